@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Офлайн-бенчмарк main.py: без интернета и настоящих VPN-серверов.
+
+Поднимает локально:
+  • HTTP-сервер — подписки (текст и base64) и «тестовые сайты»;
+  • синтетические ключи всех пяти PREFIXES: рабочие (универсальные и белые),
+    с мёртвым сервером (порт закрыт) и «зависающие» (сервер принимает TCP,
+    но трафик не идёт — проба досиживает таймаут);
+  • подмену Xray: тот же CLI `xray run -config FILE`, задержка старта,
+    доля падений при старте, SOCKS5-inbound'ы → loopback.
+
+Затем запускает main() целиком и печатает ключ/мин, p50/p99 времени
+проверки ключа, пиковый RSS и число процессов Xray.
+
+Примеры:
+  python bench.py                                  # 4 подписки × 250 ключей
+  python bench.py --keys 1000 -- --engine async    # аргументы после -- идут в main.py
+  python bench.py --json base.json                 # сохранить как базовую линию
+  python bench.py --baseline base.json -- --batch-size 20
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import random
+import socket
+import argparse
+import resource
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional
+
+FOREIGN_HOST = "127.0.0.1"   # «заблокированный в РФ» сайт
+RU_HOST      = "localhost"   # «российский» сайт — тот же сервер под другим именем
+FAKE_EGRESS  = "127.0.0.1"   # что отвечает /ip: не совпадает с --real-ip бенчмарка
+
+
+# ==================== ПОДМЕНА XRAY ====================
+def _pipe(a: socket.socket, b: socket.socket) -> None:
+    try:
+        while True:
+            data = a.recv(65536)
+            if not data:
+                break
+            b.sendall(data)
+    except OSError:
+        pass
+    finally:
+        try: b.shutdown(socket.SHUT_WR)
+        except OSError: pass
+
+
+def _recv_exact(s: socket.socket, n: int) -> bytes:
+    buf = b""
+    while len(buf) < n:
+        chunk = s.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError
+        buf += chunk
+    return buf
+
+
+def _socks_session(c: socket.socket, server_port: int, env: Dict[str, int]) -> None:
+    """SOCKS5 без авторизации; поведение зависит от порта сервера в outbound."""
+    try:
+        _recv_exact(c, _recv_exact(c, 2)[1])
+        c.sendall(b"\x05\x00")
+        _, _, _, atyp = _recv_exact(c, 4)
+        if atyp == 3:
+            host = _recv_exact(c, _recv_exact(c, 1)[0]).decode()
+        else:
+            host = socket.inet_ntop(socket.AF_INET if atyp == 1 else socket.AF_INET6,
+                                    _recv_exact(c, 4 if atyp == 1 else 16))
+        port = int.from_bytes(_recv_exact(c, 2), "big")
+
+        if server_port == env["tarpit"]:
+            # Сервер жив, но трафик не проходит: держим соединение до таймаута клиента
+            while c.recv(4096):
+                pass
+            return
+        if server_port == env["dead"] or (server_port == env["white"] and host == FOREIGN_HOST):
+            c.sendall(b"\x05\x05\x00\x01" + b"\0" * 6)
+            return
+        remote = socket.create_connection((host, port), timeout=5)
+        c.sendall(b"\x05\x00\x00\x01" + b"\0" * 6)
+        threading.Thread(target=_pipe, args=(c, remote), daemon=True).start()
+        _pipe(remote, c)
+    except (OSError, ConnectionError, IndexError):
+        pass
+    finally:
+        c.close()
+
+
+def fake_xray(config_path: str) -> None:
+    """`xray run -config FILE`: SOCKS-inbound на каждый outbound по правилам routing."""
+    env = {k: int(os.environ.get(f"BENCH_{k.upper()}_PORT", "0"))
+           for k in ("tarpit", "dead", "white")}
+    time.sleep(float(os.environ.get("BENCH_STARTUP_DELAY", "0.05")))
+    if random.random() < float(os.environ.get("BENCH_FAIL_RATE", "0")):
+        sys.exit(23)
+
+    with open(config_path) as f:
+        cfg = json.load(f)
+    outbounds = {o.get("tag"): o for o in cfg["outbounds"]}
+    rules = {r["inboundTag"][0]: r["outboundTag"]
+             for r in cfg.get("routing", {}).get("rules", [])}
+
+    for inbound in cfg["inbounds"]:
+        tag = inbound.get("tag")
+        ob = outbounds[rules[tag]] if tag in rules else cfg["outbounds"][0]
+        settings = ob.get("settings", {})
+        server = (settings.get("vnext") or settings.get("servers") or [{}])[0]
+        srv = socket.socket()
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind(("127.0.0.1", inbound["port"]))
+        srv.listen(64)
+
+        def serve(s=srv, server_port=int(server.get("port", 0))):
+            while True:
+                c, _ = s.accept()
+                threading.Thread(target=_socks_session, args=(c, server_port, env),
+                                 daemon=True).start()
+
+        threading.Thread(target=serve, daemon=True).start()
+    while True:
+        time.sleep(3600)
+
+
+# ==================== СИНТЕТИЧЕСКИЕ КЛЮЧИ ====================
+def make_key(prefix: str, host: str, port: int, tag: str) -> str:
+    uid = str(uuid.uuid4())
+    if prefix == "vless://":
+        return f"vless://{uid}@{host}:{port}?type=tcp&security=none#{tag}"
+    if prefix == "vmess://":
+        body = json.dumps({"v": "2", "ps": tag, "add": host, "port": str(port), "id": uid,
+                           "aid": "0", "scy": "auto", "net": "tcp", "tls": ""})
+        return "vmess://" + base64.b64encode(body.encode()).decode()
+    if prefix == "trojan://":
+        return f"trojan://{uid}@{host}:{port}?security=tls&sni=bench.local#{tag}"
+    if prefix == "ss://":
+        cred = base64.b64encode(f"aes-256-gcm:{uid}".encode()).decode().rstrip("=")
+        return f"ss://{cred}@{host}:{port}#{tag}"
+    return f"hysteria2://{uid}@{host}:{port}?insecure=1&sni=bench.local#{tag}"
+
+
+def make_subscriptions(subs: int, keys: int, mix: Dict[str, float], ports: Dict[str, int],
+                       dup_rate: float, seed: int) -> List[List[str]]:
+    """subs подписок по keys ключей; mix — доли видов, dup_rate — доля повторов из других подписок."""
+    rnd = random.Random(seed)
+    prefixes = ("vless://", "vmess://", "trojan://", "ss://", "hysteria2://")
+    kinds, weights = zip(*mix.items())
+    out: List[List[str]] = []
+    for si in range(subs):
+        sub = []
+        pool = [k for prev in out for k in prev]
+        for ki in range(keys):
+            if pool and rnd.random() < dup_rate:
+                sub.append(rnd.choice(pool))
+                continue
+            kind = rnd.choices(kinds, weights)[0]
+            sub.append(make_key(prefixes[ki % len(prefixes)], "127.0.0.1", ports[kind],
+                                f"{kind}-{si}-{ki}"))
+        out.append(sub)
+    return out
+
+
+# ==================== ЛОКАЛЬНЫЕ СЕРВЕРЫ ====================
+class _Handler(BaseHTTPRequestHandler):
+    subs: Dict[str, bytes] = {}
+
+    def do_GET(self):
+        if self.path in self.subs:
+            body = self.subs[self.path]
+        elif self.path == "/ip":
+            body = FAKE_EGRESS.encode()
+        else:
+            body = b"ok"
+        try:
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass    # встроенный клиент закрывает соединение после строки статуса
+
+    def log_message(self, *args):
+        pass
+
+
+def _idle_acceptor() -> socket.socket:
+    """TCP-порт, который принимает соединения и молчит (жив для предпроверки)."""
+    srv = socket.socket()
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(1024)
+    held: List[socket.socket] = []
+    threading.Thread(target=lambda: [held.append(srv.accept()[0]) for _ in iter(int, 1)],
+                     daemon=True).start()
+    return srv
+
+
+def _closed_port() -> int:
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+# ==================== ЗАМЕРЫ ====================
+class Sampler(threading.Thread):
+    """Пики: число дочерних процессов (Xray), потоков и RSS самого процесса."""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.stop = threading.Event()
+        self.peak_children = 0
+        self.peak_threads = 0
+        self.peak_rss_kb = 0
+
+    @staticmethod
+    def _children() -> int:
+        me, n = str(os.getpid()), 0
+        for pid in os.listdir("/proc"):
+            if not pid.isdigit():
+                continue
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    if f.read().rsplit(")", 1)[1].split()[1] == me:
+                        n += 1
+            except (OSError, IndexError):
+                continue
+        return n
+
+    def run(self):
+        while not self.stop.wait(0.05):
+            self.peak_children = max(self.peak_children, self._children())
+            self.peak_threads = max(self.peak_threads, threading.active_count())
+            try:
+                with open("/proc/self/status") as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            self.peak_rss_kb = max(self.peak_rss_kb, int(line.split()[1]))
+            except OSError:
+                pass
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# ==================== ЗАПУСК ====================
+def run_bench(args, main_args: List[str]) -> dict:
+    work = tempfile.mkdtemp(prefix="vpn-bench-")
+    tarpit, white = _idle_acceptor(), _idle_acceptor()
+    ports = {"tarpit": tarpit.getsockname()[1], "white": white.getsockname()[1],
+             "dead": _closed_port()}
+
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    http_port = httpd.server_address[1]
+    ports["universal"] = http_port
+    mix = {"universal": args.universal, "white": args.white,
+           "dead": args.dead, "tarpit": args.tarpit}
+    subs = make_subscriptions(args.subs, args.keys, mix, ports, args.dup_rate, args.seed)
+    urls = []
+    for i, keys in enumerate(subs):
+        body = "\n".join(keys).encode()
+        if i % 2:
+            body = base64.b64encode(body)
+        _Handler.subs[f"/sub{i}.txt"] = body
+        urls.append(f"http://127.0.0.1:{http_port}/sub{i}.txt")
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    # Подмена Xray: обёртка над этим же файлом
+    xray = os.path.join(work, "xray")
+    with open(xray, "w") as f:
+        f.write(f'#!/bin/sh\nexec "{sys.executable}" "{os.path.abspath(__file__)}" "$@"\n')
+    os.chmod(xray, 0o755)
+    os.environ.update({
+        "BENCH_TARPIT_PORT": str(ports["tarpit"]), "BENCH_WHITE_PORT": str(ports["white"]),
+        "BENCH_DEAD_PORT": str(ports["dead"]),
+        "BENCH_STARTUP_DELAY": str(args.startup_delay), "BENCH_FAIL_RATE": str(args.fail_rate),
+    })
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    c = main.CFG
+    c.XRAY_PATH = xray
+    c.FOREIGN_TEST_SITES = [f"http://{FOREIGN_HOST}:{http_port}/"]
+    c.RUSSIAN_TEST_SITES = [f"http://{RU_HOST}:{http_port}/"]
+    c.EGRESS_ECHO_URL = f"http://{RU_HOST}:{http_port}/ip"
+    c.REQUEST_TIMEOUT = args.request_timeout
+    c.CONNECTION_TIMEOUT = min(c.CONNECTION_TIMEOUT, args.request_timeout)
+    c.GEO_DEADLINE = 0          # без ipinfo.io
+    c.CHECKED_DIR = work
+    c.RU_DIR = os.path.join(work, "RU")
+    c.EURO_DIR = os.path.join(work, "EU")
+    for name in ("RESULT_CACHE_FILE", "HISTORY_DB", "ANALYTICS_FILE", "JOURNAL_FILE",
+                 "GEO_CACHE_FILE", "REAL_IP_CACHE_FILE"):
+        setattr(c, name, os.path.join(work, os.path.basename(getattr(c, name))))
+    c.FETCH_CACHE_DIR = os.path.join(work, "fetch_cache")
+
+    latencies: List[float] = []
+    lat_lock = threading.Lock()
+    check_unit = main.check_unit
+
+    def timed_unit(unit):
+        t0 = time.time()
+        try:
+            return check_unit(unit)
+        finally:
+            dt = time.time() - t0
+            with lat_lock:
+                latencies.extend([dt] * len(unit))
+
+    main.check_unit = timed_unit
+
+    sys.argv = ["main.py", "--full", "--real-ip", "10.255.255.1", "--sources", *urls, *main_args]
+    sampler = Sampler()
+    sampler.start()
+    devnull = open(os.devnull, "w")
+    real_stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = devnull
+    t0 = time.time()
+    try:
+        main.main()
+    finally:
+        elapsed = time.time() - t0
+        sys.stdout = real_stdout
+        sampler.stop.set()
+        sampler.join()
+        httpd.shutdown()
+
+    counters = main._counters.snapshot()
+    checked = counters.get("checked", 0)
+    unique = len({main.canonical_key(k) for keys in subs for k in keys})
+    return {
+        "params": {"subs": args.subs, "keys": args.keys, "mix": mix,
+                   "startup_delay": args.startup_delay, "fail_rate": args.fail_rate,
+                   "main_args": main_args},
+        "unique_keys": unique,
+        "checked": checked,
+        "elapsed_s": round(elapsed, 2),
+        "keys_per_min": round(unique / elapsed * 60, 1) if elapsed else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "peak_rss_mb": round(sampler.peak_rss_kb / 1024, 1),
+        "peak_child_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "peak_xray_procs": sampler.peak_children,
+        "peak_threads": sampler.peak_threads,
+        "xray_starts": counters.get("xray_starts", 0),
+        "probes": counters.get("probes", 0),
+        "workdir": work,
+    }
+
+
+REPORT_ROWS = [
+    ("unique_keys", "Уникальных ключей", ""),
+    ("checked", "Проверено Xray", ""),
+    ("elapsed_s", "Время", "s"),
+    ("keys_per_min", "Скорость", " ключ/мин"),
+    ("latency_p50_ms", "Проверка ключа p50", " ms"),
+    ("latency_p99_ms", "Проверка ключа p99", " ms"),
+    ("peak_rss_mb", "Пиковый RSS", " MB"),
+    ("peak_child_rss_mb", "Пиковый RSS Xray", " MB"),
+    ("peak_xray_procs", "Xray одновременно", ""),
+    ("peak_threads", "Потоков (пик)", ""),
+    ("xray_starts", "Запусков Xray", ""),
+    ("probes", "Проб сайтов", ""),
+]
+
+
+def print_report(result: dict, baseline: Optional[dict]) -> None:
+    print(f"\n{'='*70}\n BENCHMARK  {' '.join(result['params']['main_args']) or '(по умолчанию)'}\n{'='*70}")
+    for key, title, unit in REPORT_ROWS:
+        line = f"  {title:<22} {result[key]}{unit}"
+        if baseline and isinstance(baseline.get(key), (int, float)) and baseline[key]:
+            delta = (result[key] - baseline[key]) / baseline[key] * 100
+            line += f"   (база {baseline[key]}{unit}, {delta:+.0f}%)"
+        print(line)
+    print(f"{'='*70}")
+
+
+def parse_args():
+    argv = sys.argv[1:]
+    main_args: List[str] = []
+    if "--" in argv:
+        i = argv.index("--")
+        argv, main_args = argv[:i], argv[i + 1:]
+    p = argparse.ArgumentParser(description="Офлайн-бенчмарк VPN Checker")
+    p.add_argument("--subs", type=int, default=4, help="Подписок (по умолч. 4)")
+    p.add_argument("--keys", type=int, default=250, help="Ключей в подписке (по умолч. 250)")
+    p.add_argument("--universal", type=float, default=0.2, help="Доля универсальных ключей")
+    p.add_argument("--white", type=float, default=0.1, help="Доля белых (только РФ)")
+    p.add_argument("--dead", type=float, default=0.4, help="Доля с закрытым портом сервера")
+    p.add_argument("--tarpit", type=float, default=0.3, help="Доля зависающих (до таймаута)")
+    p.add_argument("--dup-rate", type=float, default=0.1, help="Доля дублей между подписками")
+    p.add_argument("--startup-delay", type=float, default=0.05, metavar="SEC",
+                   help="Задержка старта подменного Xray")
+    p.add_argument("--fail-rate", type=float, default=0.0,
+                   help="Доля запусков Xray, падающих при старте")
+    p.add_argument("--request-timeout", type=float, default=2.0, metavar="SEC",
+                   help="REQUEST_TIMEOUT для проб (по умолч. 2s, чтобы зависшие не тянули прогон)")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--json", default=None, metavar="PATH", help="Сохранить результат в JSON")
+    p.add_argument("--baseline", default=None, metavar="PATH", help="Сравнить с сохранённым JSON")
+    p.add_argument("--verbose", action="store_true", help="Показывать вывод main.py")
+    return p.parse_args(argv), main_args
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "run" and sys.argv[2] == "-config":
+        fake_xray(sys.argv[3])
+        sys.exit(0)
+
+    args, main_args = parse_args()
+    result = run_bench(args, main_args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 {args.json}")
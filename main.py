@@ -21,18 +21,37 @@ import random
 import subprocess
 import tempfile
 import requests
+from requests.adapters import HTTPAdapter
 import socket
 import re
 import hashlib
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Optional, Tuple, Dict
+import hmac
+import itertools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple, Dict, Iterable, Iterator, Callable
+from collections import defaultdict
 from dataclasses import dataclass
 import signal
 import threading
 import argparse
-from urllib.parse import urlparse, parse_qs, unquote
+from urllib.parse import urlparse, parse_qs, parse_qsl, unquote
 import base64
+import math
+import bisect
+import csv
+import binascii
+import codecs
 import ipaddress
+import ssl
+import asyncio
+import resource
+import sqlite3
+import queue
+import multiprocessing
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from contextlib import contextmanager
 
 # ==================== КОНФИГУРАЦИЯ ====================
 COUNTRY_FLAGS = {
@@ -125,7 +144,20 @@ class Config:
     SOCKS_PORT_START: int = 20000
     SOCKS_PORT_RANGE: int = 10000   # порты 20000-29999
 
-    XRAY_STARTUP_WAIT:  float = 0.5
+    XRAY_STARTUP_TIMEOUT: float = 5.0  # дедлайн готовности SOCKS-inbound
+    XRAY_READY_POLL:      float = 0.01 # первый интервал опроса, дальше x2 до 0.2s
+    BATCH_SIZE:         int   = 0      # >1 — несколько ключей на один Xray
+    CPU_WORKERS:        int   = 0      # процессов на разбор ключей (0 — по числу ядер, 1 — без пула)
+    CPU_POOL_MIN_KEYS:  int   = 5000   # меньше — разбираем в текущем процессе, пул не окупается
+    CPU_CHUNK:          int   = 2000   # ключей на одну задачу пула
+    NATIVE_PROBE:       bool  = True   # встроенный SOCKS5-клиент вместо curl
+    PROBE_WORKERS:      int   = 2048   # потоков на параллельные пробы сайтов всех ключей
+
+    # Проверка «трафик мимо прокси» для ключей, открывающих только РФ-сайты
+    EGRESS_ECHO_URL:    str   = ""     # свой echo-сервис (ответ — IP клиента текстом)
+    REAL_IP:            str   = ""     # задать вручную вместо автоопределения
+    REAL_IP_CACHE_FILE: str   = ".fetch_cache/real_ip.json"   # не в checked/ — тот коммитится
+    REAL_IP_TTL_MIN:    float = 60.0
     CONNECTION_TIMEOUT: int   = 4
     REQUEST_TIMEOUT:    int   = 8
     TOTAL_TIMEOUT:      int   = 25
@@ -134,6 +166,87 @@ class Config:
     MAX_TOTAL_WORKERS:   int = 80
     MAX_KEYS:            int = 999999
 
+    # Кэш результатов между прогонами (--full — игнорировать); не в checked/ — он публикуется
+    RESULT_CACHE_FILE:      str   = ".fetch_cache/results_cache.json"
+    RESULT_TTL_OK_HOURS:    float = 6.0
+    RESULT_TTL_FAIL_HOURS:  float = 12.0
+    RESULT_CACHE_KEEP_DAYS: int   = 7
+
+    # История проверок (SQLite; analytics.json импортируется один раз).
+    # Не в checked/: бинарная база не коммитится, а живёт в кэше Actions
+    HISTORY_DB:          str   = ".fetch_cache/history.sqlite"
+    ANALYTICS_FILE:      str   = "checked/analytics.json"
+    HISTORY_KEEP_CHECKS: int   = 50
+    HISTORY_KEEP_DAYS:   float = 30.0
+
+    # Приоритет ключей по истории: давность, задержка
+    SCORE_HALF_LIFE_HOURS: float = 48.0
+    SCORE_LATENCY_WEIGHT:  float = 0.2    # до -20% оценки у самых медленных
+    SCORE_LATENCY_REF_MS:  int   = 3000
+
+    # --time-budget: сколько минут оставить на сохранение и коммит
+    SAVE_RESERVE_MIN: float = 10.0
+
+    # --daemon: постоянный процесс с перепроверкой по расписанию
+    DAEMON_FETCH_INTERVAL_MIN: float = 30.0   # как часто перекачивать подписки
+    DAEMON_OK_RECHECK_MIN:     float = 60.0   # рабочий стабильный ключ; нестабильный — до 4× чаще
+    DAEMON_FAIL_RECHECK_MIN:   float = 60.0   # первая перепроверка нерабочего, дальше ×2
+    DAEMON_MAX_RECHECK_H:      float = 12.0
+    DAEMON_ROUND_KEYS:         int   = 2000   # ключей за раунд, после раунда — сохранение
+
+    # Распределённая проверка (--coordinator / --worker)
+    SHARD_TOKEN:          str   = ""      # общий секрет узлов (заголовок X-Shard-Token)
+    SHARD_VNODES:         int   = 64      # точек на узел в кольце хэшей
+    SHARD_WORKER_TIMEOUT: float = 30.0    # без вестей дольше — узел потерян, шард переназначается
+    SHARD_LEASE_TIMEOUT:  float = 300.0   # выданный, но не вернувшийся ключ выдаётся заново
+    SHARD_HEARTBEAT:      float = 2.0     # как часто воркер отправляет накопленные результаты
+
+    # Метрики Prometheus (--metrics-port; 0 — выключено)
+    METRICS_PORT:   int   = 0
+    METRICS_HOST:   str   = "127.0.0.1"
+    METRICS_WINDOW: float = 60.0   # окно для текущей скорости, сек
+
+    # Чекпоинты прогона для --resume (не в checked/ — он публикуется)
+    JOURNAL_FILE:        str   = ".fetch_cache/journal.jsonl"
+    CHECKPOINT_INTERVAL: float = 30.0
+
+    # Предпроверка host:port одним TCP connect на сервер; с ENDPOINT_PROBE_TLS
+    # у TLS/Reality-ключей ещё и ClientHello с SNI (ключи группируются по SNI)
+    ENDPOINT_PROBE:          bool  = True
+    ENDPOINT_PROBE_TLS:      bool  = False
+    ENDPOINT_PROBE_TIMEOUT:  float = 3.0
+    ENDPOINT_PROBE_ATTEMPTS: int   = 2
+    ENDPOINT_PROBE_WORKERS:  int   = 200
+
+    # DNS: общий кэш с TTL, резолв всех хостов заранее
+    DNS_WORKERS:      int   = 64
+    DNS_TIMEOUT:      float = 5.0
+    DNS_TTL:          float = 1800.0
+    DNS_NEGATIVE_TTL: float = 300.0
+
+    # Локальная база IP → страна ("" — geoip.dat рядом с XRAY_PATH)
+    GEOIP_DB: str = ""
+
+    # Страны при сохранении: ipinfo.io пачкой, с лимитом частоты и дедлайном
+    GEO_CACHE_FILE:     str   = ".fetch_cache/geo_cache.json"
+    GEO_CACHE_TTL_DAYS: int   = 30
+    GEO_WORKERS:        int   = 8
+    GEO_RATE:           float = 10.0   # запросов в секунду
+    GEO_DEADLINE:       float = 60.0   # дальше — метка UNKNOWN
+
+    # Загрузка подписок: параллельно, с условными запросами (ETag/Last-Modified)
+    FETCH_WORKERS:   int  = 16
+    FETCH_CACHE:     bool = True
+    FETCH_CACHE_DIR: str  = ".fetch_cache"
+
+    # Адаптивный лимит (--adaptive): AIMD между MIN и MAX
+    ADAPTIVE_MIN_WORKERS:  int   = 8
+    ADAPTIVE_MAX_WORKERS:  int   = 400
+    ADAPTIVE_STEP:         int   = 8
+    ADAPTIVE_BACKOFF:      float = 0.7
+    ADAPTIVE_INTERVAL:     float = 10.0
+    ADAPTIVE_PRESSURE_MAX: float = 0.9   # доля CPU/памяти/fd, при которой сбрасываем
+
     RUSSIAN_TEST_SITES: List[str] = None
     FOREIGN_TEST_SITES: List[str] = None
     SOURCES:            List[str] = None
@@ -153,7 +266,7 @@ class Config:
             ]
         if self.SOURCES is None:
             # ===== ВСТАВЬ СВОИ ССЫЛКИ СЮДА =====
-self.SOURCES = [
+            self.SOURCES = [
     "https://gist.githubusercontent.com/flaafix/c79a81037d15163360571c7a7331b153/raw/AetrisVPN.txt",
     "https://mifa.world/other",
     "https://mifa.world/vmess",
@@ -431,12 +544,13 @@ self.SOURCES = [
 "https://gitverse.ru/api/repos/RUVIPIEN/russian-white-bolt/raw/branch/master/VPNMIRRORS/v2ray/Xray_Mix_URI_c4598b.txt",
 "https://gitverse.ru/api/repos/RUVIPIEN/russian-white-bolt/raw/branch/master/VPNMIRRORS/v2ray/Yitong_V2Ray_11218f.txt",
 "https://gitverse.ru/api/repos/RUVIPIEN/russian-white-bolt/raw/branch/master/VPNMIRRORS/happ/SER38_Happ_Sub1_ddd131.txt",
-]
+            ]
 
 
 CFG = Config()
 
 # Глобальный семафор — ограничивает суммарное кол-во Xray
+# (AdaptiveLimiter в режиме --adaptive)
 _global_semaphore: threading.Semaphore = None
 
 # Реальный IP машины (устанавливается один раз при старте)
@@ -447,36 +561,339 @@ _port_counter = 0
 _port_lock = threading.Lock()
 
 
-def alloc_port() -> int:
+def _port_busy(port: int) -> bool:
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(("127.0.0.1", port))
+        return False
+    except OSError:
+        return True
+    finally:
+        s.close()
+
+
+def alloc_port() -> Optional[int]:
+    """Следующий порт диапазона; занятые (чужой Xray — например, второй
+    воркер на той же машине) пропускаются. None — свободного не нашлось."""
     global _port_counter
-    with _port_lock:
-        port = CFG.SOCKS_PORT_START + (_port_counter % CFG.SOCKS_PORT_RANGE)
-        _port_counter += 1
-    return port
+    for _ in range(64):
+        with _port_lock:
+            port = CFG.SOCKS_PORT_START + (_port_counter % CFG.SOCKS_PORT_RANGE)
+            _port_counter += 1
+        if not _port_busy(port):
+            return port
+    return None
+
+
+# ==================== СЧЁТЧИКИ ПРОГОНА ====================
+class RunCounters:
+    """Потокобезопасные счётчики событий прогона (проверки, таймауты, старты Xray)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[str, int] = defaultdict(int)
+
+    def inc(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self._values[name] += n
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._values)
+
+
+_counters = RunCounters()
+# Неуспешные проверки по причине (для /metrics)
+_failures = RunCounters()
+
+
+# ==================== ПРОФИЛИРОВАНИЕ ЭТАПОВ (--profile) ====================
+class StageProfiler:
+    """
+    Время по этапам проверки ключа (--profile). Каждый поток пишет в свой
+    словарь без блокировок; гистограммы — логарифмические корзины (×2,
+    первая до 0.5 мс). Сводка собирается один раз, в конце прогона.
+    """
+
+    BUCKETS = 24
+    BASE_MS = 0.5
+
+    def __init__(self):
+        self.enabled = False
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._tables: List[Dict[str, list]] = []
+
+    def _table(self) -> Dict[str, list]:
+        t = getattr(self._local, "table", None)
+        if t is None:
+            t = self._local.table = {}
+            with self._lock:
+                self._tables.append(t)
+        return t
+
+    def record(self, name: str, seconds: float) -> None:
+        if not self.enabled:
+            return
+        t = self._table()
+        h = t.get(name)
+        if h is None:
+            h = t[name] = [0, 0.0, 0.0, [0] * self.BUCKETS]
+        h[0] += 1
+        h[1] += seconds
+        if seconds > h[2]:
+            h[2] = seconds
+        ms = seconds * 1000
+        b = 0 if ms <= self.BASE_MS else int(math.log2(ms / self.BASE_MS)) + 1
+        h[3][min(b, self.BUCKETS - 1)] += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def _bound_ms(self, b: int) -> float:
+        return self.BASE_MS * (2 ** b)
+
+    def summary(self) -> Dict[str, dict]:
+        with self._lock:
+            tables = list(self._tables)
+        merged: Dict[str, list] = {}
+        for t in tables:
+            for name, (n, total, peak, hist) in list(t.items()):
+                m = merged.setdefault(name, [0, 0.0, 0.0, [0] * self.BUCKETS])
+                m[0] += n
+                m[1] += total
+                m[2] = max(m[2], peak)
+                m[3] = [a + b for a, b in zip(m[3], hist)]
+
+        out = {}
+        for name, (n, total, peak, hist) in merged.items():
+            def pct(q: float) -> float:
+                # Верхняя граница корзины, в которую попал квантиль
+                need, acc = q * n, 0
+                for b, c in enumerate(hist):
+                    acc += c
+                    if acc >= need:
+                        return min(self._bound_ms(b), peak * 1000)
+                return peak * 1000
+            out[name] = {
+                "count": n,
+                "total_s": round(total, 3),
+                "mean_ms": round(total * 1000 / n, 2) if n else 0.0,
+                "p50_ms": round(pct(0.5), 2),
+                "p90_ms": round(pct(0.9), 2),
+                "p99_ms": round(pct(0.99), 2),
+                "max_ms": round(peak * 1000, 2),
+                "histogram_ms": {f"{self._bound_ms(b):g}": c for b, c in enumerate(hist) if c},
+            }
+        return out
+
+    def report(self, path: str = "") -> None:
+        data = self.summary()
+        if not data:
+            return
+        print(f"\n{'='*70}\nПРОФИЛЬ ЭТАПОВ (мс; p50/p90/p99 — по корзинам ×2)\n{'='*70}")
+        print(f"{'этап':<34}{'кол-во':>8}{'всего,с':>10}{'сред':>9}{'p50':>8}{'p90':>8}{'p99':>8}{'макс':>9}")
+        for name, r in sorted(data.items(), key=lambda kv: -kv[1]["total_s"]):
+            print(f"{name[:33]:<34}{r['count']:>8}{r['total_s']:>10.1f}{r['mean_ms']:>9.1f}"
+                  f"{r['p50_ms']:>8.0f}{r['p90_ms']:>8.0f}{r['p99_ms']:>8.0f}{r['max_ms']:>9.0f}")
+        if path:
+            save_json(path, data)
+            print(f"📄 Профиль: {path}")
+
+
+_profiler = StageProfiler()
+
+
+# ==================== АДАПТИВНЫЙ ЛИМИТ XRAY ====================
+class AdaptiveLimiter:
+    """Семафор с изменяемым на лету лимитом в пределах [lo, hi]."""
+
+    def __init__(self, limit: int, lo: int, hi: int):
+        self._cond = threading.Condition()
+        self.lo, self.hi = lo, hi
+        self.limit = max(lo, min(hi, limit))
+        self.in_use = 0
+
+    def acquire(self) -> None:
+        with self._cond:
+            while self.in_use >= self.limit:
+                self._cond.wait()
+            self.in_use += 1
+
+    def release(self) -> None:
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify()
+
+    def resize(self, limit: int) -> int:
+        with self._cond:
+            self.limit = max(self.lo, min(self.hi, int(limit)))
+            self._cond.notify_all()
+            return self.limit
+
+
+def limiter_capacity() -> int:
+    """Максимум одновременных проверок, который может дать текущий лимитер."""
+    if isinstance(_global_semaphore, AdaptiveLimiter):
+        return _global_semaphore.hi
+    batch = CFG.BATCH_SIZE if CFG.BATCH_SIZE > 1 else 1
+    return max(1, CFG.MAX_TOTAL_WORKERS // batch)
+
+
+def _resource_pressure() -> Tuple[float, str]:
+    """Самый загруженный локальный ресурс: (доля 0..1, название). Linux: /proc."""
+    worst = (0.0, "")
+    try:
+        cpu = os.getloadavg()[0] / (os.cpu_count() or 1)
+        worst = max(worst, (cpu, "CPU"))
+    except OSError:
+        pass
+    try:
+        mem = {}
+        with open("/proc/meminfo") as f:
+            for line in f:
+                k, v = line.split(":", 1)
+                mem[k] = int(v.split()[0])
+        worst = max(worst, (1 - mem["MemAvailable"] / mem["MemTotal"], "память"))
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+        if soft > 0:
+            worst = max(worst, (len(os.listdir("/proc/self/fd")) / soft, "дескрипторы"))
+    except (OSError, ValueError):
+        pass
+    return worst
+
+
+class ConcurrencyController(threading.Thread):
+    """
+    AIMD-регулятор лимита одновременных Xray.
+
+    Раз в ADAPTIVE_INTERVAL секунд смотрит на скорость (ключ/мин), долю
+    таймаутов проб, долю Xray, не успевших стартовать, и запас по CPU/памяти/
+    дескрипторам. Пока скорость растёт и ресурсы есть — лимит += шаг,
+    при перегрузке — лимит *= ADAPTIVE_BACKOFF.
+    """
+
+    def __init__(self, limiter: AdaptiveLimiter, stop_event: threading.Event):
+        super().__init__(daemon=True, name="concurrency-controller")
+        self.limiter = limiter
+        self.stop_event = stop_event
+        self.timeout_ewma: Optional[float] = None
+
+    def run(self) -> None:
+        prev = _counters.snapshot()
+        t_prev = time.time()
+        prev_rate: Optional[float] = None
+        grew = False
+        while not self.stop_event.wait(CFG.ADAPTIVE_INTERVAL):
+            cur, now = _counters.snapshot(), time.time()
+            delta = {k: cur.get(k, 0) - prev.get(k, 0) for k in cur}
+            rate = delta.get("checked", 0) / (now - t_prev) * 60
+            prev, t_prev = cur, now
+            if not delta.get("checked"):
+                continue
+
+            probes = delta.get("probes", 0)
+            timeout_ratio = delta.get("probe_timeouts", 0) / probes if probes else 0.0
+            starts = delta.get("xray_starts", 0)
+            slow_ratio = delta.get("xray_slow", 0) / starts if starts else 0.0
+            pressure, resource_name = _resource_pressure()
+
+            reason = ""
+            if pressure >= CFG.ADAPTIVE_PRESSURE_MAX:
+                reason = f"{resource_name} {pressure:.0%}"
+            elif slow_ratio > 0.1:
+                reason = f"Xray не успевает стартовать ({slow_ratio:.0%})"
+            elif self.timeout_ewma is not None and timeout_ratio > self.timeout_ewma + 0.15:
+                reason = f"всплеск таймаутов ({timeout_ratio:.0%})"
+            elif grew and prev_rate and rate < prev_rate * 0.9:
+                reason = "скорость упала"
+
+            old = self.limiter.limit
+            if reason:
+                new = self.limiter.resize(old * CFG.ADAPTIVE_BACKOFF)
+                grew = False
+            elif (pressure < CFG.ADAPTIVE_PRESSURE_MAX * 0.85
+                  and self.limiter.in_use >= old * 0.9
+                  and (prev_rate is None or rate >= prev_rate * 0.97)):
+                new = self.limiter.resize(old + CFG.ADAPTIVE_STEP)
+                grew = new > old
+                reason = "есть запас"
+            else:
+                new, grew = old, False
+
+            if new != old:
+                print(f"   ⚙️  Лимит Xray: {old} → {new} ({reason}, {rate:.0f} ключ/мин)")
+            self.timeout_ewma = (timeout_ratio if self.timeout_ewma is None
+                                 else 0.7 * self.timeout_ewma + 0.3 * timeout_ratio)
+            prev_rate = rate
 
 
 # ==================== XRAY ====================
 class XrayManager:
-    def __init__(self, config_path: str, port: int):
+    def __init__(self, config_path: str, port: int, ports: Optional[List[int]] = None):
         self.config_path = config_path
         self.port = port
+        self.ports = ports or [port]      # у пачки — все SOCKS-inbound
         self.process = None
+        self.startup_time: Optional[float] = None
+        self.slow = False                 # не успел к дедлайну (перегрузка), а не упал
 
     def start(self) -> bool:
         try:
             if not os.path.exists(CFG.XRAY_PATH):
                 return False
-            self.process = subprocess.Popen(
-                [CFG.XRAY_PATH, "run", "-config", self.config_path],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                preexec_fn=os.setsid,
-            )
-            time.sleep(CFG.XRAY_STARTUP_WAIT)
-            return self.process.poll() is None
+            t0 = time.time()
+            with _profiler.stage("xray_spawn"):
+                self.process = subprocess.Popen(
+                    [CFG.XRAY_PATH, "run", "-config", self.config_path],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    preexec_fn=os.setsid,
+                )
+            _counters.inc("xray_starts")
+            _counters.inc("xray_running")
+            with _profiler.stage("xray_startup_wait"):
+                ready = self.wait_ready(t0 + CFG.XRAY_STARTUP_TIMEOUT)
+            self.startup_time = time.time() - t0
+            if not ready and self.process.poll() is None:
+                # Процесс жив, но порт не открылся к дедлайну — признак перегрузки
+                _counters.inc("xray_slow")
+                self.slow = True
+            return ready
         except:
+            _counters.inc("xray_slow")
+            self.slow = True
             return False
 
+    def wait_ready(self, deadline: float) -> bool:
+        """Опрашивает SOCKS-порты с нарастающей паузой, пока все они не примут
+        соединение, процесс не завершится или не истечёт дедлайн."""
+        delay = CFG.XRAY_READY_POLL
+        pending = list(self.ports)
+        while True:
+            if self.process.poll() is not None:
+                return False
+            with _profiler.stage("port_probe"):
+                pending = [p for p in pending if not check_socks_port(p, timeout=0.2)]
+            if not pending:
+                return True
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            time.sleep(min(delay, left))
+            delay = min(delay * 2, 0.2)
+
     def stop(self):
         if self.process:
             try:
@@ -485,9 +902,11 @@ class XrayManager:
             except:
                 try:
                     os.killpg(os.getpgid(self.process.pid), signal.SIGKILL)
+                    self.process.wait(timeout=3)
                 except:
                     pass
             self.process = None
+            _counters.inc("xray_running", -1)
 
 
 # ==================== ПАРСЕРЫ ====================
@@ -498,21 +917,74 @@ def create_xray_config(key: str, port: int) -> Optional[dict]:
                       "settings": {"auth": "noauth", "udp": True}}],
         "outbounds": [{"protocol": "freedom", "settings": {}}],
     }
+    outbound = parse_outbound(key)
+    if outbound:
+        config["outbounds"].insert(0, outbound)
+        return config
+    return None
+
+
+# Готовый outbound в JSON по ключу — из prepare_keys (пул процессов)
+_outbound_json: Dict[str, str] = {}
+
+
+def retain_outbounds(keys: Iterable[str]) -> None:
+    """Оставляет в _outbound_json только ключи, которые пойдут в проверку."""
+    keep = set(keys)
+    for k in [k for k in _outbound_json if k not in keep]:
+        del _outbound_json[k]
+
+
+_CONFIG_TEMPLATE = ('{"log":{"loglevel":"none"},'
+                    '"inbounds":[{"port":%d,"protocol":"socks","settings":{"auth":"noauth","udp":true}}],'
+                    '"outbounds":[%s,{"protocol":"freedom","settings":{}}]}')
+
+
+def xray_config_text(key: str, port: int) -> Optional[str]:
+    """create_xray_config сразу в JSON: для разобранного заранее ключа — подстановкой в шаблон."""
+    outbound = _outbound_json.get(key)
+    if outbound is not None:
+        return _CONFIG_TEMPLATE % (port, outbound)
+    config = create_xray_config(key, port)
+    return json.dumps(config) if config else None
+
+
+def parse_outbound(key: str) -> Optional[dict]:
+    """Outbound Xray для ключа любого поддерживаемого протокола (None — не разобрать)."""
     try:
-        if   key.startswith("vless://"):     outbound = _parse_vless(key)
-        elif key.startswith("vmess://"):     outbound = _parse_vmess(key)
-        elif key.startswith("trojan://"):    outbound = _parse_trojan(key)
-        elif key.startswith("ss://"):        outbound = _parse_ss(key)
-        elif key.startswith("hysteria2://"): outbound = _parse_hy2(key)
-        else: return None
-        if outbound:
-            config["outbounds"].insert(0, outbound)
-            return config
+        if   key.startswith("vless://"):     return _parse_vless(key)
+        elif key.startswith("vmess://"):     return _parse_vmess(key)
+        elif key.startswith("trojan://"):    return _parse_trojan(key)
+        elif key.startswith("ss://"):        return _parse_ss(key)
+        elif key.startswith("hysteria2://"): return _parse_hy2(key)
     except:
         pass
     return None
 
 
+def create_batch_config(configs: List[dict]) -> dict:
+    """
+    Склеивает одиночные конфиги create_xray_config в один: каждый SOCKS-inbound
+    маршрутизируется в свой outbound по тегу, так что один Xray проверяет
+    сразу пачку ключей.
+    """
+    batch = {
+        "log": {"loglevel": "none"},
+        "inbounds": [],
+        "outbounds": [],
+        "routing": {"domainStrategy": "AsIs", "rules": []},
+    }
+    for i, single in enumerate(configs):
+        inbound  = dict(single["inbounds"][0],  tag=f"in-{i}")
+        outbound = dict(single["outbounds"][0], tag=f"out-{i}")
+        batch["inbounds"].append(inbound)
+        batch["outbounds"].append(outbound)
+        batch["routing"]["rules"].append(
+            {"type": "field", "inboundTag": [inbound["tag"]], "outboundTag": outbound["tag"]})
+    batch["outbounds"].append({"protocol": "freedom", "settings": {}, "tag": "direct"})
+    return batch
+
+
 def _parse_vless(key: str) -> Optional[dict]:
     key = key.replace("vless://", "")
     if "@" not in key: return None
@@ -641,8 +1113,67 @@ def _parse_hy2(key: str) -> Optional[dict]:
     return ob
 
 
+# ==================== КАНОНИЗАЦИЯ КЛЮЧЕЙ ====================
+def _b64_text(data: str) -> Optional[str]:
+    """base64 (обычный или URL-safe, с паддингом или без) → текст; None — не base64."""
+    data = data.strip()
+    try:
+        return base64.urlsafe_b64decode(
+            data.replace("+", "-").replace("/", "_") + "=" * (-len(data) % 4)).decode("utf-8")
+    except (ValueError, binascii.Error):
+        return None
+
+
+def _canonical_parts(key: str) -> Optional[list]:
+    scheme, sep, body = key.partition("://")
+    if not sep:
+        return None
+    scheme = scheme.lower()
+    body = body.split("#", 1)[0]
+    if scheme == "vmess":
+        text = _b64_text(body)
+        try:
+            v = json.loads(text) if text else None
+        except ValueError:
+            return None
+        if not isinstance(v, dict):
+            return None
+        v = {k: unquote(str(x)) for k, x in v.items() if k != "ps"}
+        if "add" in v:
+            v["add"] = v["add"].lower()
+        return [scheme, sorted(v.items())]
+
+    body, _, query = body.partition("?")
+    netloc, slash, path = body.partition("/")
+    if scheme == "ss" and "@" not in netloc:
+        # Старый формат: base64 от method:password@host:port целиком
+        netloc = _b64_text(netloc) or netloc
+    userinfo, at, hostport = netloc.rpartition("@")
+    if scheme == "ss" and at:
+        decoded = _b64_text(unquote(userinfo))
+        if decoded and ":" in decoded:
+            userinfo = decoded
+    params = sorted(parse_qsl(query, keep_blank_values=True))
+    return [scheme, unquote(userinfo), hostport.lower(), unquote(slash + path), params]
+
+
+def canonical_key(key: str) -> str:
+    """
+    Идентичность ключа для дедупликации — по URI целиком, без потерь:
+    все параметры транспорта и TLS различают ключи. Не учитываются только
+    имя после # (у vmess — поле ps), порядок и %XX-кодирование
+    query-параметров, регистр схемы и адреса, кодировка userinfo у ss.
+    Нераспознанные ключи сравниваются по строке без имени.
+    """
+    parts = _canonical_parts(key)
+    if parts is None:
+        return "raw:" + key.split("#", 1)[0]
+    ident = json.dumps(parts, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(ident.encode("utf-8")).hexdigest()
+
+
 # ==================== SOCKS / CURL ====================
-def check_socks_port(port: int, timeout: int = 3) -> bool:
+def check_socks_port(port: int, timeout: float = 3) -> bool:
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.settimeout(timeout)
@@ -653,24 +1184,255 @@ def check_socks_port(port: int, timeout: int = 3) -> bool:
         return False
 
 
-def curl_check(port: int, url: str) -> Tuple[bool, float]:
+@dataclass
+class ProbeResult:
+    """Результат HTTP-запроса через SOCKS5 с разбивкой по этапам (секунды от старта)."""
+    ok: bool = False
+    elapsed: float = 0.0
+    status: int = 0
+    connect: float = 0.0      # TCP + SOCKS5 CONNECT до целевого хоста
+    tls: float = 0.0          # TLS-рукопожатие завершено
+    first_byte: float = 0.0   # первый байт ответа
+    body: bytes = b""
+    error: str = ""
+
+
+OK_HTTP_CODES = (200, 204, 301, 302)
+
+_ssl_ctx = ssl.create_default_context()
+
+
+def _recv_exact(s: socket.socket, n: int) -> bytes:
+    buf = b""
+    while len(buf) < n:
+        chunk = s.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("соединение закрыто")
+        buf += chunk
+    return buf
+
+
+def _socks5_connect(s: socket.socket, host: str, port: int) -> None:
+    """Рукопожатие SOCKS5 без авторизации + CONNECT по имени (аналог socks5h)."""
+    s.sendall(b"\x05\x01\x00")
+    if _recv_exact(s, 2) != b"\x05\x00":
+        raise ConnectionError("SOCKS5: метод не принят")
+    h = host.encode("idna")
+    s.sendall(b"\x05\x01\x00\x03" + bytes([len(h)]) + h + port.to_bytes(2, "big"))
+    ver, rep, _, atyp = _recv_exact(s, 4)
+    if ver != 5 or rep != 0:
+        raise ConnectionError(f"SOCKS5: ошибка {rep}")
+    if atyp == 1:   _recv_exact(s, 4 + 2)
+    elif atyp == 4: _recv_exact(s, 16 + 2)
+    elif atyp == 3: _recv_exact(s, _recv_exact(s, 1)[0] + 2)
+    else: raise ConnectionError("SOCKS5: неизвестный тип адреса")
+
+
+def _dechunk(body: bytes) -> bytes:
+    out = b""
+    while body:
+        size_line, _, body = body.partition(b"\r\n")
+        size = int(size_line.split(b";")[0] or b"0", 16)
+        if size == 0:
+            break
+        out += body[:size]
+        body = body[size + 2:]
+    return out
+
+
+class ProbeCancel:
+    """
+    Отмена незавершённых проб одного ключа: закрывает их сокеты
+    (блокирующий recv сразу падает) и убивает запущенные curl.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self._lock = threading.Lock()
+        self._handles: list = []
+
+    def check(self) -> None:
+        """Бросает ConnectionError, если проба уже отменена (перед каждым блокирующим шагом)."""
+        if self.event.is_set():
+            raise ConnectionError("отменено")
+
+    def register(self, handle) -> bool:
+        """Взять сокет / процесс под отмену. False — уже отменено."""
+        with self._lock:
+            if self.event.is_set():
+                return False
+            self._handles.append(handle)
+            return True
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.event.set()
+            handles, self._handles = self._handles, []
+        for h in handles:
+            try:
+                if isinstance(h, socket.socket):
+                    # Для SSLSocket — shutdown самого сокета: идущее рукопожатие
+                    # или recv в другом потоке сразу получает обрыв
+                    socket.socket.shutdown(h, socket.SHUT_RDWR)
+                else:
+                    h.kill()
+            except Exception:
+                pass
+
+
+def socks_http_request(port: int, url: str, read_body: bool = False,
+                       timeout: Optional[float] = None,
+                       connect_timeout: Optional[float] = None,
+                       max_body: int = 65536,
+                       cancel: Optional[ProbeCancel] = None) -> ProbeResult:
+    """
+    GET через локальный SOCKS5-порт Xray без запуска curl.
+    Без read_body читается только строка статуса — как curl -o /dev/null, но без тела.
+    cancel позволяет прервать запрос из другого потока.
+    """
+    timeout = timeout or CFG.REQUEST_TIMEOUT
+    connect_timeout = connect_timeout or CFG.CONNECTION_TIMEOUT
+    res = ProbeResult()
+    t0 = time.time()
+    deadline = t0 + timeout
+    s = None
+    try:
+        u = urlparse(url)
+        https = u.scheme == "https"
+        host = u.hostname or ""
+        dport = u.port or (443 if https else 80)
+        path = (u.path or "/") + (f"?{u.query}" if u.query else "")
+
+        if cancel is not None:
+            cancel.check()
+        s = socket.create_connection(("127.0.0.1", port),
+                                     timeout=min(connect_timeout, timeout))
+        if cancel is not None and not cancel.register(s):
+            raise ConnectionError("отменено")
+        _socks5_connect(s, host, dport)
+        res.connect = time.time() - t0
+
+        if https:
+            if cancel is not None:
+                cancel.check()
+            s.settimeout(max(0.1, deadline - time.time()))
+            # wrap_socket отсоединяет исходный сокет (fileno → -1): под отмену
+            # берём уже SSLSocket, и только потом начинаем рукопожатие
+            s = _ssl_ctx.wrap_socket(s, server_hostname=host, do_handshake_on_connect=False)
+            if cancel is not None and not cancel.register(s):
+                raise ConnectionError("отменено")
+            s.do_handshake()
+            res.tls = time.time() - t0
+
+        if cancel is not None:
+            cancel.check()
+        s.settimeout(max(0.1, deadline - time.time()))
+        s.sendall((f"GET {path} HTTP/1.1\r\nHost: {host}\r\n"
+                   f"User-Agent: curl/8.5.0\r\nAccept: */*\r\n"
+                   f"Connection: close\r\n\r\n").encode())
+
+        if cancel is not None:
+            cancel.check()
+        data = s.recv(4096)
+        res.first_byte = time.time() - t0
+        if not data:
+            raise ConnectionError("пустой ответ")
+        while b"\r\n" not in data and len(data) < 4096:
+            chunk = s.recv(4096)
+            if not chunk: break
+            data += chunk
+        status_line = data.split(b"\r\n", 1)[0].decode("latin-1")
+        parts = status_line.split(" ")
+        res.status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+
+        if read_body:
+            while len(data) < max_body:
+                if time.time() >= deadline or (cancel is not None and cancel.event.is_set()):
+                    break
+                s.settimeout(max(0.1, deadline - time.time()))
+                chunk = s.recv(8192)
+                if not chunk: break
+                data += chunk
+            head, _, body = data.partition(b"\r\n\r\n")
+            if b"transfer-encoding: chunked" in head.lower():
+                body = _dechunk(body)
+            res.body = body[:max_body]
+
+        res.ok = res.status in OK_HTTP_CODES
+    except socket.timeout:
+        res.error = "timeout"
+    except Exception as e:
+        res.error = str(e)[:60] or type(e).__name__
+    finally:
+        res.elapsed = time.time() - t0
+        if s is not None:
+            try: s.close()
+            except: pass
+    return res
+
+
+def probe_site(port: int, url: str, cancel: Optional[ProbeCancel] = None) -> ProbeResult:
+    """Проверка сайта через прокси: встроенный клиент или curl (CFG.NATIVE_PROBE)."""
+    t0 = time.perf_counter()
+    if CFG.NATIVE_PROBE:
+        r = socks_http_request(port, url, cancel=cancel)
+    else:
+        ok, elapsed = _curl_subprocess_check(port, url, cancel)
+        r = ProbeResult(ok=ok, elapsed=elapsed,
+                        error="" if ok or elapsed < CFG.REQUEST_TIMEOUT else "timeout")
+    if _profiler.enabled:
+        _profiler.record(f"probe:{urlparse(url).hostname}", time.perf_counter() - t0)
+    _counters.inc("probes")
+    if cancel is not None and cancel.event.is_set() and not r.ok:
+        _counters.inc("probes_cancelled")
+    elif r.error == "timeout":
+        _counters.inc("probe_timeouts")
+    return r
+
+
+def format_timings(r: ProbeResult) -> str:
+    if not r.first_byte:
+        return f"{r.elapsed:.1f}s"
+    tls = f" tls {r.tls:.2f}" if r.tls else ""
+    return f"{r.elapsed:.1f}s: conn {r.connect:.2f}{tls} ttfb {r.first_byte:.2f}"
+
+
+def _curl_subprocess_check(port: int, url: str,
+                           cancel: Optional[ProbeCancel] = None) -> Tuple[bool, float]:
     try:
         t0 = time.time()
-        r = subprocess.run(
+        proc = subprocess.Popen(
             ["curl", "-x", f"socks5h://127.0.0.1:{port}",
              "-m", str(CFG.REQUEST_TIMEOUT),
              "--connect-timeout", str(CFG.CONNECTION_TIMEOUT),
              "-s", "-o", "/dev/null", "-w", "%{http_code}",
              url],
-            capture_output=True, timeout=CFG.REQUEST_TIMEOUT + 2,
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
         )
+        if cancel is not None and not cancel.register(proc):
+            proc.kill()
+        try:
+            out, _ = proc.communicate(timeout=CFG.REQUEST_TIMEOUT + 2)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
         elapsed = time.time() - t0
-        code = r.stdout.decode().strip()
+        code = out.decode().strip()
         return code in ("200","204","301","302"), elapsed
     except:
         return False, float(CFG.REQUEST_TIMEOUT)
 
 
+def _parse_ip(text: str) -> Optional[str]:
+    """IP из ответа echo-сервиса; HTML-страница ошибки или мусор — None."""
+    text = text.strip()
+    try:
+        return str(ipaddress.ip_address(text)) if len(text) < 50 else None
+    except ValueError:
+        return None
+
+
 def get_real_ip() -> Optional[str]:
     """Получить реальный IP машины (без прокси). Вызывается один раз при старте."""
     services = [
@@ -679,45 +1441,89 @@ def get_real_ip() -> Optional[str]:
         "https://api4.my-ip.io/ip",
         "https://ipv4.icanhazip.com",
     ]
+    if CFG.EGRESS_ECHO_URL:
+        services.insert(0, CFG.EGRESS_ECHO_URL)
     for url in services:
         try:
             r = requests.get(url, timeout=5)
             if r.status_code == 200:
-                ip = r.text.strip()
-                if ip and len(ip) < 50 and "." in ip:
+                ip = _parse_ip(r.text)
+                if ip:
                     return ip
         except:
             continue
     return None
 
 
+def detect_real_ip(fresh: bool = False) -> Optional[str]:
+    """
+    Реальный IP для проверки «трафик мимо прокси»: CFG.REAL_IP, свежий
+    кэш (REAL_IP_CACHE_FILE, REAL_IP_TTL_MIN) или один опрос сервисов.
+    fresh — мимо кэша (долгоживущий --daemon: IP машины мог смениться).
+    """
+    if CFG.REAL_IP:
+        return CFG.REAL_IP
+    cached = load_json(CFG.REAL_IP_CACHE_FILE)
+    if (not fresh and cached.get("ip")
+            and time.time() - cached.get("time", 0) < CFG.REAL_IP_TTL_MIN * 60):
+        return cached["ip"]
+    ip = get_real_ip()
+    if ip:
+        save_json(CFG.REAL_IP_CACHE_FILE, {"ip": ip, "time": time.time()})
+    return ip
+
+
 # Запасные сервисы для проверки IP (если один заблокирует при массовых запросах)
 IP_CHECK_URLS = [
     "https://ipinfo.io/ip",
     "https://api.ipify.org",
     "https://ifconfig.me/ip",
 ]
+_ip_check_rr = itertools.count()
 
 
-def get_proxy_ip(port: int) -> Optional[str]:
-    """Получить IP через прокси (socks5h). Пробует сервисы по очереди, останавливается на первом успешном.
-    Валидирует ответ — настоящий IP короткий и содержит точки, не HTML-страница ошибки."""
-    for url in IP_CHECK_URLS:
-        try:
-            r = subprocess.run(
-                ["curl", "-x", f"socks5h://127.0.0.1:{port}",
-                 "-m", "4", "--connect-timeout", "4",
-                 "-s", url],
-                capture_output=True, timeout=6,
-            )
-            ip = r.stdout.decode().strip()
-            if ip and len(ip) < 50 and "." in ip:
+def get_proxy_ip(port: int, cancel: Optional[ProbeCancel] = None) -> Optional[str]:
+    """
+    IP на выходе прокси (socks5h): сначала CFG.EGRESS_ECHO_URL, затем
+    IP_CHECK_URLS, начиная со следующего по кругу, — так нагрузка на
+    публичные сервисы делится между ними, а ограничивший нас сервис
+    не оставляет ключ без проверки.
+    """
+    start = next(_ip_check_rr)
+    urls = [IP_CHECK_URLS[(start + i) % len(IP_CHECK_URLS)] for i in range(len(IP_CHECK_URLS))]
+    if CFG.EGRESS_ECHO_URL:
+        urls.insert(0, CFG.EGRESS_ECHO_URL)
+    with _profiler.stage("probe:egress"):
+        for url in urls:
+            if cancel is not None and cancel.event.is_set():
+                break
+            _counters.inc("egress_checks")
+            ip = _egress_request(port, url, cancel)
+            if ip:
                 return ip
-        except:
-            continue
     return None
 
 
+def _egress_request(port: int, url: str, cancel: Optional[ProbeCancel]) -> Optional[str]:
+    if CFG.NATIVE_PROBE:
+        r = socks_http_request(port, url, read_body=True, timeout=4, connect_timeout=4,
+                               cancel=cancel)
+        return _parse_ip(r.body.decode("utf-8", "replace")) if r.status == 200 else None
+    try:
+        proc = subprocess.Popen(
+            ["curl", "-x", f"socks5h://127.0.0.1:{port}",
+             "-m", "4", "--connect-timeout", "4",
+             "-s", url],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        )
+        if cancel is not None and not cancel.register(proc):
+            proc.kill()
+        out, _ = proc.communicate(timeout=6)
+        return _parse_ip(out.decode("utf-8", "replace"))
+    except:
+        return None
+
+
 # ==================== БЕЗОПАСНОСТЬ ====================
 def quick_security_check(key: str) -> Tuple[bool, str]:
     for p in ("exec=","command=","shell=","javascript:","eval("):
@@ -729,6 +1535,10 @@ def quick_security_check(key: str) -> Tuple[bool, str]:
 
 
 # ==================== ОПРЕДЕЛЕНИЕ ТИПА КЛЮЧА ====================
+# Время успешной пробы (сек) по ключу — для кэша результатов
+_key_latency: Dict[str, float] = {}
+
+
 def _is_ru_cidr(ip: str) -> bool:
     return any(ip.startswith(p) for p in (
         "5.","31.","37.","46.","62.","77.","78.","79.","80.","81.","82.","83.",
@@ -749,113 +1559,765 @@ def _has_white_marker(key: str) -> bool:
                                    "россия","russia","mobile","cable","ru-"))
 
 
-def determine_key_type(key: str, port: int) -> Tuple[str, str]:
+def determine_key_type(key: str, port: int, ready: bool = False) -> Tuple[str, str]:
     """
     Определяет тип ключа (white/universal/none).
 
     Логика:
-    1. Проверка что SOCKS-порт открыт
-    2. Тест зарубежных заблокированных сайтов — если отвечают, туннель реальный
-    3. Тест российских сайтов — если отвечают, проверяем IP (трафик идёт через прокси?)
+    1. Проверка что SOCKS-порт открыт (пропускается, если ready — порт уже
+       проверен при старте Xray)
+    2. Зарубежные заблокированные и российские сайты пробуются параллельно;
+       ответил зарубежный — туннель реальный
+    3. Ответили только российские — проверяем IP (трафик идёт через прокси?)
     4. Если IP совпадает с реальным → "none" (трафик мимо прокси)
     5. Если ничего не отвечает → "none"
     """
-    if not check_socks_port(port):
+    if not ready and not check_socks_port(port):
         return "none", "порт не открыт"
 
-    # ── Тест зарубежных заблокированных сайтов ──
-    # Они заблокированы в РФ без VPN — если открылись, туннель 100% работает
-    for site in CFG.FOREIGN_TEST_SITES:
-        ok, t = curl_check(port, site)
-        if ok:
-            return "universal", f"Зарубеж OK ({t:.1f}s)"
+    # Зарубежные (заблокированы в РФ без VPN — если открылись, туннель 100%
+    # работает) и российские сайты пробуются одновременно через один порт.
+    # Решение — как только оно известно: любой зарубежный OK → universal;
+    # все зарубежные упали и хоть один российский OK → white. Остальные
+    # пробы отменяются, так что нерабочий ключ держит Xray один таймаут.
+    sites = ([(True, s) for s in CFG.FOREIGN_TEST_SITES] +
+             [(False, s) for s in CFG.RUSSIAN_TEST_SITES])
+    if not sites:
+        return "none", "ничего не отвечает"
+    cancel = ProbeCancel()
+    pool = _probe_executor()
+    futures = {pool.submit(probe_site, port, url, cancel): foreign for foreign, url in sites}
+    foreign_left = len(CFG.FOREIGN_TEST_SITES)
+    ru_hit: Optional[ProbeResult] = None
+    egress = None
+    proxy_ip = None
+    try:
+        for fut in as_completed(futures):
+            r = fut.result()
+            if futures[fut]:
+                if r.ok:
+                    _key_latency[key] = round(r.elapsed, 3)
+                    return "universal", f"Зарубеж OK ({format_timings(r)})"
+                foreign_left -= 1
+            elif r.ok and ru_hit is None:
+                ru_hit = r
+                # Российские сайты открываются и без VPN — IP на выходе
+                # запрашиваем сразу, пока досиживают зарубежные пробы
+                if _real_ip:
+                    egress = pool.submit(get_proxy_ip, port, cancel)
+            if ru_hit is not None and foreign_left == 0:
+                break
+        if egress is not None:
+            proxy_ip = egress.result()
+    finally:
+        cancel.cancel()
 
-    # ── Тест российских сайтов ──
-    # Они доступны без VPN, поэтому проверяем IP — реально ли трафик через прокси
-    for site in CFG.RUSSIAN_TEST_SITES:
-        ok, t = curl_check(port, site)
-        if ok:
-            global _real_ip
-            if _real_ip:
-                proxy_ip = get_proxy_ip(port)
-                if proxy_ip and proxy_ip == _real_ip:
-                    return "none", f"IP не изменился — трафик мимо прокси"
-            return "white", f"только РФ ({t:.1f}s)"
+    # ── Доступны только российские сайты ──
+    if ru_hit is not None:
+        if proxy_ip and proxy_ip == _real_ip:
+            return "none", f"IP не изменился — трафик мимо прокси"
+        _key_latency[key] = round(ru_hit.elapsed, 3)
+        return "white", f"только РФ ({format_timings(ru_hit)})"
 
     return "none", "ничего не отвечает"
 
 
+_probe_pool: Optional[ThreadPoolExecutor] = None
+_probe_pool_lock = threading.Lock()
+
+
+def _probe_executor() -> ThreadPoolExecutor:
+    """Общий пул для параллельных проб сайтов (потоки создаются по мере нужды)."""
+    global _probe_pool
+    with _probe_pool_lock:
+        if _probe_pool is None:
+            _probe_pool = ThreadPoolExecutor(max_workers=CFG.PROBE_WORKERS,
+                                             thread_name_prefix="probe")
+        return _probe_pool
+
+
 # ==================== ПРОВЕРКА ОДНОГО КЛЮЧА ====================
+# Сбои окружения, а не ключа: Xray не занял SOCKS-порт или не поднялся к дедлайну
+PORT_CONFLICT = (False, "Порт занят", None, "none", "", "")
+XRAY_SLOW = (False, "Xray не запустился", None, "none", "таймаут старта", "")
+
+# Время старта Xray (до готовности SOCKS) — последние запуски, для медианы в итоге
+_startup_times: deque = deque(maxlen=4096)
+
+
 def check_single_key(key: str, port: int) -> Tuple[bool, str, Optional[str], str, str, str]:
-    ok, msg = quick_security_check(key)
+    with _profiler.stage("security_check"):
+        ok, msg = quick_security_check(key)
     if not ok:
         return False, "Безопасность", None, "none", msg, ""
 
-    config = create_xray_config(key, port)
+    with _profiler.stage("config_build"):
+        config = xray_config_text(key, port)
     if not config:
         return False, "Ошибка парсинга", None, "none", "", ""
 
-    with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as f:
-        json.dump(config, f)
-        cfg_path = f.name
+    with _profiler.stage("config_write"):
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as f:
+            f.write(config)
+            cfg_path = f.name
 
     xray = XrayManager(cfg_path, port)
     try:
-        if not xray.start():
-            return False, "Xray не запустился", None, "none", "", ""
-        ktype, details = determine_key_type(key, port)
-        if ktype == "none":
-            return False, "Не работает", None, "none", details, ""
-        label = "Белый список" if ktype == "white" else "Универсальный"
-        country_code, country_flag = get_country_with_flag(key)
-        return True, label, key, ktype, details, country_flag
+        if xray.start():
+            _startup_times.append(xray.startup_time)
+            return _probe_key(key, port, ready=True)
     except Exception as e:
         return False, "Ошибка", None, "none", str(e)[:40], ""
     finally:
-        xray.stop()
-        try: os.unlink(cfg_path)
-        except: pass
+        with _profiler.stage("teardown"):
+            xray.stop()
+            try: os.unlink(cfg_path)
+            except: pass
+
+    # Процесс уже остановлен: занятый порт держит кто-то другой
+    if xray.slow:
+        return XRAY_SLOW
+    if _port_busy(port):
+        _counters.inc("xray_port_conflict")
+        return PORT_CONFLICT
+    return False, "Xray не запустился", None, "none", "", ""
+
+
+def _probe_key(key: str, port: int, ready: bool = False) -> Tuple[bool, str, Optional[str], str, str, str]:
+    """Проверка ключа через уже запущенный Xray на порту port."""
+    ktype, details = determine_key_type(key, port, ready)
+    if ktype == "none":
+        return False, "Не работает", None, "none", details, ""
+    label = "Белый список" if ktype == "white" else "Универсальный"
+    with _profiler.stage("geolocation"):
+        country_code, country_flag = get_country_with_flag(key)
+    return True, label, key, ktype, details, country_flag
+
+
+# ==================== ПАКЕТНЫЙ РЕЖИМ (ОДИН XRAY НА N КЛЮЧЕЙ) ====================
+def check_key_batch(keys: List[str]) -> List[Tuple[bool, str, Optional[str], str, str, str]]:
+    """
+    Проверяет пачку ключей через один процесс Xray (N SOCKS-inbound → N outbound).
+    Результаты в том же формате и порядке, что и у check_single_key.
+    """
+    results: List[Optional[tuple]] = [None] * len(keys)
+    items: List[Tuple[int, str, int, dict]] = []
+    for i, key in enumerate(keys):
+        with _profiler.stage("security_check"):
+            ok, msg = quick_security_check(key)
+        if not ok:
+            results[i] = (False, "Безопасность", None, "none", msg, "")
+            continue
+        port = alloc_port()
+        if port is None:
+            results[i] = PORT_CONFLICT
+            continue
+        with _profiler.stage("config_build"):
+            config = create_xray_config(key, port)
+        if not config:
+            results[i] = (False, "Ошибка парсинга", None, "none", "", "")
+            continue
+        items.append((i, key, port, config))
+
+    _check_batch_items(items, results)
+    return results
+
+
+def _rebind(item: Tuple[int, str, int, dict]) -> Optional[Tuple[int, str, int, dict]]:
+    """Тот же ключ пачки на новом порту (None — свободных портов нет)."""
+    i, key, _, config = item
+    port = alloc_port()
+    if port is None:
+        return None
+    return i, key, port, dict(config, inbounds=[dict(config["inbounds"][0], port=port)])
+
+
+def _check_batch_items(items: List[Tuple[int, str, int, dict]], results: list,
+                       rebinds: int = 2, slow_retries: int = 1) -> None:
+    """
+    Запускает Xray на всю пачку. Если Xray завершился (конфиг не загрузился) —
+    делим пачку пополам и проверяем половины отдельно, пока не останется
+    сломанный ключ. Ключи ни при чём и пачка не делится, если:
+    - не удалось занять порт (его держит чужой процесс) — перезапуск на новых
+      портах, а когда и это не помогло — PORT_CONFLICT;
+    - Xray не успел подняться к дедлайну (перегрузка) — ещё одна попытка
+      того же размера, затем XRAY_SLOW.
+    Оба — не вердикты, в кэш и историю не попадают.
+    """
+    if not items:
+        return
+
+    with _profiler.stage("config_write"):
+        with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as f:
+            json.dump(create_batch_config([c for _, _, _, c in items]), f)
+            cfg_path = f.name
+
+    xray = XrayManager(cfg_path, items[0][2], [port for _, _, port, _ in items])
+    started = False
+    try:
+        started = xray.start()
+        if started:
+            _startup_times.append(xray.startup_time)
+            with ThreadPoolExecutor(max_workers=len(items)) as ex:
+                futures = {ex.submit(_probe_key, key, port): i for i, key, port, _ in items}
+                for fut in as_completed(futures):
+                    try:
+                        results[futures[fut]] = fut.result()
+                    except Exception as e:
+                        results[futures[fut]] = (False, "Ошибка", None, "none", str(e)[:40], "")
+    finally:
+        with _profiler.stage("teardown"):
+            xray.stop()
+            try: os.unlink(cfg_path)
+            except: pass
+
+    if started:
+        return
+    if xray.slow:
+        if slow_retries <= 0:
+            for i, _, _, _ in items:
+                results[i] = XRAY_SLOW
+            return
+        _check_batch_items(items, results, rebinds, slow_retries - 1)
+        return
+    busy = {port for _, _, port, _ in items if _port_busy(port)}
+    if busy:
+        _counters.inc("xray_port_conflict")
+        if rebinds <= 0:
+            for i, _, _, _ in items:
+                results[i] = PORT_CONFLICT
+            return
+        moved = []
+        for it in items:
+            new = _rebind(it) if it[2] in busy else it
+            if new is None:
+                results[it[0]] = PORT_CONFLICT
+            else:
+                moved.append(new)
+        _check_batch_items(moved, results, rebinds - 1, slow_retries)
+        return
+    if len(items) == 1:
+        results[items[0][0]] = (False, "Xray не запустился", None, "none", "", "")
+        return
+    mid = len(items) // 2
+    _check_batch_items(items[:mid], results)
+    _check_batch_items(items[mid:], results)
 
 
 # ==================== ЗАГРУЗКА ПОДПИСКИ ====================
 PREFIXES = ("vless://","vmess://","trojan://","ss://","hysteria2://")
 
 
-def fetch_keys(url: str) -> List[str]:
+_http_session: Optional[requests.Session] = None
+_http_session_lock = threading.Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Общая сессия с пулом соединений на хост — для параллельной загрузки подписок."""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            _http_session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=CFG.FETCH_WORKERS,
+                                  pool_maxsize=CFG.FETCH_WORKERS)
+            _http_session.mount("https://", adapter)
+            _http_session.mount("http://", adapter)
+            _http_session.headers.update({
+                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) Chrome/123",
+                "Accept": "text/plain,*/*",
+            })
+        return _http_session
+
+
+def _fetch_cache_path(url: str) -> str:
+    return os.path.join(CFG.FETCH_CACHE_DIR,
+                        hashlib.sha256(url.encode("utf-8")).hexdigest()[:16] + ".json")
+
+
+_B64_CHARS = re.compile(rb"[A-Za-z0-9+/=\s]*")
+
+
+def iter_subscription_keys(chunks: Iterable[bytes], sniff: int = 65536) -> Iterator[str]:
+    """
+    Потоковый разбор подписки по кускам ответа: без копии всего текста в памяти.
+    По первым sniff байтам решаем: обычный текст или base64 целиком
+    (base64 декодируется по кратным 4 символам по мере поступления).
+    Битый base64 посреди потока — ValueError, а не молча урезанный список.
+    """
+    it = iter(chunks)
+    head = b""
+    for chunk in it:
+        head += chunk
+        if len(head) >= sniff:
+            break
+
+    stripped = head.lstrip()
+    is_b64 = (stripped and not any(stripped.startswith(p.encode()) for p in PREFIXES)
+              and _B64_CHARS.fullmatch(head[:sniff]) is not None)
+
+    def raw_pieces() -> Iterator[bytes]:
+        yield head
+        yield from it
+
+    def decoded_pieces() -> Iterator[bytes]:
+        # Битый base64 посреди ответа — ошибка, а не конец подписки:
+        # stream_keys засчитает её как оборванную загрузку
+        tail = b""
+        for piece in raw_pieces():
+            tail += b"".join(piece.split())
+            cut = len(tail) - len(tail) % 4
+            if cut:
+                try:
+                    yield base64.b64decode(tail[:cut])
+                except (ValueError, binascii.Error) as e:
+                    raise ValueError(f"битый base64: {e}") from e
+                tail = tail[cut:]
+        if tail:
+            try:
+                yield base64.b64decode(tail + b"=" * (-len(tail) % 4))
+            except (ValueError, binascii.Error) as e:
+                raise ValueError(f"битый base64: {e}") from e
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    buf = ""
+    for piece in (decoded_pieces() if is_b64 else raw_pieces()):
+        buf += decoder.decode(piece).replace("\r", "\n")
+        *lines, buf = buf.split("\n")
+        for line in lines:
+            line = line.strip()
+            if line.startswith(PREFIXES):
+                yield line
+    line = (buf + decoder.decode(b"", final=True)).strip()
+    if line.startswith(PREFIXES):
+        yield line
+
+
+# Длительность последней загрузки по источнику, сек (для /metrics)
+_fetch_durations: Dict[str, float] = {}
+
+
+def stream_keys(url: str) -> Iterator[str]:
+    """
+    Ключи подписки по мере скачивания (stream=True + iter_content).
+    Если в FETCH_CACHE_DIR есть прошлый ответ с ETag/Last-Modified,
+    запрос условный: на 304 отдаётся уже разобранный список ключей из кэша.
+    Повторы — только до начала ответа; обрыв посреди загрузки — ConnectionError
+    (уже отданные ключи остаются у потребителя, в кэш ответ не пишется).
+    """
+    source, t0 = url, time.time()
+    parsed = urlparse(url)
+    if parsed.netloc == "translate.yandex.ru":
+        orig = parse_qs(parsed.query).get("url",[None])[0]
+        if orig: url = unquote(orig)
+
+    cache_path = _fetch_cache_path(url) if CFG.FETCH_CACHE else None
+    cached = load_json(cache_path) if cache_path else {}
+    headers = {}
+    if cached.get("etag"):          headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified"): headers["If-Modified-Since"] = cached["last_modified"]
+
+    session = get_http_session()
+    resp = None
+    for attempt in range(3):
+        try:
+            resp = session.get(url, timeout=45, headers=headers, allow_redirects=True, stream=True)
+            if resp.status_code == 304 and "keys" in cached:
+                resp.close()
+                _counters.inc("fetch_not_modified")
+                yield from cached["keys"]
+                _fetch_durations[source] = time.time() - t0
+                return
+            resp.raise_for_status()
+            break
+        except Exception:
+            if resp is not None:
+                resp.close()
+                resp = None
+            if attempt == 2: return
+            time.sleep(1)
+
+    keys: List[str] = []
     try:
-        parsed = urlparse(url)
-        if parsed.netloc == "translate.yandex.ru":
-            orig = parse_qs(parsed.query).get("url",[None])[0]
-            if orig: url = unquote(orig)
-
-        headers = {"User-Agent": "Mozilla/5.0 (X11; Linux x86_64) Chrome/123",
-                   "Accept": "text/plain,*/*"}
-        for attempt in range(3):
+        for k in iter_subscription_keys(resp.iter_content(chunk_size=65536)):
+            keys.append(k)
+            yield k
+    except Exception as e:
+        _counters.inc("fetch_truncated")
+        raise ConnectionError(f"загрузка оборвалась после {len(keys)} ключей: {e}") from e
+    finally:
+        resp.close()
+
+    _counters.inc("fetch_downloaded")
+    _fetch_durations[source] = time.time() - t0
+    etag, modified = resp.headers.get("ETag"), resp.headers.get("Last-Modified")
+    if cache_path and (etag or modified):
+        save_json(cache_path, {"url": url, "etag": etag, "last_modified": modified,
+                               "keys": keys}, compact=True)
+
+
+def fetch_keys(url: str) -> List[str]:
+    """Все ключи подписки; оборванная загрузка повторяется один раз, затем — исключение."""
+    for attempt in range(2):
+        try:
+            return list(stream_keys(url))
+        except Exception:
+            if attempt == 1: raise
+            time.sleep(1)
+    return []
+
+
+def fetch_all(sources: List[str]) -> List[List[str]]:
+    """
+    Параллельная загрузка всех подписок; порядок результатов = порядок sources.
+    Подписка с оборванной загрузкой считается не ответившей (пустой список),
+    а не урезанной: демон сохранит её прежние ключи.
+    """
+    results: List[List[str]] = [[] for _ in sources]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(sources), CFG.FETCH_WORKERS))) as ex:
+        futures = {ex.submit(fetch_keys, url): i for i, url in enumerate(sources)}
+        for fut in as_completed(futures):
             try:
-                resp = requests.get(url, timeout=45, headers=headers, allow_redirects=True)
-                resp.raise_for_status()
-                break
-            except:
-                if attempt == 2: return []
-                time.sleep(1)
+                results[futures[fut]] = fut.result()
+            except Exception as e:
+                url = sources[futures[fut]]
+                short = url.rstrip("/").split("/")[-1][:45] or url[:45]
+                print(f"  ⚠️  {short}: {e}")
+    return results
+
+
+# ==================== ПУЛ ПРОЦЕССОВ: РАЗБОР КЛЮЧЕЙ ====================
+def _prepare_chunk(keys: List[str]) -> List[Tuple[str, Optional[str]]]:
+    """Один разбор на ключ: (canonical_key, outbound в JSON или None)."""
+    out = []
+    for k in keys:
+        outbound = parse_outbound(k)
+        text = json.dumps(outbound, separators=(",", ":")) if outbound else None
+        out.append((canonical_key(k), text))
+    return out
+
+
+def cpu_workers() -> int:
+    return CFG.CPU_WORKERS or os.cpu_count() or 1
+
+
+def _pool_context():
+    """
+    forkserver (или spawn): fork из процесса, где уже работают потоки
+    загрузки и DNS, может унаследовать захваченную ими блокировку.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+
+
+def prepare_keys(keys: List[str]) -> List[str]:
+    """
+    Разбор ключей (парсинг, canonical_key, outbound в JSON) пачками по
+    CPU_CHUNK в пуле процессов — без GIL, который делят потоки проверки.
+    Если пул не поднялся или упал — разбор в своём процессе.
+    Возвращает canonical_key по порядку; готовые outbound сохраняются
+    в _outbound_json для xray_config_text.
+    """
+    workers = cpu_workers()
+    chunks = [keys[i:i + CFG.CPU_CHUNK] for i in range(0, len(keys), CFG.CPU_CHUNK)]
+    results = None
+    if workers > 1 and len(keys) >= CFG.CPU_POOL_MIN_KEYS:
+        try:
+            with ProcessPoolExecutor(max_workers=min(workers, len(chunks)),
+                                     mp_context=_pool_context()) as ex:
+                results = list(ex.map(_prepare_chunk, chunks))
+        except (BrokenProcessPool, OSError) as e:
+            print(f"  ⚠️  Пул процессов недоступен ({type(e).__name__}) — разбор в одном процессе")
+    if results is None:
+        results = map(_prepare_chunk, chunks)
+    idents: List[str] = []
+    for chunk, prepared in zip(chunks, results):
+        for k, (ident, text) in zip(chunk, prepared):
+            idents.append(ident)
+            if text is not None:
+                _outbound_json[k] = text
+    return idents
+
+
+# ==================== DNS: ОБЩИЙ КЭШ РЕЗОЛВА ====================
+class DnsCache:
+    """
+    Потокобезопасный кэш host → IP с TTL и отрицательным кэшем (NXDOMAIN,
+    таймаут). Один на всех: геолокация, группировка серверов, имена стран.
+    Параллельные запросы одного хоста ждут первый, а не резолвят повторно.
+    """
 
-        content = resp.text.strip()
-        if not any(content.startswith(p) for p in PREFIXES):
+    def __init__(self, ttl: float, negative_ttl: float):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Tuple[Optional[str], float]] = {}
+        self._inflight: Dict[str, threading.Event] = {}
+
+    def cached(self, host: str) -> Tuple[bool, Optional[str]]:
+        """(есть ли свежая запись, IP или None для отрицательной)."""
+        with self._lock:
+            entry = self._entries.get(host)
+        if entry is not None and entry[1] > time.time():
+            return True, entry[0]
+        return False, None
+
+    @staticmethod
+    def _literal(host: str) -> bool:
+        try:
+            ipaddress.ip_address(host)
+            return True
+        except ValueError:
+            return False
+
+    def resolve(self, host: str) -> Optional[str]:
+        host = host.strip("[]").lower()
+        if self._literal(host):
+            return host
+        while True:
+            hit, ip = self.cached(host)
+            if hit:
+                return ip
+            with self._lock:
+                waiter = self._inflight.get(host)
+                if waiter is None:
+                    self._inflight[host] = threading.Event()
+                    break
+            waiter.wait(CFG.DNS_TIMEOUT)
+        try:
+            ip = socket.gethostbyname(host)
+        except (OSError, UnicodeError):
+            ip = None
+        self._store(host, ip)
+        return ip
+
+    def _store(self, host: str, ip: Optional[str]) -> None:
+        ttl = self.ttl if ip else self.negative_ttl
+        with self._lock:
+            self._entries[host] = (ip, time.time() + ttl)
+            waiter = self._inflight.pop(host, None)
+        if waiter is not None:
+            waiter.set()
+
+    def resolve_many(self, hosts: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Параллельный резолв различных хостов. Не успевшие за DNS_TIMEOUT
+        получают отрицательную запись — повторно их в этом прогоне не ждём.
+        """
+        hosts = {h.strip("[]").lower() for h in hosts if h}
+        todo = [h for h in hosts if not self._literal(h) and not self.cached(h)[0]]
+        if todo:
+            ex = ThreadPoolExecutor(max_workers=min(len(todo), CFG.DNS_WORKERS))
+            futures = {ex.submit(self.resolve, h): h for h in todo}
             try:
-                content += "=" * (4 - len(content) % 4)
-                content = base64.b64decode(content).decode("utf-8")
-            except: pass
+                for _ in as_completed(futures, timeout=CFG.DNS_TIMEOUT + len(todo) / CFG.DNS_WORKERS):
+                    pass
+            except FuturesTimeout:
+                for fut, h in futures.items():
+                    if not fut.done():
+                        self._store(h, None)
+            ex.shutdown(wait=False)
+        return {h: h if self._literal(h) else self.cached(h)[1] for h in hosts}
 
-        return [l.strip() for l in content.replace("\r\n","\n").replace("\r","\n").split("\n")
-                if l.strip() and any(l.strip().startswith(p) for p in PREFIXES)]
-    except:
-        return []
+
+_dns = DnsCache(CFG.DNS_TTL, CFG.DNS_NEGATIVE_TTL)
+
+
+def resolve_hosts(sub_data: List[Tuple[str, List[str]]]) -> None:
+    """Этап резолва: все различные хосты ключей заранее, до запуска Xray."""
+    hosts = {h for _, keys in sub_data for k in keys for h in [extract_host_from_key(k)] if h}
+    if not hosts:
+        return
+    t0 = time.time()
+    resolved = _dns.resolve_many(hosts)
+    failed = sum(1 for ip in resolved.values() if ip is None)
+    print(f"  🧭 DNS: {len(hosts)} хостов за {time.time() - t0:.1f}s | не резолвятся: {failed}")
+
+
+# ==================== ЛОКАЛЬНАЯ БАЗА IP → СТРАНА ====================
+class GeoIndex:
+    """
+    CIDR → страна из локального файла: отсортированный массив целочисленных
+    диапазонов (отдельно IPv4 и IPv6), поиск бинарный — O(log n).
+    Подсети либо вложены, либо не пересекаются, поэтому для каждого
+    диапазона хранится индекс охватывающего: после bisect поднимаемся
+    по родителям до первого, содержащего адрес (самая узкая подсеть).
+
+    Форматы: geoip.dat из Xray, CSV "сеть,страна", ip2location LITE
+    ("ip_from","ip_to","CC",...) и GeoLite2-Country-Blocks (коды стран
+    берутся из соседнего GeoLite2-Country-Locations-en.csv).
+    """
+
+    def __init__(self, ranges: Iterable[Tuple[int, int, int, str]] = ()):
+        by_family: Dict[int, List[Tuple[int, int, str]]] = {4: [], 6: []}
+        for family, start, end, cc in ranges:
+            by_family[family].append((start, end, cc))
+        self._tables = {family: self._build(rows) for family, rows in by_family.items()}
+        self.size = sum(len(rows) for rows in by_family.values())
+
+    @staticmethod
+    def _build(rows: List[Tuple[int, int, str]]) -> Tuple[List[int], List[int], List[str], List[int]]:
+        rows.sort(key=lambda r: (r[0], -r[1]))
+        starts = [r[0] for r in rows]
+        ends   = [r[1] for r in rows]
+        codes  = [r[2] for r in rows]
+        parents: List[int] = []
+        stack: List[int] = []
+        for i, (start, end, _) in enumerate(rows):
+            while stack and ends[stack[-1]] < start:
+                stack.pop()
+            parents.append(stack[-1] if stack else -1)
+            stack.append(i)
+        return starts, ends, codes, parents
+
+    def lookup(self, ip: str) -> Optional[str]:
+        try:
+            addr = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        starts, ends, codes, parents = self._tables[addr.version]
+        value = int(addr)
+        i = bisect.bisect_right(starts, value) - 1
+        while i >= 0:
+            if ends[i] >= value:
+                return codes[i]
+            i = parents[i]
+        return None
+
+    def lookup_many(self, ips: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Пакетный поиск: каждый адрес один раз."""
+        return {ip: self.lookup(ip) for ip in set(ips)}
+
+    @classmethod
+    def load(cls, path: str) -> "GeoIndex":
+        if path.endswith(".dat"):
+            return cls(_read_geoip_dat(path))
+        return cls(_read_geoip_csv(path))
+
+
+def _cidr_range(network: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        net = ipaddress.ip_network(network.strip(), strict=False)
+    except ValueError:
+        return None
+    return net.version, int(net.network_address), int(net.broadcast_address)
+
+
+def _read_geoip_csv(path: str) -> Iterator[Tuple[int, int, int, str]]:
+    geonames: Dict[str, str] = {}
+    locations = os.path.join(os.path.dirname(path), "GeoLite2-Country-Locations-en.csv")
+    if os.path.exists(locations):
+        with open(locations, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                if row.get("country_iso_code"):
+                    geonames[row["geoname_id"]] = row["country_iso_code"]
+
+    with open(path, encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            if len(row) < 2 or row[0].startswith("#"):
+                continue
+            if row[0].isdigit() and row[1].isdigit() and len(row) >= 3:
+                # ip2location: границы диапазона числами, IPv6-файлы — по длине числа
+                start, end = int(row[0]), int(row[1])
+                family = 4 if end < 2 ** 32 else 6
+                cc = row[2]
+            else:
+                span = _cidr_range(row[0])
+                if span is None:
+                    continue          # заголовок
+                family, start, end = span
+                cc = row[1]
+                if not (len(cc) == 2 and cc.isalpha()):
+                    cc = geonames.get(row[1]) or (geonames.get(row[2]) if len(row) > 2 else None)
+            if cc and len(cc) == 2 and cc != "-":
+                yield family, start, end, cc.upper()
+
+
+def _read_varint(buf: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        value |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _proto_fields(buf: bytes) -> Iterator[Tuple[int, object]]:
+    """Минимальный разбор protobuf: (номер поля, int | bytes)."""
+    pos = 0
+    while pos < len(buf):
+        tag, pos = _read_varint(buf, pos)
+        wire = tag & 7
+        if wire == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire == 2:
+            size, pos = _read_varint(buf, pos)
+            value, pos = buf[pos:pos + size], pos + size
+        elif wire == 5:
+            value, pos = buf[pos:pos + 4], pos + 4
+        elif wire == 1:
+            value, pos = buf[pos:pos + 8], pos + 8
+        else:
+            raise ValueError(f"wire type {wire}")
+        yield tag >> 3, value
+
+
+def _read_geoip_dat(path: str) -> Iterator[Tuple[int, int, int, str]]:
+    """
+    geoip.dat — GeoIPList{repeated GeoIP entry = 1},
+    GeoIP{country_code = 1, repeated CIDR cidr = 2}, CIDR{bytes ip = 1, prefix = 2}.
+    Служебные списки (private, cloudflare, ...) пропускаются.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    for field, entry in _proto_fields(data):
+        if field != 1:
+            continue
+        cc = ""
+        cidrs: List[bytes] = []
+        for sub, value in _proto_fields(entry):
+            if sub == 1:
+                cc = value.decode("ascii", "replace").upper()
+            elif sub == 2:
+                cidrs.append(value)
+        if len(cc) != 2:
+            continue
+        for raw in cidrs:
+            ip, prefix = b"", 0
+            for sub, value in _proto_fields(raw):
+                if sub == 1:
+                    ip = value
+                elif sub == 2:
+                    prefix = value
+            if len(ip) not in (4, 16):
+                continue
+            bits = len(ip) * 8
+            start = int.from_bytes(ip, "big") >> (bits - prefix) << (bits - prefix) if prefix else 0
+            yield (4 if len(ip) == 4 else 6), start, start | ((1 << (bits - prefix)) - 1), cc
+
+
+_geo_index: Optional[GeoIndex] = None
+
+
+def geoip_db_path() -> str:
+    """CFG.GEOIP_DB или geoip.dat рядом с бинарником Xray."""
+    return CFG.GEOIP_DB or os.path.join(os.path.dirname(CFG.XRAY_PATH), "geoip.dat")
+
+
+def load_geo_index(path: str) -> Optional[GeoIndex]:
+    global _geo_index
+    if not os.path.exists(path):
+        return None
+    try:
+        _geo_index = GeoIndex.load(path)
+    except Exception:
+        _geo_index = None
+    return _geo_index
 
 
 # ==================== ОПРЕДЕЛЕНИЕ СТРАНЫ ====================
 _ip_country_cache: Dict[str, str] = {}
-_host_ip_cache:    Dict[str, str] = {}
-_country_cache:    Dict[str, str] = {}
 
 COUNTRY_NAMES_RU = {
     "RU":"Россия","NL":"Нидерланды","DE":"Германия","US":"США","GB":"Великобритания",
@@ -903,41 +2365,22 @@ def get_country_code(host: str) -> Optional[str]:
     if not host:
         return None
 
-    if host in _host_ip_cache:
-        ip = _host_ip_cache[host]
-        if ip in _ip_country_cache:
-            return _ip_country_cache[ip]
-
-    try:
-        ipaddress.ip_address(host)
-        ip = host
-    except ValueError:
-        try:
-            ip = socket.gethostbyname(host)
-            _host_ip_cache[host] = ip
-        except:
-            return get_country_by_tld(host)
+    ip = _dns.resolve(host)
+    if ip is None:
+        return get_country_by_tld(host)
 
     if ip in _ip_country_cache:
         return _ip_country_cache[ip]
 
-    for country, ranges in IP_COUNTRY_RANGES.items():
-        if any(ip.startswith(prefix) for prefix in ranges):
-            _ip_country_cache[ip] = country
-            return country
-
-    try:
-        resp = requests.get(f"https://ipinfo.io/{ip}/json", timeout=3)
-        if resp.status_code == 200:
-            data = resp.json()
-            country = data.get("country","").upper()
-            if country and len(country) == 2:
-                _ip_country_cache[ip] = country
-                return country
-    except:
-        pass
-
-    return None
+    # Только локальные данные: сетевой запрос на каждый ключ сюда не попадает
+    if _geo_index is not None:
+        country = _geo_index.lookup(ip)
+    else:
+        country = next((c for c, ranges in IP_COUNTRY_RANGES.items()
+                        if any(ip.startswith(prefix) for prefix in ranges)), None)
+    if country:
+        _ip_country_cache[ip] = country
+    return country
 
 
 def get_country_with_flag(key: str) -> Tuple[str, str]:
@@ -963,19 +2406,123 @@ def get_country(key: str) -> str:
     try:
         host = extract_host_from_key(key)
         if not host: return ""
-        if host in _country_cache: return _country_cache[host]
-        ip = host
-        if not re.match(r"^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$", host):
-            ip = socket.gethostbyname(host)
-        resp = requests.get(f"https://ipinfo.io/{ip}/json", timeout=5)
-        code = resp.json().get("country","").upper()
-        name = COUNTRY_NAMES_RU.get(code, code)
-        _country_cache[host] = name
-        return name
+        ip = _dns.resolve(host)
+        if not ip: return ""
+        code = _ip_country_cache.get(ip)
+        if not code and _geo_index is not None:
+            code = _geo_index.lookup(ip)
+        if not code:
+            resp = requests.get(f"https://ipinfo.io/{ip}/json", timeout=5)
+            code = resp.json().get("country","").upper()
+        if code:
+            _ip_country_cache[ip] = code
+        return COUNTRY_NAMES_RU.get(code, code)
     except:
         return ""
 
 
+# ==================== ПАКЕТНОЕ ОПРЕДЕЛЕНИЕ СТРАН (СОХРАНЕНИЕ) ====================
+class RateLimiter:
+    """Не больше rate вызовов в секунду на все потоки (равномерные слоты)."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.time()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class GeoCache:
+    """IP → код страны из ipinfo.io между прогонами (GEO_CACHE_FILE)."""
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.data: Dict[str, dict] = load_json(file_path)
+        self._lock = threading.Lock()
+
+    def get(self, ip: str) -> Optional[str]:
+        with self._lock:
+            entry = self.data.get(ip)
+        if entry and time.time() - entry.get("time", 0) < CFG.GEO_CACHE_TTL_DAYS * 86400:
+            return entry.get("cc")
+        return None
+
+    def put(self, ip: str, cc: str) -> None:
+        with self._lock:
+            self.data[ip] = {"cc": cc, "time": time.time()}
+
+    def save(self) -> None:
+        cutoff = time.time() - CFG.GEO_CACHE_TTL_DAYS * 86400
+        with self._lock:
+            self.data = {ip: e for ip, e in self.data.items() if e.get("time", 0) >= cutoff}
+            data = dict(self.data)
+        save_json(self.file_path, data, compact=True)
+
+
+def _ipinfo_country(ip: str, limiter: RateLimiter) -> Optional[str]:
+    limiter.wait()
+    try:
+        resp = requests.get(f"https://ipinfo.io/{ip}/json", timeout=5)
+        if resp.status_code == 200:
+            code = resp.json().get("country", "").upper()
+            if len(code) == 2:
+                return code
+    except Exception:
+        pass
+    return None
+
+
+def batch_country_flags(keys: List[str], deadline: float) -> Dict[str, str]:
+    """
+    Метки стран ("🇳🇱NL") для ключей без результата из проверки — пачкой:
+    общий DNS-кэш, локальная база, кэш ipinfo с диска, и только остаток —
+    параллельные запросы к ipinfo.io с ограничением частоты. Что не успело
+    к deadline (time.time()), получает метку "UNKNOWN".
+    """
+    hosts = {k: extract_host_from_key(k) for k in keys}
+    ips = _dns.resolve_many(h for h in hosts.values() if h)
+    geo_cache = GeoCache(CFG.GEO_CACHE_FILE)
+
+    codes: Dict[str, Optional[str]] = {}
+    for ip in set(filter(None, ips.values())):
+        codes[ip] = (_ip_country_cache.get(ip) or geo_cache.get(ip)
+                     or (_geo_index.lookup(ip) if _geo_index is not None else None))
+
+    missing = [ip for ip, cc in codes.items() if not cc]
+    if missing and time.time() < deadline:
+        limiter = RateLimiter(CFG.GEO_RATE)
+        ex = ThreadPoolExecutor(max_workers=min(len(missing), CFG.GEO_WORKERS))
+        futures = {ex.submit(_ipinfo_country, ip, limiter): ip for ip in missing}
+        try:
+            for fut in as_completed(futures, timeout=max(0.0, deadline - time.time())):
+                cc = fut.result()
+                if cc:
+                    codes[futures[fut]] = cc
+                    geo_cache.put(futures[fut], cc)
+        except FuturesTimeout:
+            late = sum(1 for f in futures if not f.done())
+            print(f"   ⏱️  Дедлайн геолокации: {late} IP без страны → UNKNOWN")
+        ex.shutdown(wait=False, cancel_futures=True)
+        geo_cache.save()
+
+    flags: Dict[str, str] = {}
+    for k, host in hosts.items():
+        ip = ips.get(host.strip("[]").lower()) if host else None
+        code = (codes.get(ip) if ip else None) or (get_country_by_tld(host) if host else None)
+        if code:
+            flags[k] = f"{COUNTRY_FLAGS.get(code, '')}{code}"
+        else:
+            flags[k] = "UNKNOWN"
+    return flags
+
+
 # ==================== ИМЕНОВАНИЕ ====================
 _country_flags_cache: Dict[str, str] = {}
 
@@ -990,7 +2537,1044 @@ def rename_key(key: str, country_flag: str = "") -> str:
     return f"{base}#{label}"
 
 
+# ==================== КЭШ РЕЗУЛЬТАТОВ ====================
+def load_json(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ Ошибка чтения {path}: {e}")
+        return {}
+
+
+def save_json(path: str, data, compact: bool = False):
+    """Атомарная запись JSON: во временный файл рядом, затем os.replace."""
+    try:
+        dir_path = os.path.dirname(path) or "."
+        os.makedirs(dir_path, exist_ok=True)
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            if compact:
+                json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+            else:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"⚠️ Ошибка записи {path}: {e}")
+
+
+def save_text(path: str, text: str):
+    """Атомарная запись текста: раздающий сервер не увидит файл наполовину записанным."""
+    try:
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"⚠️ Ошибка записи {path}: {e}")
+
+
+def get_hash(key: str) -> str:
+    """Стабильный хэш ключа без имени (#...) — как в analytics.json."""
+    return hashlib.sha256(key.split("#")[0].encode("utf-8")).hexdigest()[:16]
+
+
+# Отказы, которые говорят о сервере ключа, а не о машине проверки. Остальные
+# (Xray не запустился, исключения, нехватка слотов/дескрипторов) — не вердикт:
+# их не кэшируем и не пишем в историю, иначе одна перегрузка «хоронит» рабочие ключи
+SERVER_FAIL_REASONS = ("Не работает", "Сервер недоступен")
+
+
+def is_verdict(result: Tuple[bool, str, Optional[str], str, str, str]) -> bool:
+    success, reason, wkey, ktype, details, country_flag = result
+    if success and wkey:
+        return True
+    return reason in SERVER_FAIL_REASONS and details != "порт не открыт"
+
+
+class ResultCache:
+    """
+    Последний результат проверки каждого ключа: {hash: {time, ok, type, latency, flag}}.
+    Свежие записи (моложе RESULT_TTL_OK_HOURS для рабочих и RESULT_TTL_FAIL_HOURS
+    для нерабочих) повторно не проверяются. read=False (--full) — прошлые
+    записи не используются, но новые результаты в кэш пишутся.
+    """
+
+    def __init__(self, file_path: str, read: bool = True):
+        self.file_path = file_path
+        self.read = read
+        self._lock = threading.Lock()
+        self.data: Dict[str, dict] = load_json(file_path)
+
+    def last(self, key: str) -> Optional[dict]:
+        """Последняя запись о ключе любой давности (None при read=False)."""
+        return self.data.get(get_hash(key)) if self.read else None
+
+    def get_fresh(self, key: str) -> Optional[dict]:
+        entry = self.last(key)
+        if not entry:
+            return None
+        ttl = CFG.RESULT_TTL_OK_HOURS if entry.get("ok") else CFG.RESULT_TTL_FAIL_HOURS
+        return entry if time.time() - entry.get("time", 0) < ttl * 3600 else None
+
+    def record(self, key: str, result: Tuple[bool, str, Optional[str], str, str, str]) -> None:
+        success, reason, wkey, ktype, details, country_flag = result
+        if not is_verdict(result):
+            return
+        entry = {"time": time.time(), "ok": bool(success and wkey), "type": ktype,
+                 "latency": _key_latency.get(key), "flag": country_flag}
+        with self._lock:
+            self.data[get_hash(key)] = entry
+
+    def save(self) -> None:
+        cutoff = time.time() - CFG.RESULT_CACHE_KEEP_DAYS * 86400
+        with self._lock:
+            self.data = {h: e for h, e in self.data.items() if e.get("time", 0) >= cutoff}
+            data = dict(self.data)
+        save_json(self.file_path, data, compact=True)
+
+
+_result_cache: Optional[ResultCache] = None
+
+
+def _apply_cached(
+    key: str,
+    entry: dict,
+    global_white: List[str],
+    global_universal: List[str],
+    stats: dict,
+) -> bool:
+    """Засчитать свежий результат из кэша в итог. True — ключ рабочий."""
+    if not entry["ok"]:
+        return False
+    if entry.get("flag"):
+        _country_flags_cache[key] = entry["flag"]
+    if entry.get("type") == "white":
+        global_white.append(key)
+        stats["white"] += 1
+    else:
+        global_universal.append(key)
+        stats["universal"] += 1
+    return True
+
+
+def split_cached(
+    sub_data: List[Tuple[str, List[str]]],
+    cache: ResultCache,
+    global_white: List[str],
+    global_universal: List[str],
+    stats: dict,
+) -> List[Tuple[str, List[str]]]:
+    """Свежие результаты из кэша сразу идут в итог, на проверку остаются только устаревшие."""
+    hit_ok = hit_fail = 0
+    remaining: List[Tuple[str, List[str]]] = []
+    for url, keys in sub_data:
+        stale = []
+        for k in keys:
+            entry = cache.get_fresh(k)
+            if entry is None:
+                stale.append(k)
+            elif _apply_cached(k, entry, global_white, global_universal, stats):
+                hit_ok += 1
+            else:
+                hit_fail += 1
+        if stale:
+            remaining.append((url, stale))
+    stats["cached"] = hit_ok + hit_fail
+    left = sum(len(keys) for _, keys in remaining)
+    print(f"  ♻️  Из кэша: {hit_ok} рабочих, {hit_fail} нерабочих пропущено | "
+          f"на проверку: {left}")
+    return remaining
+
+
+# ==================== ЖУРНАЛ ПРОГОНА (--resume) ====================
+class RunJournal:
+    """
+    Чекпоинты прогона: JSONL, по строке на проверенный ключ
+    {"h": хэш, "t": "white"/"universal"/"" , "k": ключ, "f": флаг}
+    (ключ и флаг — только у рабочих). Строки копятся в памяти и
+    дописываются на диск раз в CHECKPOINT_INTERVAL секунд (фоновым потоком —
+    и когда новых результатов долго нет), так что при убийстве процесса
+    теряется не больше одного интервала.
+    Успешный прогон удаляет журнал; --resume подхватывает оставшийся.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        self.path = path
+        self.done: Dict[str, dict] = self._read(path) if resume else {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._fh = open(path, "a" if resume else "w", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._pending: List[str] = []
+        self._last_flush = time.time()
+        self._closed = threading.Event()
+        threading.Thread(target=self._flush_loop, daemon=True, name="journal-flush").start()
+
+    def _flush_loop(self) -> None:
+        while not self._closed.wait(max(0.1, CFG.CHECKPOINT_INTERVAL)):
+            self.flush()
+
+    @staticmethod
+    def _read(path: str) -> Dict[str, dict]:
+        done: Dict[str, dict] = {}
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        done[entry["h"]] = entry
+                    except (ValueError, KeyError, TypeError):
+                        continue      # недописанная строка при убийстве
+        except OSError:
+            pass
+        return done
+
+    def record(self, key: str, result: Tuple[bool, str, Optional[str], str, str, str]) -> None:
+        success, reason, wkey, ktype, details, country_flag = result
+        entry = {"h": get_hash(key), "t": ktype if success and wkey else ""}
+        if entry["t"]:
+            entry["k"] = wkey
+            if country_flag:
+                entry["f"] = country_flag
+        with self._lock:
+            self._pending.append(json.dumps(entry, ensure_ascii=False, separators=(",", ":")))
+            due = time.time() - self._last_flush >= CFG.CHECKPOINT_INTERVAL
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            lines, self._pending = self._pending, []
+            self._last_flush = time.time()
+            if not lines or self._fh.closed:
+                return
+            self._fh.write("\n".join(lines) + "\n")
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def replay(self, key: str, global_white: List[str], global_universal: List[str],
+               stats: dict) -> bool:
+        """Ключ уже проверен в прерванном прогоне: засчитать и пропустить."""
+        entry = self.done.get(get_hash(key))
+        if entry is None:
+            return False
+        stats["resumed"] = stats.get("resumed", 0) + 1
+        if entry["t"]:
+            wkey = entry.get("k", key)
+            if entry.get("f"):
+                _country_flags_cache[wkey] = entry["f"]
+            (global_white if entry["t"] == "white" else global_universal).append(wkey)
+            stats[entry["t"]] += 1
+        return True
+
+    def close(self, remove: bool = False) -> None:
+        self._closed.set()
+        self.flush()
+        with self._lock:
+            self._fh.close()
+        if remove:
+            try: os.unlink(self.path)
+            except OSError: pass
+
+
+_journal: Optional[RunJournal] = None
+
+
+def split_journal(
+    sub_data: List[Tuple[str, List[str]]],
+    journal: RunJournal,
+    global_white: List[str],
+    global_universal: List[str],
+    stats: dict,
+) -> List[Tuple[str, List[str]]]:
+    """--resume: ключи из журнала прерванного прогона не проверяются повторно."""
+    remaining: List[Tuple[str, List[str]]] = []
+    for url, keys in sub_data:
+        left = [k for k in keys if not journal.replay(k, global_white, global_universal, stats)]
+        if left:
+            remaining.append((url, left))
+    print(f"  ⏯️  Продолжение: {stats.get('resumed', 0)} ключей из журнала "
+          f"({len(journal.done)} записей)")
+    return remaining
+
+
+# ==================== ИСТОРИЯ ПРОВЕРОК (SQLite) ====================
+class HistoryStore:
+    """
+    История проверок по хэшу ключа в SQLite вместо analytics.json:
+    добавление — O(1) (буфер + executemany), поиск — по индексу (hash, time).
+    При первом запуске импортирует существующий analytics.json.
+    """
+
+    def __init__(self, db_path: str, legacy_json: Optional[str] = None):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[str, float, int, Optional[int]]] = []
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS keys (
+                hash      TEXT PRIMARY KEY,
+                created   REAL NOT NULL,
+                last_seen REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS checks (
+                hash    TEXT NOT NULL,
+                time    REAL NOT NULL,
+                success INTEGER NOT NULL,
+                latency INTEGER
+            );
+            CREATE INDEX IF NOT EXISTS checks_hash_time ON checks (hash, time);
+            CREATE TABLE IF NOT EXISTS sources (
+                url     TEXT PRIMARY KEY,
+                keys    INTEGER NOT NULL,
+                working INTEGER NOT NULL,
+                updated REAL NOT NULL
+            );
+        """)
+        # Вес проверки по давности: exp(-возраст / τ), τ из периода полураспада
+        self.db.create_function("decay", 2, lambda age, tau: math.exp(-max(age, 0.0) / tau),
+                                deterministic=True)
+        if legacy_json and os.path.exists(legacy_json):
+            empty = self.db.execute("SELECT 1 FROM keys LIMIT 1").fetchone() is None
+            if empty:
+                self.import_json(legacy_json)
+
+    def import_json(self, path: str) -> int:
+        """Импорт analytics.json формата {hash: {created, checks: [...]}}."""
+        data = load_json(path)
+        now = time.time()
+        with self._lock, self.db:
+            for h, entry in data.items():
+                checks = entry.get("checks", [])
+                last = max((c.get("time", 0) for c in checks), default=entry.get("created", now))
+                self.db.execute("INSERT OR IGNORE INTO keys VALUES (?, ?, ?)",
+                                (h, entry.get("created", now), last))
+                self.db.executemany(
+                    "INSERT INTO checks VALUES (?, ?, ?, ?)",
+                    [(h, c.get("time", 0), int(bool(c.get("success"))), c.get("latency"))
+                     for c in checks])
+        return len(data)
+
+    def touch(self, hashes: List[str]) -> None:
+        """Отметить ключи как встреченные в источниках сейчас."""
+        now = time.time()
+        with self._lock, self.db:
+            self.db.executemany(
+                "INSERT INTO keys VALUES (?, ?, ?) "
+                "ON CONFLICT(hash) DO UPDATE SET last_seen = excluded.last_seen",
+                [(h, now, now) for h in hashes])
+
+    def append(self, key_hash: str, success: bool, latency: Optional[int] = None) -> None:
+        with self._lock:
+            self._pending.append((key_hash, time.time(), int(success), latency))
+            if len(self._pending) < 500:
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+            if not pending:
+                return
+            with self.db:
+                self.db.executemany(
+                    "INSERT INTO keys VALUES (?, ?, ?) "
+                    "ON CONFLICT(hash) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)",
+                    [(h, t, t) for h, t, _, _ in pending])
+                self.db.executemany("INSERT INTO checks VALUES (?, ?, ?, ?)", pending)
+
+    def get_checks(self, key_hash: str, limit: int = 50) -> List[dict]:
+        self.flush()
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT time, success, latency FROM checks WHERE hash = ? "
+                "ORDER BY time DESC LIMIT ?", (key_hash, limit)).fetchall()
+        return [{"time": t, "success": bool(s), "latency": l} for t, s, l in reversed(rows)]
+
+    def key_stats(self, hashes: Iterable[str], half_life_hours: float) -> Dict[str, dict]:
+        """
+        Сводка по ключам с историей: {хэш: {"n", "ok", "w", "w_ok", "latency"}},
+        где w / w_ok — число проверок / успехов с весом по давности,
+        latency — средняя задержка успешных проверок (мс) или None.
+        """
+        self.flush()
+        hashes = list(set(hashes))
+        tau = half_life_hours * 3600 / math.log(2)
+        now = time.time()
+        out: Dict[str, dict] = {}
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                rows = self.db.execute(
+                    "SELECT hash, COUNT(*), SUM(success), SUM(decay(? - time, ?)), "
+                    "SUM(success * decay(? - time, ?)), AVG(CASE WHEN success THEN latency END) "
+                    f"FROM checks WHERE hash IN ({','.join('?' * len(chunk))}) GROUP BY hash",
+                    [now, tau, now, tau] + chunk)
+                for h, n, ok, w, w_ok, latency in rows:
+                    out[h] = {"n": n, "ok": ok or 0, "w": w or 0.0, "w_ok": w_ok or 0.0,
+                              "latency": latency}
+        return out
+
+    def record_sources(self, yields: Dict[str, Tuple[int, int]]) -> None:
+        """Итог прогона по источникам: {url: (уникальных ключей, рабочих)}."""
+        now = time.time()
+        with self._lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)",
+                [(url, n, ok, now) for url, (n, ok) in yields.items()])
+
+    def source_ratios(self) -> Dict[str, float]:
+        """Доля рабочих ключей источника в последнем полном прогоне (сглаженная)."""
+        with self._lock:
+            rows = self.db.execute("SELECT url, keys, working FROM sources").fetchall()
+        return {url: (ok + 1) / (n + 2) for url, n, ok in rows}
+
+    def compact(self, keep_checks: int, keep_days: float) -> Tuple[int, int]:
+        """Оставить keep_checks последних проверок на ключ и удалить ключи,
+        не встречавшиеся в источниках keep_days дней. Возвращает (ключей, проверок) удалено."""
+        self.flush()
+        cutoff = time.time() - keep_days * 86400
+        with self._lock, self.db:
+            dropped_keys = self.db.execute(
+                "DELETE FROM keys WHERE last_seen < ?", (cutoff,)).rowcount
+            dropped_checks = self.db.execute(
+                "DELETE FROM checks WHERE hash NOT IN (SELECT hash FROM keys)").rowcount
+            dropped_checks += self.db.execute("""
+                DELETE FROM checks WHERE rowid IN (
+                    SELECT rowid FROM (
+                        SELECT rowid, ROW_NUMBER() OVER (
+                            PARTITION BY hash ORDER BY time DESC) AS rn
+                        FROM checks)
+                    WHERE rn > ?)""", (keep_checks,)).rowcount
+        return dropped_keys, dropped_checks
+
+    def export_json(self, path: str) -> int:
+        """Выгрузка в прежний формат analytics.json."""
+        self.flush()
+        out: Dict[str, dict] = {}
+        with self._lock:
+            for h, created in self.db.execute("SELECT hash, created FROM keys ORDER BY created"):
+                out[h] = {"created": created, "checks": []}
+            for h, t, s, l in self.db.execute(
+                    "SELECT hash, time, success, latency FROM checks ORDER BY hash, time"):
+                if h in out:
+                    out[h]["checks"].append({"time": t, "success": bool(s), "latency": l})
+        save_json(path, out)
+        return len(out)
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            self.db.close()
+
+
+_history: Optional[HistoryStore] = None
+
+
+# ==================== ПРЕДПРОВЕРКА СЕРВЕРОВ (host:port) ====================
+def extract_endpoint(key: str) -> Optional[Tuple[str, int]]:
+    """(адрес, порт) сервера из outbound ключа."""
+    outbound = parse_outbound(key)
+    if not outbound:
+        return None
+    settings = outbound.get("settings", {})
+    servers = settings.get("vnext") or settings.get("servers") or []
+    if not servers:
+        return None
+    host = str(servers[0].get("address", "")).strip("[]").lower()
+    try:
+        return (host, int(servers[0].get("port"))) if host else None
+    except (TypeError, ValueError):
+        return None
+
+
+def resolved_endpoint(key: str) -> Optional[Tuple[str, int]]:
+    """extract_endpoint с IP из общего DNS-кэша: разные имена одного сервера — одна группа."""
+    ep = extract_endpoint(key)
+    if not ep:
+        return None
+    return (_dns.resolve(ep[0]) or ep[0], ep[1])
+
+
+DEAD_ENDPOINT_RESULT = (False, "Сервер недоступен", None, "none", "TCP не отвечает", "")
+
+
+def endpoint_sni(key: str) -> str:
+    """SNI для TLS-предпроверки (ENDPOINT_PROBE_TLS); "" — ключ без TLS/Reality или проверка выключена."""
+    if not CFG.ENDPOINT_PROBE_TLS:
+        return ""
+    outbound = parse_outbound(key) or {}
+    stream = outbound.get("streamSettings", {})
+    if stream.get("security") not in ("tls", "reality"):
+        return ""
+    ts = stream.get("realitySettings") or stream.get("tlsSettings") or {}
+    sni = ts.get("serverName") or (extract_endpoint(key) or ("", 0))[0]
+    try:
+        ipaddress.ip_address(sni)
+        return ""                 # SNI не бывает IP-адресом
+    except ValueError:
+        return sni
+
+
+def _probe_tls(sock: socket.socket, sni: str) -> None:
+    """ClientHello с SNI; любой ответ сервера (даже alert) — жив. Молчание — socket.timeout."""
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    try:
+        ctx.wrap_socket(sock, server_hostname=sni).close()
+    except ssl.SSLError:
+        pass
+
+
+def probe_endpoint(host: str, port: int, sni: str = "") -> bool:
+    """
+    Дешёвая проверка доступности: TCP connect (повтор при таймауте), с sni —
+    ещё и TLS ClientHello: сервер, который принял TCP, но молчит на
+    рукопожатие, тоже мёртв.
+    Мёртвым сервер считается только по отказу (ECONNREFUSED) или таймауту.
+    Прочие ошибки — локальные (EMFILE, нет маршрута у раннера, DNS) или
+    сброс на ClientHello: это «неизвестно», ключ проверяется обычным путём.
+    """
+    for attempt in range(CFG.ENDPOINT_PROBE_ATTEMPTS):
+        try:
+            with socket.create_connection((host, port), timeout=CFG.ENDPOINT_PROBE_TIMEOUT) as sock:
+                if sni:
+                    _probe_tls(sock, sni)
+                return True
+        except socket.timeout:
+            continue
+        except ConnectionRefusedError:
+            return False
+        except OSError:
+            _counters.inc("endpoint_probe_unknown")
+            return True
+    return False
+
+
+def filter_dead_endpoints(
+    sub_data: List[Tuple[str, List[str]]],
+    stats: dict,
+) -> List[Tuple[str, List[str]]]:
+    """
+    Группирует ключи по IP:port (имена — через общий DNS-кэш) и один раз
+    проверяет каждый сервер.
+    Ключи на недоступных серверах сразу считаются нерабочими — без Xray.
+    hysteria2 работает по UDP, его TCP-проверкой не отсеиваем.
+    С ENDPOINT_PROBE_TLS группа — IP:port:SNI.
+    """
+    groups: Dict[Tuple[str, int, str], List[str]] = defaultdict(list)
+    for _, keys in sub_data:
+        for k in keys:
+            if k.startswith("hysteria2://"):
+                continue
+            ep = resolved_endpoint(k)
+            if ep:
+                groups[ep + (endpoint_sni(k),)].append(k)
+    if not groups:
+        return sub_data
+
+    t0 = time.time()
+    alive: Dict[Tuple[str, int, str], bool] = {}
+    with ThreadPoolExecutor(max_workers=min(len(groups), CFG.ENDPOINT_PROBE_WORKERS)) as ex:
+        futures = {ex.submit(probe_endpoint, *ep): ep for ep in groups}
+        for fut in as_completed(futures):
+            try:
+                alive[futures[fut]] = fut.result()
+            except Exception:
+                alive[futures[fut]] = True
+
+    dead_keys = {k for ep, keys in groups.items() if not alive.get(ep, True) for k in keys}
+    for k in dead_keys:
+        _remember_result(k, DEAD_ENDPOINT_RESULT)
+    _failures.inc(DEAD_ENDPOINT_RESULT[1], len(dead_keys))
+    stats["failed"] += len(dead_keys)
+    stats["dead_endpoint"] = len(dead_keys)
+
+    dead_eps = sum(1 for ok in alive.values() if not ok)
+    print(f"  🔌 Серверов: {len(groups)} | недоступно: {dead_eps} "
+          f"→ {len(dead_keys)} ключей отсеяно без Xray ({time.time() - t0:.1f}s)")
+
+    remaining = []
+    for url, keys in sub_data:
+        live = [k for k in keys if k not in dead_keys]
+        if live:
+            remaining.append((url, live))
+    return remaining
+
+
+class EndpointGate:
+    """
+    Ленивая версия filter_dead_endpoints для потокового режима: ключи
+    приходят по одному, поэтому каждый host:port проверяется при первой
+    встрече и результат запоминается. Оборачивает функцию проверки единицы.
+    """
+
+    def __init__(self, check_fn: Callable[[List[str]], list]):
+        self.check_fn = check_fn
+        self._alive: Dict[Tuple[str, int, str], bool] = {}
+        self._lock = threading.Lock()
+        self.dead_keys = 0
+
+    def alive(self, key: str) -> bool:
+        if key.startswith("hysteria2://"):
+            return True
+        ep = resolved_endpoint(key)
+        if not ep:
+            return True
+        ep += (endpoint_sni(key),)
+        with self._lock:
+            known = self._alive.get(ep)
+        if known is None:
+            try:
+                known = probe_endpoint(*ep)
+            except Exception:
+                known = True
+            with self._lock:
+                self._alive[ep] = known
+        return known
+
+    def __call__(self, unit: List[str]) -> List[Tuple[bool, str, Optional[str], str, str, str]]:
+        live = [k for k in unit if self.alive(k)]
+        checked = iter(self.check_fn(live) if live else [])
+        results = []
+        for k in unit:
+            if k in live:
+                results.append(next(checked))
+            else:
+                with self._lock:
+                    self.dead_keys += 1
+                results.append(DEAD_ENDPOINT_RESULT)
+        return results
+
+
+# stats дополняют и поток-поставщик stream_feed (журнал, кэш), и цикл async-движка
+_stats_lock = threading.Lock()
+
+
+def stream_feed(
+    sources: List[str],
+    max_keys: int,
+    global_white: List[str],
+    global_universal: List[str],
+    stats: dict,
+    stop_event: threading.Event,
+    origins: Dict[str, str],
+) -> Iterator[Tuple[str, Iterator[str]]]:
+    """
+    Потоковый источник для run_async_engine: подписки скачиваются
+    параллельно (окно FETCH_WORKERS), ключи отдаются по мере разбора —
+    с дедупликацией, лимитом max_keys и кэшем результатов на лету.
+    """
+    seen: set = set()
+    budget = [max_keys]
+    window = max(1, CFG.FETCH_WORKERS)
+    pipes: List[queue.Queue] = [queue.Queue(maxsize=10000) for _ in sources]
+
+    def put(pipe: queue.Queue, item) -> bool:
+        # Потребитель может так и не дойти до этой подписки (стоп, лимит ключей)
+        while not stop_event.is_set() and budget[0] > 0:
+            try:
+                pipe.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def pump(url: str, pipe: queue.Queue) -> None:
+        try:
+            for k in stream_keys(url):
+                if not put(pipe, k):
+                    break
+        except Exception as e:
+            # Уже отданные ключи проверяются; повторить загрузку нельзя — они в работе
+            short = url.rstrip("/").split("/")[-1][:45] or url[:45]
+            print(f"  ⚠️  {short}: {e}")
+        finally:
+            put(pipe, None)
+
+    def keys_of(url: str, pipe: queue.Queue) -> Iterator[str]:
+        raw = uniq = 0
+        hashes: List[str] = []
+        while not stop_event.is_set():
+            try:
+                k = pipe.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if k is None or budget[0] <= 0:
+                break
+            raw += 1
+            ident = canonical_key(k)
+            if ident in seen:
+                continue
+            seen.add(ident)
+            uniq += 1
+            budget[0] -= 1
+            hashes.append(get_hash(k))
+            origins[k] = url
+            with _stats_lock:
+                if _journal is not None and _journal.replay(k, global_white, global_universal, stats):
+                    continue
+                entry = _result_cache.get_fresh(k) if _result_cache is not None else None
+                if entry is not None:
+                    stats["cached"] += 1
+                    _apply_cached(k, entry, global_white, global_universal, stats)
+                    continue
+            yield k
+        if _history is not None:
+            _history.touch(hashes)
+        short = url.rstrip("/").split("/")[-1][:45] or url[:45]
+        dups = raw - uniq
+        print(f"  ⬇️  {uniq:>6} ключей  {short}" + (f"  (дублей: {dups})" if dups else ""))
+
+    ex = ThreadPoolExecutor(max_workers=window)
+    try:
+        for url, pipe in zip(sources, pipes):
+            ex.submit(pump, url, pipe)
+        for url, pipe in zip(sources, pipes):
+            if stop_event.is_set() or budget[0] <= 0:
+                break
+            yield url, keys_of(url, pipe)
+    finally:
+        budget[0] = 0
+        ex.shutdown(wait=False, cancel_futures=True)
+
+
+# ==================== ПРИОРИТЕТЫ: ИСТОРИЯ КЛЮЧЕЙ И ИСТОЧНИКОВ ====================
+@dataclass
+class Priorities:
+    chance:  Dict[str, float]   # вероятность, что ключ рабочий
+    score:   Dict[str, float]   # порядок в очереди: chance с поправкой на задержку
+    sources: Dict[str, float]   # доля рабочих ключей источника
+
+
+def score_keys(
+    sub_data: List[Tuple[str, List[str]]],
+    history: "HistoryStore",
+    source_ratios: Dict[str, float],
+) -> Priorities:
+    """
+    Оценка ключей по истории. chance — доля успехов с весом по давности
+    (период полураспада SCORE_HALF_LIFE_HOURS), сглаженная к выходу
+    источника: у нового ключа это и есть выход источника. Выход источника —
+    доля рабочих в его последнем полном прогоне, без неё — по истории его
+    ключей, без истории вовсе — общий уровень. score дополнительно штрафует
+    медленные ключи (средняя задержка успешных проверок).
+    """
+    stats = history.key_stats((get_hash(k) for _, keys in sub_data for k in keys),
+                              CFG.SCORE_HALF_LIFE_HOURS)
+    total_w = sum(st["w"] for st in stats.values())
+    total_ok = sum(st["w_ok"] for st in stats.values())
+    global_rate = (total_ok + 1) / (total_w + 2)
+
+    prio = Priorities({}, {}, {})
+    for url, keys in sub_data:
+        src = [stats[get_hash(k)] for k in keys if get_hash(k) in stats]
+        if url in source_ratios:
+            prior = source_ratios[url]
+        else:
+            prior = (sum(st["w_ok"] for st in src) + 2 * global_rate) / (sum(st["w"] for st in src) + 2)
+        prio.sources[url] = prior
+        for k in keys:
+            st = stats.get(get_hash(k))
+            if st is None:
+                chance = prior
+                latency = None
+            else:
+                chance = (st["w_ok"] + 2 * prior) / (st["w"] + 2)
+                latency = st["latency"]
+            prio.chance[k] = chance
+            slow = min(latency / CFG.SCORE_LATENCY_REF_MS, 1.0) if latency else 0.0
+            prio.score[k] = chance * (1 - CFG.SCORE_LATENCY_WEIGHT * slow)
+    return prio
+
+
+def order_by_priority(
+    sub_data: List[Tuple[str, List[str]]],
+    prio: Priorities,
+) -> List[Tuple[str, List[str]]]:
+    """Подписки — по выходу источника, ключи внутри — по score."""
+    ordered = [(url, sorted(keys, key=lambda k: prio.score.get(k, 0.0), reverse=True))
+               for url, keys in sub_data]
+    ordered.sort(key=lambda x: prio.sources.get(x[0], 0.0), reverse=True)
+    return ordered
+
+
+def order_by_value(
+    sub_data: List[Tuple[str, List[str]]],
+    prio: Priorities,
+) -> List[Tuple[str, List[str]]]:
+    """Все ключи одной очередью по убыванию score, а не по подпискам (--time-budget)."""
+    keys = sorted((k for _, ks in sub_data for k in ks), key=lambda k: prio.score.get(k, 0.0),
+                  reverse=True)
+    return [("по приоритету", keys)] if keys else []
+
+
+def order_sources(sources: List[str], ratios: Dict[str, float]) -> List[str]:
+    """Порядок загрузки для --stream: ключей ещё нет, только выход источников."""
+    default = sum(ratios.values()) / len(ratios) if ratios else 0.0
+    return sorted(sources, key=lambda u: ratios.get(u, default), reverse=True)
+
+
+def source_yields(
+    origins: Dict[str, str],
+    working: Iterable[str],
+) -> Dict[str, Tuple[int, int]]:
+    """{url: (уникальных ключей, рабочих)} по карте ключ → источник."""
+    yields: Dict[str, List[int]] = defaultdict(lambda: [0, 0])
+    for url in origins.values():
+        yields[url][0] += 1
+    for k in working:
+        if k in origins:
+            yields[origins[k]][1] += 1
+    return {url: (n, ok) for url, (n, ok) in yields.items()}
+
+
+# ==================== ПЛАНИРОВЩИК ПО БЮДЖЕТУ ВРЕМЕНИ ====================
+class DeadlineWatch(threading.Thread):
+    """
+    Следит за бюджетом времени (--time-budget): раз в минуту печатает
+    текущую скорость и прогноз, сколько ключей успеем, и выставляет
+    stop_event в stop_at — чтобы незавершённые проверки успели дойти
+    (TOTAL_TIMEOUT), а сохранение и коммит уложились в SAVE_RESERVE_MIN.
+    """
+
+    def __init__(self, stop_at: float, stop_event: threading.Event, total: int):
+        super().__init__(daemon=True, name="deadline-watch")
+        self.stop_at = stop_at
+        self.stop_event = stop_event
+        self.total = total
+
+    def run(self) -> None:
+        t0 = time.time()
+        base = _counters.snapshot().get("checked", 0)
+        last_report = t0
+        while not self.stop_event.wait(min(5.0, max(0.1, self.stop_at - time.time()))):
+            now = time.time()
+            if now >= self.stop_at:
+                print(f"\n   ⏰ Бюджет времени исчерпан — останавливаю проверку, "
+                      f"оставляю время на сохранение")
+                self.stop_event.set()
+                return
+            if now - last_report >= 60:
+                last_report = now
+                done = _counters.snapshot().get("checked", 0) - base
+                rate = done / (now - t0)
+                can = int(rate * (self.stop_at - now))
+                forecast = f"успеем ещё ~{can}"
+                if self.total:      # в потоковом режиме общее число заранее неизвестно
+                    left = max(0, self.total - done)
+                    forecast = f"успеем ~{min(left, can)} из {left}"
+                print(f"   ⏳ Бюджет: {(self.stop_at - now) / 60:.0f} мин до остановки | "
+                      f"{rate * 60:.0f} ключ/мин → {forecast}")
+
+
+# ==================== МЕТРИКИ PROMETHEUS ====================
+def _prom_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class MetricsServer:
+    """
+    HTTP-эндпоинт /metrics в текстовом формате Prometheus (--metrics-port).
+    Значения берутся из _counters/_failures, лимитера, _fetch_durations и
+    гистограмм этапов _profiler (при метриках он включён всегда).
+    Скорость — по окну METRICS_WINDOW: фоновый поток раз в 5 с
+    запоминает число проверенных ключей.
+    """
+
+    def __init__(self, host: str, port: int):
+        self.t_start = time.time()
+        self._samples: deque = deque()
+        self._lock = threading.Lock()
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                try:
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def start(self) -> None:
+        threading.Thread(target=self.httpd.serve_forever, daemon=True, name="metrics").start()
+        threading.Thread(target=self._sample, daemon=True, name="metrics-sampler").start()
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _sample(self) -> None:
+        while True:
+            now = time.time()
+            with self._lock:
+                self._samples.append((now, _counters.snapshot().get("checked", 0)))
+                while self._samples and now - self._samples[0][0] > CFG.METRICS_WINDOW:
+                    self._samples.popleft()
+            time.sleep(5.0)
+
+    def throughput(self) -> float:
+        """Ключей в минуту за последние METRICS_WINDOW секунд."""
+        now, checked = time.time(), _counters.snapshot().get("checked", 0)
+        with self._lock:
+            t0, c0 = self._samples[0] if self._samples else (self.t_start, 0)
+        return (checked - c0) / (now - t0) * 60 if now > t0 else 0.0
+
+    def render(self) -> str:
+        counts = _counters.snapshot()
+        lines: List[str] = []
+
+        def metric(name: str, kind: str, help_text: str, samples: Iterable[Tuple[str, float]]):
+            lines.append(f"# HELP vpn_checker_{name} {help_text}")
+            lines.append(f"# TYPE vpn_checker_{name} {kind}")
+            for labels, value in samples:
+                lines.append(f"vpn_checker_{name}{labels} {value:g}")
+
+        metric("keys_checked_total", "counter", "Проверено ключей",
+               [("", counts.get("checked", 0))])
+        metric("keys_ok_total", "counter", "Рабочих ключей по типу",
+               [(f'{{type="{t}"}}', counts.get(f"ok_{t}", 0)) for t in ("white", "universal")])
+        metric("keys_failed_total", "counter", "Нерабочих ключей по причине (с отсеянными предпроверкой)",
+               [(f'{{reason="{_prom_label(r)}"}}', n)
+                for r, n in sorted(_failures.snapshot().items())])
+        metric("xray_running", "gauge", "Запущено процессов Xray",
+               [("", counts.get("xray_running", 0))])
+        metric("slots_in_use", "gauge", "Единиц проверки в работе",
+               [("", counts.get("units_in_flight", 0))])
+        limit = (_global_semaphore.limit if isinstance(_global_semaphore, AdaptiveLimiter)
+                 else limiter_capacity())
+        metric("slots_limit", "gauge", "Текущий лимит одновременных проверок", [("", limit)])
+        metric("throughput_keys_per_minute", "gauge",
+               f"Скорость проверки за последние {CFG.METRICS_WINDOW:.0f}s",
+               [("", round(self.throughput(), 2))])
+        metric("fetch_duration_seconds", "gauge", "Длительность последней загрузки подписки",
+               [(f'{{source="{_prom_label(u)}"}}', round(d, 3))
+                for u, d in sorted(_fetch_durations.items())])
+        metric("events_total", "counter", "Счётчики событий прогона",
+               [(f'{{event="{_prom_label(e)}"}}', n) for e, n in sorted(counts.items())
+                if e not in ("xray_running", "units_in_flight") and not e.startswith("ok_")])
+        metric("uptime_seconds", "gauge", "Время работы",
+               [("", round(time.time() - self.t_start, 1))])
+
+        lines.append("# HELP vpn_checker_stage_seconds Длительность этапов проверки")
+        lines.append("# TYPE vpn_checker_stage_seconds histogram")
+        for stage, r in sorted(_profiler.summary().items()):
+            label = _prom_label(stage)
+            acc = 0
+            for b in range(_profiler.BUCKETS - 1):
+                bound = _profiler._bound_ms(b)
+                acc += r["histogram_ms"].get(f"{bound:g}", 0)
+                lines.append(f'vpn_checker_stage_seconds_bucket{{stage="{label}",'
+                             f'le="{bound / 1000:g}"}} {acc}')
+            acc += r["histogram_ms"].get(f"{_profiler._bound_ms(_profiler.BUCKETS - 1):g}", 0)
+            lines.append(f'vpn_checker_stage_seconds_bucket{{stage="{label}",le="+Inf"}} {acc}')
+            lines.append(f'vpn_checker_stage_seconds_sum{{stage="{label}"}} {r["total_s"]:g}')
+            lines.append(f'vpn_checker_stage_seconds_count{{stage="{label}"}} {acc}')
+        return "\n".join(lines) + "\n"
+
+
 # ==================== ЯДРО: ПРОВЕРКА ПОДПИСКИ ====================
+def check_unit(unit: List[str]) -> List[Tuple[bool, str, Optional[str], str, str, str]]:
+    """Проверка единицы работы: один ключ или пачка (CFG.BATCH_SIZE) на один Xray."""
+    _counters.inc("units_in_flight")
+    try:
+        if len(unit) > 1:
+            return check_key_batch(unit)
+        port = alloc_port()
+        if port is None:
+            return [PORT_CONFLICT]
+        return [check_single_key(unit[0], port)]
+    finally:
+        _counters.inc("units_in_flight", -1)
+
+
+def _guarded_check_unit(unit: List[str]) -> List[Tuple[bool, str, Optional[str], str, str, str]]:
+    """check_unit под глобальным семафором Xray."""
+    with _profiler.stage("slot_wait"):
+        _global_semaphore.acquire()
+    try:
+        time.sleep(random.uniform(0, 0.03))
+        return check_unit(unit)
+    finally:
+        _global_semaphore.release()
+
+
+def _remember_result(key: str, result: Tuple[bool, str, Optional[str], str, str, str]) -> None:
+    """Запись результата в кэш результатов, журнал прогона и историю проверок."""
+    success, reason, wkey, ktype, details, country_flag = result
+    if _result_cache is not None:
+        _result_cache.record(key, result)
+    if _journal is not None and is_verdict(result):
+        # Сбои окружения (Xray не запустился, порт занят) --resume проверит заново
+        _journal.record(key, result)
+    if _history is not None and is_verdict(result):
+        latency = _key_latency.get(key)
+        _history.append(get_hash(key), bool(success and wkey),
+                        int(latency * 1000) if latency is not None else None)
+
+
+def _handle_result(
+    key: str,
+    result: Tuple[bool, str, Optional[str], str, str, str],
+    checked: int,
+    n: int,
+    t0: float,
+    global_white: List[str],
+    global_universal: List[str],
+    tag: str = "",
+) -> str:
+    """Учитывает результат одного ключа и печатает строку прогресса.
+    Возвращает "white", "universal" или "failed"."""
+    success, reason, wkey, ktype, details, country_flag = result
+    _counters.inc("checked")
+    _remember_result(key, result)
+    if not (success and wkey):
+        _failures.inc(reason)
+        return "failed"
+    _counters.inc(f"ok_{ktype}")
+    elapsed = time.time() - t0
+    speed = checked / elapsed * 60 if elapsed else 0
+    if country_flag:
+        _country_flags_cache[wkey] = country_flag
+    country_info = f" {country_flag}" if country_flag else ""
+    if ktype == "white":
+        global_white.append(wkey)
+        print(f"  🏳️  {tag}[{checked}/{n}]{country_info} {details}  "
+              f"(всего белых: {len(global_white)}, {speed:.0f}/мин)")
+        return "white"
+    global_universal.append(wkey)
+    print(f"  🌍 {tag}[{checked}/{n}]{country_info} {details}  "
+          f"(всего универс: {len(global_universal)}, {speed:.0f}/мин)")
+    return "universal"
+
+
+def _print_sub_summary(n: int, sub: dict, elapsed: float, tag: str = "") -> None:
+    speed = n / elapsed * 60 if elapsed else 0
+    found = sub["white"] + sub["universal"]
+    print(f"   ✅ {tag}Итог: {found}/{n} рабочих  "
+          f"(🏳️ {sub['white']} белых, 🌍 {sub['universal']} универс) | "
+          f"{speed:.0f} ключ/мин | {elapsed:.1f}s")
+
+
 def check_subscription(
     sub_index: int,
     total_subs: int,
@@ -1002,84 +3586,222 @@ def check_subscription(
     stop_event: threading.Event,
 ) -> None:
     n = len(keys)
-    workers = min(n, CFG.MAX_WORKERS_PER_SUB)
+    batch = CFG.BATCH_SIZE if CFG.BATCH_SIZE > 1 else 1
+    units = [keys[i:i + batch] for i in range(0, n, batch)]
+    workers = min(len(units), max(1, CFG.MAX_WORKERS_PER_SUB // batch))
     short_url = url.rstrip("/").split("/")[-1][:45] or url[:45]
 
     print(f"\n{'─'*70}")
     print(f"📦 [{sub_index}/{total_subs}] {short_url}")
-    print(f"   Ключей: {n} | Потоков: {workers}")
+    if batch > 1:
+        print(f"   Ключей: {n} | Пачек: {len(units)} по {batch} | Потоков: {workers}")
+    else:
+        print(f"   Ключей: {n} | Потоков: {workers}")
 
-    sub_white = sub_universal = sub_failed = 0
+    sub = {"white": 0, "universal": 0, "failed": 0}
     t0 = time.time()
 
-    def _worker(key: str):
+    def _worker(unit: List[str]):
         if stop_event.is_set():
-            return False, "Остановлено", None, "none", "", ""
-        _global_semaphore.acquire()
+            return [(False, "Остановлено", None, "none", "", "")] * len(unit)
+        return _guarded_check_unit(unit)
+
+    checked = 0
+    collected: set = set()
+
+    def _collect(fut) -> None:
+        nonlocal checked
+        collected.add(fut)
         try:
-            port = alloc_port()
-            time.sleep(random.uniform(0, 0.03))
-            return check_single_key(key, port)
-        finally:
-            _global_semaphore.release()
+            results = fut.result(timeout=CFG.TOTAL_TIMEOUT)
+        except Exception:
+            checked += len(futures[fut])
+            sub["failed"] += len(futures[fut])
+            return
+        for key, res in zip(futures[fut], results):
+            if res[1] == "Остановлено":     # не проверялся — не в счёт
+                continue
+            checked += 1
+            sub[_handle_result(key, res, checked, n, t0, global_white, global_universal)] += 1
 
     with ThreadPoolExecutor(max_workers=workers) as ex:
-        futures = {ex.submit(_worker, k): k for k in keys}
-        checked = 0
+        futures = {ex.submit(_worker, u): u for u in units}
         try:
             for fut in as_completed(futures):
+                _collect(fut)
                 if stop_event.is_set():
                     break
-                checked += 1
-                try:
-                    success, reason, wkey, ktype, details, country_flag = fut.result(timeout=CFG.TOTAL_TIMEOUT)
-                except Exception:
-                    sub_failed += 1
-                    continue
-
-                if success and wkey:
-                    elapsed = time.time() - t0
-                    speed = checked / elapsed * 60 if elapsed else 0
-                    if country_flag and wkey:
-                        _country_flags_cache[wkey] = country_flag
-                    if ktype == "white":
-                        global_white.append(wkey)
-                        sub_white += 1
-                        country_info = f" {country_flag}" if country_flag else ""
-                        print(f"  🏳️  [{checked}/{n}]{country_info} {details}  "
-                              f"(всего белых: {len(global_white)}, {speed:.0f}/мин)")
-                    else:
-                        global_universal.append(wkey)
-                        sub_universal += 1
-                        country_info = f" {country_flag}" if country_flag else ""
-                        print(f"  🌍 [{checked}/{n}]{country_info} {details}  "
-                              f"(всего универс: {len(global_universal)}, {speed:.0f}/мин)")
-                else:
-                    sub_failed += 1
+            if stop_event.is_set():
+                # Бюджет исчерпан: не начатые единицы снимаем, а уже идущие
+                # дожидаемся (на это оставлен запас TOTAL_TIMEOUT) и учитываем —
+                # иначе их результаты не попадут ни в итог, ни в журнал
+                left = [f for f in futures if f not in collected and not f.cancel()]
+                finished, _ = wait(left, timeout=CFG.TOTAL_TIMEOUT)
+                for fut in finished:
+                    _collect(fut)
         except KeyboardInterrupt:
             stop_event.set()
             for f in futures: f.cancel()
 
     elapsed = time.time() - t0
-    speed = n / elapsed * 60 if elapsed else 0
     stats["total"]     += n
-    stats["white"]     += sub_white
-    stats["universal"] += sub_universal
-    stats["failed"]    += sub_failed
+    stats["white"]     += sub["white"]
+    stats["universal"] += sub["universal"]
+    stats["failed"]    += sub["failed"]
+    _print_sub_summary(n, sub, elapsed)
 
-    found = sub_white + sub_universal
-    print(f"   ✅ Итог: {found}/{n} рабочих  "
-          f"(🏳️ {sub_white} белых, 🌍 {sub_universal} универс) | "
-          f"{speed:.0f} ключ/мин | {elapsed:.1f}s")
+
+# ==================== ASYNC-ДВИЖОК: ОДНА ГЛОБАЛЬНАЯ ОЧЕРЕДЬ ====================
+def run_async_engine(
+    feed: Iterable[Tuple[str, Iterable[str]]],
+    global_white: List[str],
+    global_universal: List[str],
+    stats: dict,
+    stop_event: threading.Event,
+    check_fn: Callable[[List[str]], list] = None,
+) -> None:
+    """
+    Все ключи всех подписок идут через одну ограниченную очередь, поэтому
+    следующая подписка начинает проверяться, пока хвост предыдущей ещё
+    досиживает таймауты, и лимит MAX_TOTAL_WORKERS занят всё время.
+
+    feed — пары (url, ключи); ключи могут быть ленивым итератором (потоковая
+    загрузка): он читается в отдельном потоке, и проверка начинается до того,
+    как подписка скачана целиком.
+    """
+    try:
+        asyncio.run(_async_engine(feed, global_white, global_universal, stats, stop_event,
+                                  check_fn or _guarded_check_unit))
+    except KeyboardInterrupt:
+        stop_event.set()
+
+
+async def _async_engine(
+    feed: Iterable[Tuple[str, Iterable[str]]],
+    global_white: List[str],
+    global_universal: List[str],
+    stats: dict,
+    stop_event: threading.Event,
+    check_fn: Callable[[List[str]], list],
+) -> None:
+    batch = CFG.BATCH_SIZE if CFG.BATCH_SIZE > 1 else 1
+    concurrency = limiter_capacity()
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    # Состояние подписок дополняется потоком-поставщиком: n растёт по мере
+    # поступления ключей, closed — ключей больше не будет
+    subs: List[dict] = []
+    t_global = time.time()
+
+    print(f"   Async: {concurrency} одновременных единиц проверки, "
+          f"очередь до {concurrency * 2}")
+
+    def _finish(si: int) -> None:
+        sub = subs[si]
+        sub["done"] = True
+        with _stats_lock:
+            for k in ("white", "universal", "failed"):
+                stats[k] += sub[k]
+            stats["total"] += sub["checked"]
+        if not sub["n"]:
+            return
+        short = sub["url"].rstrip("/").split("/")[-1][:45] or sub["url"][:45]
+        elapsed = time.time() - (sub["t0"] or time.time())
+        print(f"   📦 [{si + 1}] {short}")
+        _print_sub_summary(sub["n"], sub, elapsed)
+        g_elapsed = time.time() - t_global
+        speed = stats["total"] / g_elapsed * 60 if g_elapsed else 0
+        left = sum(1 for s in subs if not s["done"])
+        print(f"   📈 Общий итог: 🏳️ {stats['white']} | 🌍 {stats['universal']} | "
+              f"{speed:.0f} ключ/мин | подписок в работе: {left}")
+
+    def _put(item) -> None:
+        asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+    def produce() -> None:
+        """Читает feed в отдельном потоке: итераторы ключей могут блокироваться на сети."""
+        try:
+            for url, keys in feed:
+                if stop_event.is_set():
+                    break
+                si = len(subs)
+                subs.append({"url": url, "n": 0, "checked": 0, "white": 0, "universal": 0,
+                             "failed": 0, "t0": None, "closed": False, "done": False})
+                unit: List[str] = []
+                for k in keys:
+                    if stop_event.is_set():
+                        break
+                    unit.append(k)
+                    if len(unit) >= batch:
+                        subs[si]["n"] += len(unit)
+                        _put((si, unit))
+                        unit = []
+                if unit:
+                    subs[si]["n"] += len(unit)
+                    _put((si, unit))
+                subs[si]["closed"] = True
+                _put((si, None))
+        finally:
+            for _ in range(concurrency):
+                _put(None)
+
+    async def worker() -> None:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            si, unit = item
+            sub = subs[si]
+            if unit is not None:
+                if sub["t0"] is None:
+                    sub["t0"] = time.time()
+                if stop_event.is_set():
+                    continue
+                try:
+                    results = await loop.run_in_executor(executor, check_fn, unit)
+                except Exception:
+                    results = [(False, "Ошибка", None, "none", "", "")] * len(unit)
+                for key, res in zip(unit, results):
+                    sub["checked"] += 1
+                    kind = _handle_result(key, res, sub["checked"], sub["n"], sub["t0"],
+                                          global_white, global_universal, tag=f"[{si + 1}] ")
+                    sub[kind] += 1
+            if sub["closed"] and not sub["done"] and sub["checked"] >= sub["n"]:
+                _finish(si)
+
+    # Поставщик — daemon-поток: при Ctrl+C он не должен держать завершение цикла
+    threading.Thread(target=produce, daemon=True, name="key-feed").start()
+    try:
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+    finally:
+        executor.shutdown(wait=False)
+        for sub in subs:
+            if not sub["done"] and sub["checked"]:
+                for k in ("white", "universal", "failed"):
+                    stats[k] += sub[k]
+                stats["total"] += sub["checked"]
 
 
 # ==================== СОХРАНЕНИЕ ====================
-def save_keys(white_keys: List[str], universal_keys: List[str]):
+def save_keys(white_keys: List[str], universal_keys: List[str], publish_empty: bool = False):
+    """Списки с флагами стран в RU_DIR/EURO_DIR. publish_empty — переписывать
+    и опустевший список (--daemon), иначе прошлый файл остаётся как есть."""
     print(f"\n{'='*70}\nСОХРАНЕНИЕ\n{'='*70}")
     os.makedirs(CFG.RU_DIR,   exist_ok=True)
     os.makedirs(CFG.EURO_DIR, exist_ok=True)
 
     print("🔍 Добавляем флаги стран...")
+    missing = [k for k in white_keys + universal_keys
+               if _country_flags_cache.get(k, "") in ("", "UNKNOWN")]
+    if missing:
+        t0 = time.time()
+        with _profiler.stage("geolocation_batch"):
+            flags = batch_country_flags(missing, t0 + CFG.GEO_DEADLINE)
+        _country_flags_cache.update(flags)
+        unknown = sum(1 for f in flags.values() if f == "UNKNOWN")
+        print(f"   {len(missing)} ключей без страны: {time.time() - t0:.1f}s | UNKNOWN: {unknown}")
+
     white_renamed = []
     for k in white_keys:
         flag = _country_flags_cache.get(k, "")
@@ -1090,27 +3812,26 @@ def save_keys(white_keys: List[str], universal_keys: List[str]):
         flag = _country_flags_cache.get(k, "")
         universal_renamed.append(rename_key(k, flag))
 
-    if white_keys:
+    if white_keys or publish_empty:
         p = os.path.join(CFG.RU_DIR, "ru_white.txt")
-        with open(p, "w", encoding="utf-8") as f: f.write("\n".join(white_renamed))
+        save_text(p, "\n".join(white_renamed))
         print(f"🏳️  {p}  ({len(white_keys)} ключей)")
 
-    if universal_keys:
+    if universal_keys or publish_empty:
         p = os.path.join(CFG.EURO_DIR, "euro_universal.txt")
-        with open(p, "w", encoding="utf-8") as f: f.write("\n".join(universal_renamed))
+        save_text(p, "\n".join(universal_renamed))
         print(f"🌍 {p}  ({len(universal_keys)} ключей)")
 
         p = os.path.join(CFG.EURO_DIR, "euro_black.txt")
-        with open(p, "w", encoding="utf-8") as f: f.write("")
+        save_text(p, "")
 
     subs = os.path.join(CFG.CHECKED_DIR, "subscriptions_list.txt")
-    with open(subs, "w", encoding="utf-8") as f:
-        f.write("=== 🇷🇺 РОССИЯ ===\n\n⚪ БЕЛЫЙ СПИСОК:\n"
-                "https://raw.githubusercontent.com/Mihuil121/vpn-checker-backend-fox/main/checked/RU_Best/ru_white.txt\n\n"
-                "=== 🇪🇺 ЕВРОПА ===\n\n⚫ ЧЕРНЫЙ СПИСОК:\n"
-                "https://raw.githubusercontent.com/Mihuil121/vpn-checker-backend-fox/main/checked/My_Euro/euro_black.txt\n\n"
-                "🔘 УНИВЕРСАЛЬНЫЕ:\n"
-                "https://raw.githubusercontent.com/Mihuil121/vpn-checker-backend-fox/main/checked/My_Euro/euro_universal.txt\n")
+    save_text(subs, "=== 🇷🇺 РОССИЯ ===\n\n⚪ БЕЛЫЙ СПИСОК:\n"
+                    "https://raw.githubusercontent.com/Mihuil121/vpn-checker-backend-fox/main/checked/RU_Best/ru_white.txt\n\n"
+                    "=== 🇪🇺 ЕВРОПА ===\n\n⚫ ЧЕРНЫЙ СПИСОК:\n"
+                    "https://raw.githubusercontent.com/Mihuil121/vpn-checker-backend-fox/main/checked/My_Euro/euro_black.txt\n\n"
+                    "🔘 УНИВЕРСАЛЬНЫЕ:\n"
+                    "https://raw.githubusercontent.com/Mihuil121/vpn-checker-backend-fox/main/checked/My_Euro/euro_universal.txt\n")
     print(f"📋 {subs}")
 
 
@@ -1124,6 +3845,10 @@ def parse_args():
   python main_fast.py --workers-per-sub 200        # больше потоков на подписку
   python main_fast.py --total-workers 400          # больше Xray одновременно
   python main_fast.py --sources URL1 URL2          # только эти подписки
+  python main_fast.py --batch-size 20              # 20 ключей на один Xray
+  python main_fast.py --engine async               # общая очередь без простоя между подписками
+  python main_fast.py --stream                     # проверка начинается до конца загрузки
+  python main_fast.py --time-budget 330            # уложиться в лимит job на Actions
 """
     )
     p.add_argument("--sources", nargs="*", default=None, metavar="URL")
@@ -1132,42 +3857,105 @@ def parse_args():
                    help=f"Макс потоков на одну подписку (по умолч. {CFG.MAX_WORKERS_PER_SUB})")
     p.add_argument("--total-workers", type=int, default=None, metavar="N",
                    help=f"Глобальный лимит Xray-процессов (по умолч. {CFG.MAX_TOTAL_WORKERS})")
+    p.add_argument("--startup-timeout", type=float, default=None, metavar="SEC",
+                   help=f"Дедлайн готовности Xray (по умолч. {CFG.XRAY_STARTUP_TIMEOUT}s)")
+    p.add_argument("--adaptive", action="store_true",
+                   help="Подбирать лимит Xray на лету (AIMD) от --total-workers "
+                        f"в пределах [{CFG.ADAPTIVE_MIN_WORKERS}, {CFG.ADAPTIVE_MAX_WORKERS}]")
+    p.add_argument("--max-workers", type=int, default=None, metavar="N",
+                   help="Верхняя граница для --adaptive")
+    p.add_argument("--full", action="store_true",
+                   help="Проверить всё заново, не пропуская свежие результаты из кэша")
+    p.add_argument("--time-budget", "--deadline", type=float, default=None, metavar="MIN",
+                   help="Бюджет прогона в минутах: сначала самые перспективные ключи, "
+                        f"остановка за {CFG.SAVE_RESERVE_MIN:.0f} мин до конца для сохранения")
+    p.add_argument("--daemon", action="store_true",
+                   help="Не завершаться: перекачивать подписки и перепроверять ключи по расписанию")
+    p.add_argument("--coordinator", default=None, metavar="HOST:PORT",
+                   help="Не проверять самому, а раздавать ключи воркерам (шарды по хэшу ключа)")
+    p.add_argument("--worker", default=None, metavar="URL",
+                   help="Проверять ключи, выданные координатором по адресу URL")
+    p.add_argument("--shard-token", default=None, metavar="TOKEN",
+                   help="Общий секрет координатора и воркеров (обязателен, если координатор слушает не localhost)")
+    p.add_argument("--resume", action="store_true",
+                   help="Продолжить прерванный прогон: ключи из журнала не проверяются заново")
+    p.add_argument("--export-analytics", default=None, metavar="PATH",
+                   help="Выгрузить историю из SQLite в формат analytics.json и выйти")
+    p.add_argument("--compact-history", action="store_true",
+                   help=f"Сжать историю (оставить {CFG.HISTORY_KEEP_CHECKS} проверок на ключ, "
+                        f"удалить ключи старше {CFG.HISTORY_KEEP_DAYS:.0f} дн.) и выйти")
+    p.add_argument("--no-endpoint-probe", action="store_true",
+                   help="Не отсеивать ключи на недоступных host:port до запуска Xray")
+    p.add_argument("--endpoint-probe-tls", action="store_true",
+                   help="В предпроверке слать TLS/Reality-серверам ClientHello с SNI ключа")
+    p.add_argument("--no-fetch-cache", action="store_true",
+                   help="Скачивать подписки целиком, без условных запросов")
+    p.add_argument("--engine", choices=("threads", "async"), default="threads",
+                   help="threads — пул на каждую подписку по очереди, "
+                        "async — одна глобальная очередь ключей всех подписок")
+    p.add_argument("--stream", action="store_true",
+                   help="Проверять ключи по мере скачивания подписок (включает --engine async)")
+    p.add_argument("--geoip", default=None, metavar="PATH",
+                   help="База IP → страна: geoip.dat из Xray или CSV "
+                        "(GeoLite2 / ip2location / \"сеть,страна\")")
+    p.add_argument("--geo-deadline", type=float, default=None, metavar="SEC",
+                   help=f"Сколько ждать страны при сохранении (по умолч. {CFG.GEO_DEADLINE:.0f}s), "
+                        "остальные — UNKNOWN")
+    p.add_argument("--echo-url", default=None, metavar="URL",
+                   help="Echo-сервис для IP на выходе прокси (по умолч. публичные по кругу)")
+    p.add_argument("--real-ip", default=None, metavar="IP",
+                   help="Реальный IP машины вместо автоопределения при старте")
+    p.add_argument("--curl", action="store_true",
+                   help="Проверять сайты через curl вместо встроенного SOCKS5-клиента")
+    p.add_argument("--cpu-workers", type=int, default=None, metavar="N",
+                   help="Процессов на разбор ключей (по умолч. по числу ядер, 1 — без пула)")
+    p.add_argument("--batch-size", type=int, default=None, metavar="N",
+                   help="Ключей на один процесс Xray (по умолч. 1 — отдельный Xray на ключ)")
+    p.add_argument("--metrics-port", type=int, default=None, metavar="PORT",
+                   help="Отдавать метрики Prometheus на http://METRICS_HOST:PORT/metrics")
+    p.add_argument("--profile", nargs="?", const="", default=None, metavar="JSON",
+                   help="Время по этапам проверки: таблица в конце, с путём — ещё и JSON")
     return p.parse_args()
 
 
-# ==================== MAIN ====================
-def main():
-    global _global_semaphore
-    args = parse_args()
+def analyze_sources(
+    sources: List[str],
+    max_keys: int,
+    global_white: List[str],
+    global_universal: List[str],
+    stats: dict,
+    endpoint_probe: bool,
+    origins: Dict[str, str],
+) -> List[Tuple[str, List[str]]]:
+    """
+    Шаг 1: скачать все подписки, убрать дубли, применить кэш и отсеять мёртвые серверы.
+    origins заполняется картой ключ → источник (для выхода источников).
+    """
+    sub_data = collect_sources(sources, max_keys, origins)
 
-    sources  = args.sources or CFG.SOURCES
-    max_keys = args.max_keys or CFG.MAX_KEYS
-    if args.workers_per_sub: CFG.MAX_WORKERS_PER_SUB = args.workers_per_sub
-    if args.total_workers:   CFG.MAX_TOTAL_WORKERS   = args.total_workers
+    _history.touch([get_hash(k) for _, keys in sub_data for k in keys])
 
-    _global_semaphore = threading.Semaphore(CFG.MAX_TOTAL_WORKERS)
+    if _journal is not None and _journal.done:
+        sub_data = split_journal(sub_data, _journal, global_white, global_universal, stats)
 
-    print(f"\n{'='*70}")
-    print(" VPN Checker v4.0 — УМНАЯ ПРОВЕРКА ПО ПОДПИСКАМ")
-    print(f"{'='*70}")
-    print(f"  Потоков на подписку: до {CFG.MAX_WORKERS_PER_SUB}")
-    print(f"  Глобальный лимит Xray: {CFG.MAX_TOTAL_WORKERS}")
-    print(f"  Startup: {CFG.XRAY_STARTUP_WAIT}s | Timeout: {CFG.REQUEST_TIMEOUT}s")
+    if _result_cache is not None and _result_cache.read:
+        sub_data = split_cached(sub_data, _result_cache, global_white, global_universal, stats)
 
-    # Получаем реальный IP машины один раз при старте
-    global _real_ip
-    _real_ip = "109.110.91.167"
-    print(f"  🌐 Реальный IP: {_real_ip}")
+    resolve_hosts(sub_data)
 
-    if not os.path.exists(CFG.XRAY_PATH):
-        print(f"\n❌ Xray не найден: {CFG.XRAY_PATH}")
-        return
+    if endpoint_probe:
+        sub_data = filter_dead_endpoints(sub_data, stats)
+    retain_outbounds(k for _, keys in sub_data for k in keys)
+    return sub_data
 
-    if not sources:
-        print("\n❌ Нет источников. Добавь ссылки в CFG.SOURCES или передай через --sources")
-        return
 
-    # ── ШАГ 1: Анализ всех подписок ─────────────────────────────────────
+def collect_sources(
+    sources: List[str],
+    max_keys: int,
+    origins: Dict[str, str],
+) -> List[Tuple[str, List[str]]]:
+    """Скачать все подписки и убрать дубли между ними (с отчётом по источникам)."""
+    batch = CFG.BATCH_SIZE if CFG.BATCH_SIZE > 1 else 1
     print(f"\n{'='*70}")
     print(f"📊 АНАЛИЗ ПОДПИСОК  ({len(sources)} источников)")
     print(f"{'='*70}")
@@ -1176,59 +3964,837 @@ def main():
     seen:     set = set()
     total_keys = 0
 
-    for url in sources:
-        raw_keys = fetch_keys(url)
+    total_dups = 0
+
+    t_fetch = time.time()
+    fetched = fetch_all(sources)
+    fetch_elapsed = time.time() - t_fetch
+
+    t_parse = time.time()
+    all_keys = [k for raw_keys in fetched for k in raw_keys]
+    all_idents = iter(prepare_keys(all_keys))
+    parse_elapsed = time.time() - t_parse
+
+    for url, raw_keys in zip(sources, fetched):
         uniq = []
         for k in raw_keys:
-            if k not in seen:
-                seen.add(k)
+            ident = next(all_idents)
+            if ident not in seen:
+                seen.add(ident)
                 uniq.append(k)
+        dups = len(raw_keys) - len(uniq)
+        total_dups += dups
+        dup_info = f"  (дублей: {dups})" if dups else ""
         if total_keys + len(uniq) > max_keys:
             uniq = uniq[:max_keys - total_keys]
 
         short = url.rstrip("/").split("/")[-1][:45] or url[:45]
         if uniq:
             sub_data.append((url, uniq))
+            origins.update((k, url) for k in uniq)
             total_keys += len(uniq)
-            w = min(len(uniq), CFG.MAX_WORKERS_PER_SUB)
-            print(f"  ✅ {len(uniq):>6} ключей → {w:>3} потоков  {short}")
+            w = min(-(-len(uniq) // batch), max(1, CFG.MAX_WORKERS_PER_SUB // batch))
+            print(f"  ✅ {len(uniq):>6} ключей → {w:>3} потоков  {short}{dup_info}")
         else:
-            print(f"  ❌      0                    {short}")
+            print(f"  ❌      0                    {short}{dup_info}")
 
         if total_keys >= max_keys:
             break
-
-    # Сортируем: сначала большие подписки
-    sub_data.sort(key=lambda x: len(x[1]), reverse=True)
-
-    print(f"\n  📦 Подписок: {len(sub_data)}")
+    # Дубли и ключи сверх лимита в проверку не пойдут — их outbound не нужен
+    for k in set(all_keys).difference(origins):
+        _outbound_json.pop(k, None)
+
+    fc = _counters.snapshot()
+    print(f"\n  ⬇️  Загрузка: {fetch_elapsed:.1f}s | скачано {fc.get('fetch_downloaded', 0)}, "
+          f"не изменилось (304) {fc.get('fetch_not_modified', 0)}")
+    workers = cpu_workers() if len(all_keys) >= CFG.CPU_POOL_MIN_KEYS else 1
+    print(f"  🧩 Разбор: {parse_elapsed:.1f}s ({len(all_keys)} ключей, процессов: {workers})")
+    print(f"  📦 Подписок: {len(sub_data)}")
     print(f"  🔑 Уникальных ключей: {total_keys}")
+    print(f"  ♊ Дублей отброшено:  {total_dups}")
     print(f"\n  Топ-5 по размеру:")
-    for url, keys in sub_data[:5]:
+    for url, keys in sorted(sub_data, key=lambda x: len(x[1]), reverse=True)[:5]:
         short = url.rstrip("/").split("/")[-1][:50]
         print(f"    {len(keys):>6} ключей  {short}")
+    return sub_data
+
+
+# ==================== РЕЖИМ ДЕМОНА (--daemon) ====================
+class RecheckSchedule:
+    """
+    Когда перепроверять каждый ключ в режиме --daemon. Рабочий — через
+    DAEMON_OK_RECHECK_MIN, умноженное на 0.25..1 по стабильности (chance
+    по истории): ненадёжные выпадают из списка чаще, их и смотрим чаще.
+    Нерабочий — через DAEMON_FAIL_RECHECK_MIN с удвоением за каждую
+    неудачу подряд, не реже раза в DAEMON_MAX_RECHECK_H. Новый — сразу.
+    """
+
+    def __init__(self):
+        self.due: Dict[str, float] = {}
+        self.fails: Dict[str, int] = {}
+
+    def interval(self, ok: bool, chance: float, fails: int = 1) -> float:
+        if ok:
+            return CFG.DAEMON_OK_RECHECK_MIN * 60 * (0.25 + 0.75 * min(max(chance, 0.0), 1.0))
+        return min(CFG.DAEMON_FAIL_RECHECK_MIN * 60 * 2 ** (fails - 1),
+                   CFG.DAEMON_MAX_RECHECK_H * 3600)
+
+    def add(self, key: str, now: float, last: Optional[dict] = None, chance: float = 0.5) -> None:
+        """Новый ключ; last — запись ResultCache о прошлой проверке, если есть."""
+        if key in self.due:
+            return
+        if last is None:
+            self.due[key] = now
+            return
+        if not last["ok"]:
+            self.fails[key] = 1
+        self.due[key] = last.get("time", 0) + self.interval(last["ok"], chance)
+
+    def done(self, key: str, ok: bool, chance: float, now: float) -> None:
+        if ok:
+            self.fails.pop(key, None)
+            self.due[key] = now + self.interval(True, chance)
+        else:
+            n = self.fails[key] = self.fails.get(key, 0) + 1
+            self.due[key] = now + self.interval(False, chance, n)
+
+    def drop(self, key: str) -> None:
+        self.due.pop(key, None)
+        self.fails.pop(key, None)
+
+    def pick(self, now: float, limit: int) -> List[str]:
+        """Ключи, чей срок наступил, — самые просроченные первыми."""
+        ready = [k for k, t in self.due.items() if t <= now]
+        ready.sort(key=self.due.__getitem__)
+        return ready[:limit]
+
+    def next_due(self) -> Optional[float]:
+        return min(self.due.values()) if self.due else None
+
+
+def run_daemon(
+    sources: List[str],
+    max_keys: int,
+    endpoint_probe: bool,
+    stop_event: threading.Event,
+) -> None:
+    """
+    --daemon: один тёплый процесс вместо запуска по cron. Подписки
+    перекачиваются раз в DAEMON_FETCH_INTERVAL_MIN (условные запросы, 304 —
+    без загрузки), ключи перепроверяются по RecheckSchedule раундами до
+    DAEMON_ROUND_KEYS. Если состав рабочих изменился, списки переписываются
+    атомарно. DNS, GeoIP, страны и история остаются в памяти между раундами.
+    """
+    sched = RecheckSchedule()
+    origins: Dict[str, str] = {}
+    working: Dict[str, str] = {}       # ключ → "white" / "universal"
+    judged: set = set()                # ключи с актуальным вердиктом
+    prio = Priorities({}, {}, {})
+    published: Optional[Dict[str, str]] = None
+    next_fetch = 0.0
+
+    def refetch(now: float) -> None:
+        global _real_ip
+        nonlocal origins, prio
+        ip = detect_real_ip(fresh=True)
+        if ip and ip != _real_ip:
+            print(f"  🌐 Реальный IP: {ip}")
+        _real_ip = ip or _real_ip
+
+        fresh: Dict[str, str] = {}
+        collect_sources(sources, max_keys, fresh)
+        # Источник, который не ответил, сохраняет прежние ключи до следующей загрузки
+        answered = set(fresh.values())
+        for k, url in origins.items():
+            if url not in answered and url in sources:
+                fresh.setdefault(k, url)
+        if not fresh:
+            print("  ⚠️  Ни один источник не ответил — оставляю прежние списки")
+            return
+
+        if judged:
+            # Выход источников — по ключам, у которых уже есть вердикт:
+            # полного прохода по всем ключам в режиме демона не бывает
+            _history.record_sources(source_yields(
+                {k: url for k, url in origins.items() if k in judged}, working))
+        _history.compact(CFG.HISTORY_KEEP_CHECKS, CFG.HISTORY_KEEP_DAYS)
+        for k in set(origins) - set(fresh):
+            working.pop(k, None)
+            judged.discard(k)
+            sched.drop(k)
+            _key_latency.pop(k, None)
+            _country_flags_cache.pop(k, None)
+            _outbound_json.pop(k, None)
+        origins = fresh
+        _startup_times.clear()
+
+        by_source: Dict[str, List[str]] = defaultdict(list)
+        for k, url in origins.items():
+            by_source[url].append(k)
+        sub_data = list(by_source.items())
+        _history.touch([get_hash(k) for k in origins])
+        resolve_hosts(sub_data)
+        prio = score_keys(sub_data, _history, _history.source_ratios())
+        for k in origins:
+            last = _result_cache.last(k) if _result_cache is not None else None
+            if last is not None and k not in sched.due:
+                judged.add(k)
+            if last is not None and k not in sched.due and last["ok"]:
+                # Тёплый старт: прошлый рабочий результат публикуется до перепроверки
+                working[k] = last.get("type") or "universal"
+                if last.get("flag"):
+                    _country_flags_cache[k] = last["flag"]
+            sched.add(k, now, last, prio.chance.get(k, 0.5))
+
+    def recheck(due: List[str]) -> None:
+        outcomes: Dict[str, tuple] = {}
+        base = EndpointGate(_guarded_check_unit) if endpoint_probe else _guarded_check_unit
+
+        def check_fn(unit: List[str]) -> list:
+            results = base(unit)
+            outcomes.update(zip(unit, results))
+            return results
+
+        stats = {"total": 0, "white": 0, "universal": 0, "failed": 0}
+        run_async_engine([("перепроверка", due)], [], [], stats, stop_event, check_fn)
+
+        done_at = time.time()
+        for k, (success, reason, wkey, ktype, details, flag) in outcomes.items():
+            if reason == "Остановлено":
+                continue
+            ok = bool(success and wkey)
+            if ok:
+                working[k] = ktype
+            else:
+                working.pop(k, None)
+            judged.add(k)
+            sched.done(k, ok, prio.chance.get(k, 0.5), done_at)
+        if _result_cache is not None:
+            _result_cache.save()
+
+    def publish() -> None:
+        nonlocal published
+        if origins and working != published:
+            save_keys([k for k, t in working.items() if t == "white"],
+                      [k for k, t in working.items() if t != "white"], publish_empty=True)
+            published = dict(working)
+
+    print(f"\n🔁 Режим демона: подписки раз в {CFG.DAEMON_FETCH_INTERVAL_MIN:g} мин, "
+          f"до {CFG.DAEMON_ROUND_KEYS} ключей за раунд")
+    try:
+        while not stop_event.is_set():
+            now = time.time()
+            if now >= next_fetch:
+                next_fetch = now + CFG.DAEMON_FETCH_INTERVAL_MIN * 60
+                refetch(now)
+
+            due = sched.pick(now, CFG.DAEMON_ROUND_KEYS)
+            if due:
+                waiting = sum(1 for t in sched.due.values() if t <= now)
+                print(f"\n🔁 Перепроверка: {len(due)} из {waiting} ожидающих "
+                      f"(рабочих сейчас {len(working)})")
+                recheck(due)
+            if not stop_event.is_set():
+                publish()
+            if not due:
+                wake = min(t for t in (sched.next_due(), next_fetch) if t is not None)
+                stop_event.wait(min(max(wake - time.time(), 1.0), 60.0))
+    except KeyboardInterrupt:
+        print("\n\n⚠️  Ctrl+C — сохраняю...")
+        stop_event.set()
+    publish()
+    if _result_cache is not None:
+        _result_cache.save()
+
+
+# ==================== РАСПРЕДЕЛЁННАЯ ПРОВЕРКА (--coordinator / --worker) ====================
+def _ring_point(value: str) -> int:
+    return int(hashlib.sha256(value.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Консистентное хэширование: у каждого узла SHARD_VNODES точек на кольце,
+    ключ (get_hash) принадлежит ближайшей точке по часовой стрелке. При
+    появлении или потере узла переезжают только ключи его участков.
+    """
+
+    def __init__(self, vnodes: int):
+        self.vnodes = vnodes
+        self._points: List[int] = []
+        self._owners: List[str] = []
+
+    def add(self, node: str) -> None:
+        for i in range(self.vnodes):
+            point = _ring_point(f"{node}#{i}")
+            idx = bisect.bisect(self._points, point)
+            self._points.insert(idx, point)
+            self._owners.insert(idx, node)
+
+    def remove(self, node: str) -> None:
+        keep = [(p, o) for p, o in zip(self._points, self._owners) if o != node]
+        self._points = [p for p, _ in keep]
+        self._owners = [o for _, o in keep]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._points:
+            return None
+        idx = bisect.bisect(self._points, int(get_hash(key), 16)) % len(self._points)
+        return self._owners[idx]
+
+
+class ShardCoordinator:
+    """
+    Очереди ключей по воркерам. Воркер берёт ключи своего шарда (lease),
+    результаты возвращает пачками (complete), которые заодно служат
+    пульсом. Опустевший воркер забирает хвост самой длинной чужой очереди.
+    Потерянный воркер (SHARD_WORKER_TIMEOUT) уходит с кольца, его очередь
+    и невозвращённые ключи переходят к оставшимся.
+    """
+
+    def __init__(self, keys: List[str], on_result: Callable[[str, tuple], None]):
+        self.on_result = on_result
+        self.ring = HashRing(CFG.SHARD_VNODES)
+        self.order = {k: i for i, k in enumerate(keys)}
+        self.pending = set(keys)
+        self.queues: Dict[str, deque] = {}
+        self.unassigned: deque = deque(keys)    # пока нет ни одного воркера
+        self.leases: Dict[str, Tuple[str, float]] = {}
+        self.last_seen: Dict[str, float] = {}
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        self._result_lock = threading.Lock()
+        self._seq = 0
+        if not keys:
+            self.done.set()
+
+    def _rebalance(self) -> None:
+        """Раздать все невыданные ключи по кольцу заново, сохраняя порядок приоритета."""
+        queued = [k for q in [self.unassigned, *self.queues.values()] for k in q
+                  if k in self.pending and k not in self.leases]
+        queued.sort(key=self.order.__getitem__)
+        self.unassigned = deque()
+        for q in self.queues.values():
+            q.clear()
+        for k in queued:
+            owner = self.ring.owner(k)
+            (self.queues[owner] if owner else self.unassigned).append(k)
+
+    def register(self, name: str) -> str:
+        with self._lock:
+            self._seq += 1
+            worker = f"{name}-{self._seq}"
+            self.ring.add(worker)
+            self.queues[worker] = deque()
+            self.last_seen[worker] = time.time()
+            self._rebalance()
+        print(f"  🤝 Воркер {worker} подключён (всего {len(self.queues)})")
+        return worker
+
+    def lease(self, worker: str, n: int) -> Optional[List[str]]:
+        """До n ключей воркеру; None — воркер неизвестен (потерян) и должен переподключиться."""
+        now = time.time()
+        with self._lock:
+            if worker not in self.queues:
+                return None
+            self.last_seen[worker] = now
+            out: List[str] = []
+            own = self.queues[worker]
+            while own and len(out) < n:
+                k = own.popleft()
+                if k in self.pending and k not in self.leases:
+                    out.append(k)
+            if not out:
+                victim = max(self.queues.values(), key=len)
+                while victim and len(out) < n:
+                    k = victim.pop()
+                    if k in self.pending and k not in self.leases:
+                        out.append(k)
+            for k in out:
+                self.leases[k] = (worker, now)
+            return out
+
+    def complete(self, worker: str, items: List[dict]) -> None:
+        accepted = []
+        with self._lock:
+            if worker in self.last_seen:
+                self.last_seen[worker] = time.time()
+            for item in items:
+                key = item.get("key") if isinstance(item, dict) else None
+                lease = self.leases.get(key)
+                if lease is None or lease[0] != worker:
+                    continue            # не выдавался этому воркеру или уже засчитан
+                result = _shard_result(key, item.get("result"))
+                del self.leases[key]
+                if result is None or result[1] == "Остановлено":
+                    owner = self.ring.owner(key)
+                    (self.queues[owner] if owner else self.unassigned).appendleft(key)
+                    continue
+                self.pending.discard(key)
+                latency = item.get("latency")
+                if isinstance(latency, (int, float)) and 0 <= latency <= CFG.TOTAL_TIMEOUT:
+                    _key_latency[key] = float(latency)
+                accepted.append((key, result))
+            if not self.pending:
+                self.done.set()
+        with self._result_lock:
+            for key, result in accepted:
+                self.on_result(key, result)
+
+    def reap(self) -> None:
+        """Снять потерянных воркеров и вернуть в очереди просроченные ключи."""
+        now = time.time()
+        with self._lock:
+            lost = [w for w, t in self.last_seen.items()
+                    if now - t > CFG.SHARD_WORKER_TIMEOUT and w in self.queues]
+            for w in lost:
+                self.ring.remove(w)
+                self.unassigned.extend(self.queues.pop(w))
+                del self.last_seen[w]
+            expired = [k for k, (w, t) in self.leases.items()
+                       if w in lost or now - t > CFG.SHARD_LEASE_TIMEOUT]
+            for k in expired:
+                del self.leases[k]
+                self.unassigned.append(k)
+            if lost or expired:
+                self._rebalance()
+        for w in lost:
+            print(f"  💀 Воркер {w} потерян — его шард переназначен ({len(self.queues)} осталось)")
+        if expired and not lost:
+            print(f"  ↩️  {len(expired)} ключей без ответа дольше {CFG.SHARD_LEASE_TIMEOUT:.0f}s — выданы заново")
+
+    def progress(self) -> Tuple[int, int, int]:
+        """(осталось, выдано, воркеров)."""
+        with self._lock:
+            return len(self.pending), len(self.leases), len(self.queues)
+
+
+def _shard_result(key: str, raw) -> Optional[Tuple[bool, str, Optional[str], str, str, str]]:
+    """
+    Результат от воркера в формате check_single_key — только проверенные
+    поля: рабочим засчитывается сам выданный ключ (wkey воркера не берётся),
+    тип — white/universal, флаг — из COUNTRY_FLAGS. Мусор — None.
+    """
+    if not isinstance(raw, (list, tuple)) or len(raw) != 6:
+        return None
+    success, reason, _, ktype, details, flag = raw
+    if not isinstance(reason, str) or not isinstance(details, str) or not isinstance(flag, str):
+        return None
+    ok = success is True and ktype in ("white", "universal")
+    m = re.fullmatch(r"(.*?)([A-Z]{2})", flag)
+    if flag != "UNKNOWN" and not (m and m.group(1) == COUNTRY_FLAGS.get(m.group(2), "")):
+        flag = ""
+    if not ok:
+        return (False, reason[:40], None, "none", details[:80], "")
+    label = "Белый список" if ktype == "white" else "Универсальный"
+    return (True, label, key, ktype, details[:80], flag)
+
+
+def _shard_handler(coord: ShardCoordinator):
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code: int, data: dict) -> None:
+            body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def do_POST(self):
+            token = self.headers.get("X-Shard-Token", "")
+            if CFG.SHARD_TOKEN and not hmac.compare_digest(token.encode(), CFG.SHARD_TOKEN.encode()):
+                self._reply(403, {"error": "token"})
+                return
+            try:
+                data = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except ValueError:
+                self._reply(400, {"error": "json"})
+                return
+            if self.path == "/register":
+                self._reply(200, {"worker": coord.register(str(data.get("name", "worker"))[:40])})
+            elif self.path == "/lease":
+                keys = coord.lease(data.get("worker", ""), max(1, int(data.get("n", 1))))
+                if keys is None:
+                    self._reply(410, {"error": "unknown worker"})
+                else:
+                    self._reply(200, {"keys": keys, "done": coord.done.is_set()})
+            elif self.path == "/results":
+                coord.complete(data.get("worker", ""), data.get("results", []))
+                self._reply(200, {"done": coord.done.is_set()})
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def _parse_bind(bind: str) -> Tuple[str, int]:
+    host, _, port = bind.rpartition(":")
+    return host or "0.0.0.0", int(port)
+
+
+def coordinator_bind_error(bind: str) -> str:
+    """Почему нельзя слушать bind ("" — можно): наружу — только с SHARD_TOKEN."""
+    try:
+        host, _ = _parse_bind(bind)
+    except ValueError:
+        return f"неверный адрес {bind!r}, нужен HOST:PORT"
+    if host == "localhost":
+        return ""
+    try:
+        loopback = ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        loopback = False
+    if not loopback and not CFG.SHARD_TOKEN:
+        return (f"{host} доступен извне — задай общий секрет --shard-token "
+                f"(иначе любой сможет прислать свои ключи в публикуемые списки)")
+    return ""
+
+
+def run_coordinator(
+    sub_data: List[Tuple[str, List[str]]],
+    bind: str,
+    global_white: List[str],
+    global_universal: List[str],
+    stats: dict,
+    stop_event: threading.Event,
+) -> None:
+    """
+    --coordinator HOST:PORT: ключи (уже без дублей, кэша и мёртвых серверов)
+    не проверяются здесь, а раздаются воркерам по шардам. Результаты
+    засчитываются как при локальной проверке, так что кэш, история и
+    save_keys работают без изменений.
+    """
+    keys = [k for _, ks in sub_data for k in ks]
+    t0 = time.time()
+    checked = [0]
+
+    def on_result(key: str, result: tuple) -> None:
+        checked[0] += 1
+        kind = _handle_result(key, result, checked[0], len(keys), t0,
+                              global_white, global_universal, tag="[shard] ")
+        stats[kind] += 1
+        stats["total"] += 1
+
+    coord = ShardCoordinator(keys, on_result)
+    httpd = ThreadingHTTPServer(_parse_bind(bind), _shard_handler(coord))
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True, name="coordinator").start()
+    print(f"  🛰️  Координатор на {bind}: {len(keys)} ключей ждут воркеров "
+          f"(python main.py --worker http://<адрес>:{_parse_bind(bind)[1]})")
+
+    last_report = time.time()
+    try:
+        while not stop_event.is_set() and not coord.done.wait(1.0):
+            coord.reap()
+            if time.time() - last_report >= 15:
+                last_report = time.time()
+                left, leased, workers = coord.progress()
+                print(f"   📈 Осталось {left} (у воркеров {leased}) | воркеров: {workers} | "
+                      f"🏳️ {stats['white']} | 🌍 {stats['universal']}")
+        if coord.done.is_set():
+            # Даём воркерам забрать «done» и завершиться самим
+            time.sleep(CFG.SHARD_HEARTBEAT * 2)
+    except KeyboardInterrupt:
+        print("\n\n⚠️  Ctrl+C — сохраняю...")
+        stop_event.set()
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def run_worker(url: str, stop_event: threading.Event) -> dict:
+    """
+    --worker URL: берёт ключи у координатора и проверяет их обычным
+    движком (run_async_engine). Результаты копятся и уходят пачкой раз в
+    SHARD_HEARTBEAT — это же пульс узла, пока очередь движка заполнена.
+    """
+    global _port_counter
+    base = url.rstrip("/")
+    session = requests.Session()
+    headers = {"X-Shard-Token": CFG.SHARD_TOKEN} if CFG.SHARD_TOKEN else {}
+    name = socket.gethostname()
+    state = {"worker": "", "done": False}
+    outbox: List[dict] = []
+    outbox_lock = threading.Lock()
+    stats = {"total": 0, "white": 0, "universal": 0, "failed": 0}
+
+    def call(path: str, payload: dict) -> Optional[dict]:
+        """POST к координатору; None — воркер неизвестен (410). Сетевые сбои — с повтором."""
+        for attempt in range(5):
+            try:
+                r = session.post(base + path, json=payload, headers=headers, timeout=30)
+                if r.status_code == 410:
+                    return None
+                r.raise_for_status()
+                return r.json()
+            except requests.RequestException:
+                if attempt == 4 or stop_event.is_set():
+                    raise
+                time.sleep(2 ** attempt)
+
+    def register() -> None:
+        state["worker"] = call("/register", {"name": name})["worker"]
+        print(f"  🤝 Подключён к {base} как {state['worker']}")
+
+    def feed() -> Iterator[str]:
+        want = max(1, limiter_capacity())
+        while not stop_event.is_set():
+            try:
+                resp = call("/lease", {"worker": state["worker"], "n": want})
+            except requests.RequestException:
+                print("  ⚠️  Координатор недоступен — завершаю")
+                return
+            if resp is None:
+                register()
+                continue
+            if resp["keys"]:
+                yield from resp["keys"]
+            elif resp["done"]:
+                state["done"] = True
+                return
+            else:
+                time.sleep(1.0)         # свой шард пуст, чужие ключи ещё проверяются
+
+    def check_fn(unit: List[str]) -> list:
+        results = _guarded_check_unit(unit)
+        with outbox_lock:
+            outbox.extend({"key": k, "result": list(r), "latency": _key_latency.get(k)}
+                          for k, r in zip(unit, results))
+        return results
+
+    def flush() -> None:
+        with outbox_lock:
+            batch = outbox[:]
+            del outbox[:]
+        if not batch and state["done"]:
+            return
+        try:
+            call("/results", {"worker": state["worker"], "results": batch})
+        except requests.RequestException:
+            with outbox_lock:
+                outbox[:0] = batch
+
+    finished = threading.Event()
+
+    def heartbeat() -> None:
+        while not finished.wait(CFG.SHARD_HEARTBEAT):
+            flush()
+
+    # Несколько воркеров на одной машине начинают с разных участков диапазона портов
+    _port_counter = random.randrange(CFG.SOCKS_PORT_RANGE)
+    register()
+    threading.Thread(target=heartbeat, daemon=True, name="shard-heartbeat").start()
+    try:
+        run_async_engine([(base, feed())], [], [], stats, stop_event, check_fn)
+    finally:
+        finished.set()
+        flush()
+    return stats
+
+
+# ==================== MAIN ====================
+def _terminate(signum, frame):
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def main():
+    global _global_semaphore, _result_cache, _history, _journal
+    t_start = time.time()
+    args = parse_args()
+    # Таймаут Actions/kill присылает SIGTERM: сохраняемся как при Ctrl+C
+    signal.signal(signal.SIGTERM, _terminate)
+
+    if args.export_analytics or args.compact_history:
+        history = HistoryStore(CFG.HISTORY_DB, CFG.ANALYTICS_FILE)
+        if args.compact_history:
+            keys_n, checks_n = history.compact(CFG.HISTORY_KEEP_CHECKS, CFG.HISTORY_KEEP_DAYS)
+            print(f"🧹 История: удалено {keys_n} ключей, {checks_n} проверок")
+        if args.export_analytics:
+            n = history.export_json(args.export_analytics)
+            print(f"📤 {args.export_analytics}  ({n} ключей)")
+        history.close()
+        return
+
+    sources  = args.sources or CFG.SOURCES
+    max_keys = args.max_keys or CFG.MAX_KEYS
+    if args.workers_per_sub: CFG.MAX_WORKERS_PER_SUB = args.workers_per_sub
+    if args.total_workers:   CFG.MAX_TOTAL_WORKERS   = args.total_workers
+    if args.batch_size:      CFG.BATCH_SIZE          = args.batch_size
+    if args.cpu_workers:     CFG.CPU_WORKERS         = args.cpu_workers
+    if args.shard_token:     CFG.SHARD_TOKEN         = args.shard_token
+    if args.coordinator and coordinator_bind_error(args.coordinator):
+        print(f"\n❌ Координатор: {coordinator_bind_error(args.coordinator)}")
+        return
+    if args.startup_timeout: CFG.XRAY_STARTUP_TIMEOUT = args.startup_timeout
+    if args.curl:            CFG.NATIVE_PROBE        = False
+    if args.profile is not None: _profiler.enabled   = True
+    if args.metrics_port is not None: CFG.METRICS_PORT = args.metrics_port
+    if args.no_fetch_cache:  CFG.FETCH_CACHE         = False
+    if args.endpoint_probe_tls: CFG.ENDPOINT_PROBE_TLS = True
+    if args.geoip:           CFG.GEOIP_DB            = args.geoip
+    if args.echo_url:        CFG.EGRESS_ECHO_URL     = args.echo_url
+    if args.real_ip:         CFG.REAL_IP             = args.real_ip
+    if args.geo_deadline is not None: CFG.GEO_DEADLINE = args.geo_deadline
+    if args.stream:          args.engine             = "async"
+
+    # В пакетном режиме семафор считает процессы Xray, а не ключи:
+    # суммарно одновременно проверяется ~MAX_TOTAL_WORKERS ключей
+    batch = CFG.BATCH_SIZE if CFG.BATCH_SIZE > 1 else 1
+    if args.max_workers: CFG.ADAPTIVE_MAX_WORKERS = args.max_workers
+    if args.adaptive:
+        _global_semaphore = AdaptiveLimiter(max(1, CFG.MAX_TOTAL_WORKERS // batch),
+                                            max(1, CFG.ADAPTIVE_MIN_WORKERS // batch),
+                                            max(1, CFG.ADAPTIVE_MAX_WORKERS // batch))
+        # Пул подписки не должен упираться в фиксированный лимит раньше регулятора
+        CFG.MAX_WORKERS_PER_SUB = max(CFG.MAX_WORKERS_PER_SUB, CFG.ADAPTIVE_MAX_WORKERS)
+    else:
+        _global_semaphore = threading.Semaphore(max(1, CFG.MAX_TOTAL_WORKERS // batch))
 
-    # ── ШАГ 2: Проверка ─────────────────────────────────────────────────
     print(f"\n{'='*70}")
-    print("🚀 НАЧИНАЕМ ПРОВЕРКУ")
+    print(" VPN Checker v4.0 — УМНАЯ ПРОВЕРКА ПО ПОДПИСКАМ")
     print(f"{'='*70}")
+    print(f"  Потоков на подписку: до {CFG.MAX_WORKERS_PER_SUB}")
+    print(f"  Глобальный лимит Xray: {CFG.MAX_TOTAL_WORKERS}")
+    print(f"  Движок: {args.engine}")
+    if args.adaptive:
+        print(f"  Адаптивный лимит: {CFG.ADAPTIVE_MIN_WORKERS}..{CFG.ADAPTIVE_MAX_WORKERS}")
+    if batch > 1:
+        print(f"  Пакетный режим: {batch} ключей на Xray, до {max(1, CFG.MAX_TOTAL_WORKERS // batch)} Xray")
+    print(f"  Startup: до {CFG.XRAY_STARTUP_TIMEOUT}s | Timeout: {CFG.REQUEST_TIMEOUT}s")
+
+    metrics: Optional[MetricsServer] = None
+    if CFG.METRICS_PORT:
+        try:
+            metrics = MetricsServer(CFG.METRICS_HOST, CFG.METRICS_PORT)
+        except OSError as e:
+            print(f"  ⚠️  Метрики: порт {CFG.METRICS_PORT} недоступен ({e})")
+        else:
+            # Гистограммы этапов для /metrics собирает профилировщик
+            _profiler.enabled = True
+            metrics.start()
+            print(f"  📈 Метрики: http://{CFG.METRICS_HOST}:{CFG.METRICS_PORT}/metrics")
+
+    # Получаем реальный IP машины один раз при старте
+    global _real_ip
+    _real_ip = detect_real_ip()
+    if _real_ip:
+        print(f"  🌐 Реальный IP: {_real_ip}")
+    else:
+        print("  ⚠️  Реальный IP не определён — проверка «трафик мимо прокси» отключена")
+
+    # Координатор сам ничего не проверяет — Xray ему не нужен
+    if not os.path.exists(CFG.XRAY_PATH) and not args.coordinator:
+        print(f"\n❌ Xray не найден: {CFG.XRAY_PATH}")
+        return
+
+    geo_path = geoip_db_path()
+    if load_geo_index(geo_path):
+        print(f"  🗺️  GeoIP: {geo_path} ({_geo_index.size} подсетей)")
+    else:
+        print(f"  ⚠️  GeoIP-база не найдена ({geo_path}) — страна по префиксам и домену")
+
+    if args.worker:
+        stop_event = threading.Event()
+        t0 = time.time()
+        stats = run_worker(args.worker, stop_event)
+        elapsed = time.time() - t0
+        print(f"\n  Воркер: проверено {stats['total']} | 🏳️ {stats['white']} | "
+              f"🌍 {stats['universal']} | {stats['total'] / elapsed * 60 if elapsed else 0:.0f} ключ/мин")
+        if args.profile is not None:
+            _profiler.report(args.profile)
+        print("\n✅ ГОТОВО!\n")
+        return
+
+    if not sources:
+        print("\n❌ Нет источников. Добавь ссылки в CFG.SOURCES или передай через --sources")
+        return
 
     white_keys:     List[str] = []
     universal_keys: List[str] = []
-    stats      = {"total": 0, "white": 0, "universal": 0, "failed": 0}
+    stats      = {"total": 0, "white": 0, "universal": 0, "failed": 0, "cached": 0}
     stop_event = threading.Event()
+    check_fn   = None
+    origins:    Dict[str, str] = {}
+
+    _history = HistoryStore(CFG.HISTORY_DB, CFG.ANALYTICS_FILE)
+    # --full не читает кэш, но обновляет его свежими результатами
+    _result_cache = ResultCache(CFG.RESULT_CACHE_FILE, read=not args.full)
+
+    if args.daemon:
+        if isinstance(_global_semaphore, AdaptiveLimiter):
+            ConcurrencyController(_global_semaphore, stop_event).start()
+        run_daemon(sources, max_keys, CFG.ENDPOINT_PROBE and not args.no_endpoint_probe,
+                   stop_event)
+        _history.close()
+        if args.profile is not None:
+            _profiler.report(args.profile)
+        if metrics is not None:
+            metrics.close()
+        print("\n✅ ГОТОВО!\n")
+        return
+
+    _journal = RunJournal(CFG.JOURNAL_FILE, resume=args.resume)
+    if args.resume and not _journal.done:
+        print(f"  ⏯️  Журнал {CFG.JOURNAL_FILE} пуст — проверяем всё")
+
+    if args.stream:
+        # Без предварительного анализа: ключи идут в очередь по мере загрузки,
+        # мёртвые серверы отсеиваются лениво при первой встрече
+        sub_data = stream_feed(order_sources(sources, _history.source_ratios()), max_keys,
+                               white_keys, universal_keys, stats, stop_event, origins)
+        if CFG.ENDPOINT_PROBE and not args.no_endpoint_probe:
+            check_fn = EndpointGate(_guarded_check_unit)
+    else:
+        # ── ШАГ 1: Анализ всех подписок ─────────────────────────────────
+        sub_data = analyze_sources(sources, max_keys, white_keys, universal_keys, stats,
+                                   CFG.ENDPOINT_PROBE and not args.no_endpoint_probe, origins)
+        prio = score_keys(sub_data, _history, _history.source_ratios())
+        if args.time_budget:
+            sub_data = order_by_value(sub_data, prio)
+            print(f"  🎯 Очередь по ожидаемой пользе: {len(prio.chance)} ключей, "
+                  f"ожидается ~{sum(prio.chance.values()):.0f} рабочих")
+        else:
+            sub_data = order_by_priority(sub_data, prio)
+            print(f"  🎯 Порядок по истории: подписки по выходу, ключи по успешности "
+                  f"(ожидается ~{sum(prio.chance.values()):.0f} рабочих)")
+
+    # ── ШАГ 2: Проверка ─────────────────────────────────────────────────
+    print(f"\n{'='*70}")
+    print("🚀 НАЧИНАЕМ ПРОВЕРКУ")
+    print(f"{'='*70}")
+
     t_global   = time.time()
+    if isinstance(_global_semaphore, AdaptiveLimiter):
+        ConcurrencyController(_global_semaphore, stop_event).start()
+    if args.time_budget:
+        stop_at = t_start + (args.time_budget - CFG.SAVE_RESERVE_MIN) * 60 - CFG.TOTAL_TIMEOUT
+        total = 0 if args.stream else sum(len(keys) for _, keys in sub_data)
+        print(f"  ⏳ Бюджет {args.time_budget:.0f} мин: проверка до "
+              f"{time.strftime('%H:%M:%S', time.localtime(stop_at))}")
+        DeadlineWatch(stop_at, stop_event, total).start()
 
     try:
-        for i, (url, keys) in enumerate(sub_data, 1):
-            if stop_event.is_set():
-                break
-            check_subscription(i, len(sub_data), url, keys,
-                                white_keys, universal_keys, stats, stop_event)
-            elapsed = time.time() - t_global
-            speed = stats["total"] / elapsed * 60 if elapsed else 0
-            print(f"   📈 Общий итог: 🏳️ {stats['white']} | 🌍 {stats['universal']} | "
-                  f"{speed:.0f} ключ/мин | осталось подписок: {len(sub_data)-i}")
+        if args.coordinator:
+            run_coordinator(sub_data, args.coordinator, white_keys, universal_keys, stats, stop_event)
+        elif args.engine == "async":
+            run_async_engine(sub_data, white_keys, universal_keys, stats, stop_event, check_fn)
+        else:
+            for i, (url, keys) in enumerate(sub_data, 1):
+                if stop_event.is_set():
+                    break
+                check_subscription(i, len(sub_data), url, keys,
+                                    white_keys, universal_keys, stats, stop_event)
+                elapsed = time.time() - t_global
+                speed = stats["total"] / elapsed * 60 if elapsed else 0
+                print(f"   📈 Общий итог: 🏳️ {stats['white']} | 🌍 {stats['universal']} | "
+                      f"{speed:.0f} ключ/мин | осталось подписок: {len(sub_data)-i}")
 
     except KeyboardInterrupt:
         print("\n\n⚠️  Ctrl+C — сохраняю...")
@@ -1242,16 +4808,40 @@ def main():
     print(f"  🏳️  Белый список:  {stats['white']}")
     print(f"  🌍 Универсальные: {stats['universal']}")
     print(f"  ❌ Не работают:   {stats['failed']}")
+    if stats["cached"]:
+        print(f"  ♻️  Из кэша:       {stats['cached']}")
+    if stats.get("resumed"):
+        print(f"  ⏯️  Из журнала:    {stats['resumed']}")
     print(f"  ⏱️  Время:         {elapsed/60:.1f} мин")
     spd = stats['total'] / elapsed * 60 if elapsed else 0
     print(f"  ⚡ Скорость:       {spd:.0f} ключ/мин")
+    if _startup_times:
+        st = sorted(_startup_times)
+        print(f"  🚀 Старт Xray:     медиана {st[len(st)//2]*1000:.0f}ms, "
+              f"макс {st[-1]*1000:.0f}ms")
     print(f"{'='*70}")
 
+    if _result_cache is not None:
+        _result_cache.save()
+    if not stop_event.is_set():
+        # Выход источников — только по полному прогону, иначе он занижен
+        _history.record_sources(source_yields(origins, white_keys + universal_keys))
+    _history.compact(CFG.HISTORY_KEEP_CHECKS, CFG.HISTORY_KEEP_DAYS)
+    _history.close()
+
     if white_keys or universal_keys:
         save_keys(white_keys, universal_keys)
     else:
         print("\n⚠️  Рабочих ключей не найдено")
 
+    # Журнал нужен только прерванному прогону
+    _journal.close(remove=not stop_event.is_set())
+
+    if args.profile is not None:
+        _profiler.report(args.profile)
+    if metrics is not None:
+        metrics.close()
+
     print("\n✅ ГОТОВО!\n")
 
 
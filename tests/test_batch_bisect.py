@@ -0,0 +1,104 @@
+"""_check_batch_items: деление пачки пополам только при падении Xray, а не при сбоях окружения."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FakeXray:
+    """Вместо Xray: «падает» на конфиге с BAD, медленный старт — по счётчику slow_starts."""
+
+    launches = []
+    slow_starts = 0
+
+    def __init__(self, config_path, port, ports=None):
+        with open(config_path) as f:
+            self.config = f.read()
+        self.ports = ports or [port]
+        self.slow = False
+        self.startup_time = 0.01
+
+    def start(self):
+        FakeXray.launches.append(list(self.ports))
+        if FakeXray.slow_starts:
+            FakeXray.slow_starts -= 1
+            self.slow = True
+            return False
+        return "BAD" not in self.config
+
+    def stop(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def fake_xray(monkeypatch):
+    FakeXray.launches = []
+    FakeXray.slow_starts = 0
+    monkeypatch.setattr(main, "XrayManager", FakeXray)
+    monkeypatch.setattr(main, "_port_busy", lambda port: False)
+    monkeypatch.setattr(main, "_probe_key",
+                        lambda key, port: (True, "Универсальный", key, "universal", "ok", ""))
+
+
+def _items(hosts):
+    items = []
+    for i, host in enumerate(hosts):
+        key = f"trojan://pw@{host}:443?security=tls#k{i}"
+        port = 20000 + i
+        items.append((i, key, port, main.create_xray_config(key, port)))
+    return items
+
+
+def test_bisection_isolates_broken_key():
+    items = _items(["a.example", "b.example", "BAD.example", "d.example"])
+    results = [None] * len(items)
+    main._check_batch_items(items, results)
+    assert [r[1] for r in results] == ["Универсальный", "Универсальный",
+                                       "Xray не запустился", "Универсальный"]
+    assert not main.is_verdict(results[2])
+    assert FakeXray.launches[0] == [20000, 20001, 20002, 20003]
+
+
+def test_slow_start_retries_same_size_without_bisection():
+    FakeXray.slow_starts = 1
+    items = _items(["a.example", "b.example", "c.example"])
+    results = [None] * len(items)
+    main._check_batch_items(items, results)
+    assert all(r[0] for r in results)
+    assert FakeXray.launches == [[20000, 20001, 20002]] * 2
+
+
+def test_persistent_slow_start_is_not_a_verdict():
+    FakeXray.slow_starts = 10
+    items = _items(["a.example", "b.example"])
+    results = [None] * len(items)
+    main._check_batch_items(items, results)
+    assert results == [main.XRAY_SLOW] * 2
+    assert len(FakeXray.launches) == 2
+    assert not main.is_verdict(main.XRAY_SLOW)
+
+
+def test_busy_port_rebinds_instead_of_blaming_keys(monkeypatch):
+    busy = {20001}
+    monkeypatch.setattr(main, "_port_busy", lambda port: port in busy)
+    monkeypatch.setattr(main, "alloc_port", lambda: 30000)
+    items = _items(["a.example", "b.example"])
+    # Первый запуск «падает», пока порт 20001 занят чужим процессом
+    starts = iter([False, True])
+    monkeypatch.setattr(FakeXray, "start",
+                        lambda self: FakeXray.launches.append(list(self.ports)) or next(starts))
+    results = [None] * len(items)
+    main._check_batch_items(items, results)
+    assert all(r[0] for r in results)
+    assert FakeXray.launches == [[20000, 20001], [20000, 30000]]
+
+
+def test_alloc_port_gives_up_when_range_is_busy(monkeypatch):
+    monkeypatch.setattr(main, "_port_busy", lambda port: True)
+    assert main.alloc_port() is None
+    assert main.check_unit(["trojan://pw@a.example:443#x"]) == [main.PORT_CONFLICT]
@@ -0,0 +1,57 @@
+"""canonical_key: одинаковые ключи в разной записи совпадают, разные серверы — нет."""
+
+import base64
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def _vmess(fields: dict) -> str:
+    return "vmess://" + base64.b64encode(json.dumps(fields).encode()).decode()
+
+
+def test_name_order_and_case_do_not_matter():
+    a = "trojan://pw@Host.example:443?type=ws&path=%2Fws&security=tls#first"
+    b = "TROJAN://pw@host.example:443?security=tls&path=/ws&type=ws#second"
+    assert main.canonical_key(a) == main.canonical_key(b)
+
+
+def test_transport_params_keep_keys_distinct():
+    pairs = [
+        ("trojan://pw@h:443?type=ws&path=/a", "trojan://pw@h:443?type=ws&path=/b"),
+        ("trojan://pw@h:443?type=ws&host=a.com", "trojan://pw@h:443?type=ws&host=b.com"),
+        ("hysteria2://pw@h:443?obfs=salamander&obfs-password=x",
+         "hysteria2://pw@h:443?obfs=salamander&obfs-password=y"),
+        ("vless://id@h:443?type=xhttp&path=/a", "vless://id@h:443?type=xhttp&path=/b"),
+        ("vless://id@h:443?security=tls&fp=chrome", "vless://id@h:443?security=tls&fp=firefox"),
+        ("vless://id@h:443?security=tls&alpn=h2", "vless://id@h:443?security=tls&alpn=http/1.1"),
+    ]
+    for a, b in pairs:
+        assert main.canonical_key(a) != main.canonical_key(b), (a, b)
+
+
+def test_vmess_ignores_ps_but_not_path():
+    base = {"add": "h.example", "port": 443, "id": "u", "net": "tcp", "path": "/a"}
+    same = dict(base, ps="other name", add="H.EXAMPLE", port="443")
+    other = dict(base, path="/b")
+    assert main.canonical_key(_vmess(dict(base, ps="x"))) == main.canonical_key(_vmess(same))
+    assert main.canonical_key(_vmess(base)) != main.canonical_key(_vmess(other))
+
+
+def test_shadowsocks_userinfo_encodings_match():
+    userinfo = base64.b64encode(b"aes-256-gcm:secret").decode()
+    sip002 = f"ss://{userinfo}@h.example:8388#a"
+    unpadded = f"ss://{userinfo.rstrip('=')}@H.example:8388#b"
+    legacy = "ss://" + base64.b64encode(b"aes-256-gcm:secret@h.example:8388").decode()
+    ids = {main.canonical_key(k) for k in (sip002, unpadded, legacy)}
+    assert len(ids) == 1
+
+
+def test_prepare_chunk_uses_same_identity():
+    keys = ["trojan://pw@h:443?type=ws&path=/a#x", "trojan://pw@h:443?type=ws&path=/b#y"]
+    prepared = main._prepare_chunk(keys)
+    assert [ident for ident, _ in prepared] == [main.canonical_key(k) for k in keys]
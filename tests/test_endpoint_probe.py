@@ -0,0 +1,73 @@
+"""probe_endpoint: мёртв только по отказу или молчанию; TLS-вариант ловит немые серверы."""
+
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def fast(monkeypatch):
+    monkeypatch.setattr(main.CFG, "ENDPOINT_PROBE_TIMEOUT", 0.3)
+    monkeypatch.setattr(main.CFG, "ENDPOINT_PROBE_ATTEMPTS", 1)
+
+
+def _server(reply: bytes = b""):
+    """Принимает TCP; reply — что ответить на первые байты (пусто — молчать)."""
+    srv = socket.socket()
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(8)
+    conns = []
+
+    def serve():
+        while True:
+            try:
+                c, _ = srv.accept()
+            except OSError:
+                return
+            conns.append(c)
+            if reply:
+                c.recv(4096)
+                c.sendall(reply)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return srv
+
+
+def test_refused_is_dead():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    assert main.probe_endpoint("127.0.0.1", port) is False
+
+
+def test_silent_server_is_alive_over_tcp_but_dead_over_tls():
+    srv = _server()
+    port = srv.getsockname()[1]
+    assert main.probe_endpoint("127.0.0.1", port) is True
+    assert main.probe_endpoint("127.0.0.1", port, "example.com") is False
+    srv.close()
+
+
+def test_tls_alert_counts_as_alive():
+    # TLS alert handshake_failure: сервер ответил — жив
+    srv = _server(b"\x15\x03\x03\x00\x02\x02\x28")
+    assert main.probe_endpoint("127.0.0.1", srv.getsockname()[1], "example.com") is True
+    srv.close()
+
+
+def test_endpoint_sni_only_with_flag(monkeypatch):
+    key = "vless://id@1.2.3.4:443?security=reality&sni=www.example.com&pbk=x#k"
+    assert main.endpoint_sni(key) == ""
+    monkeypatch.setattr(main.CFG, "ENDPOINT_PROBE_TLS", True)
+    assert main.endpoint_sni(key) == "www.example.com"
+    assert main.endpoint_sni("vless://id@host.example:443?security=tls#k") == "host.example"
+    assert main.endpoint_sni("vless://id@1.2.3.4:443?security=tls#k") == ""
+    assert main.endpoint_sni("vless://id@host.example:80?security=none#k") == ""
@@ -0,0 +1,90 @@
+"""GeoIndex: самая узкая подсеть, IPv4/IPv6, чтение geoip.dat и CSV."""
+
+import ipaddress
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def _ranges(*rows):
+    for network, cc in rows:
+        net = ipaddress.ip_network(network)
+        yield net.version, int(net.network_address), int(net.broadcast_address), cc
+
+
+def test_narrowest_subnet_wins():
+    index = main.GeoIndex(_ranges(("10.0.0.0/8", "AA"), ("10.1.0.0/16", "BB"),
+                                  ("10.1.2.0/24", "CC"), ("10.2.0.0/16", "DD")))
+    assert index.lookup("10.1.2.3") == "CC"
+    assert index.lookup("10.1.3.1") == "BB"
+    assert index.lookup("10.2.0.1") == "DD"
+    # После вложенных подсетей адрес снова попадает в охватывающую
+    assert index.lookup("10.200.0.1") == "AA"
+    assert index.lookup("11.0.0.1") is None
+    assert index.lookup("not an ip") is None
+
+
+def test_ipv4_and_ipv6_tables_are_separate():
+    index = main.GeoIndex(_ranges(("0.0.0.0/1", "AA"), ("2001:db8::/32", "BB")))
+    assert index.lookup("1.2.3.4") == "AA"
+    assert index.lookup("2001:db8::1") == "BB"
+    assert index.lookup("2001:db9::1") is None
+    assert index.lookup_many(["1.2.3.4", "1.2.3.4", "2001:db8::1"]) == {
+        "1.2.3.4": "AA", "2001:db8::1": "BB"}
+
+
+def _varint(n: int) -> bytes:
+    out = bytearray()
+    while True:
+        b = n & 0x7F
+        n >>= 7
+        out.append(b | (0x80 if n else 0))
+        if not n:
+            return bytes(out)
+
+
+def _field(num: int, value) -> bytes:
+    if isinstance(value, int):
+        return _varint(num << 3) + _varint(value)
+    return _varint(num << 3 | 2) + _varint(len(value)) + value
+
+
+def _geoip(cc: str, *networks: str) -> bytes:
+    body = _field(1, cc.encode())
+    for network in networks:
+        net = ipaddress.ip_network(network)
+        body += _field(2, _field(1, net.network_address.packed) + _field(2, net.prefixlen))
+    return _field(1, body)
+
+
+def test_read_geoip_dat(tmp_path):
+    path = tmp_path / "geoip.dat"
+    path.write_bytes(_geoip("nl", "185.0.0.0/8", "2a00::/12")
+                     + _geoip("private", "10.0.0.0/8")
+                     + _geoip("DE", "185.10.0.0/16"))
+    rows = list(main._read_geoip_dat(str(path)))
+    assert (4, int(ipaddress.ip_address("185.0.0.0")),
+            int(ipaddress.ip_address("185.255.255.255")), "NL") in rows
+    assert all(cc in ("NL", "DE") for *_, cc in rows)
+
+    index = main.GeoIndex.load(str(path))
+    assert index.size == 3
+    assert index.lookup("185.10.1.1") == "DE"
+    assert index.lookup("185.11.1.1") == "NL"
+    assert index.lookup("2a01::1") == "NL"
+    assert index.lookup("10.0.0.1") is None
+
+
+def test_read_csv_formats(tmp_path):
+    cidr = tmp_path / "cidr.csv"
+    cidr.write_text("network,country\n1.0.0.0/24,au\n# comment\nbad,XX\n")
+    assert main.GeoIndex.load(str(cidr)).lookup("1.0.0.7") == "AU"
+
+    ip2l = tmp_path / "ip2location.csv"
+    ip2l.write_text('"16777216","16777471","JP","Japan"\n"16777472","16778239","-","-"\n')
+    index = main.GeoIndex.load(str(ip2l))
+    assert index.lookup("1.0.0.1") == "JP"
+    assert index.lookup("1.0.1.1") is None
@@ -0,0 +1,80 @@
+"""HistoryStore: веса по давности в key_stats и чистка в compact."""
+
+import json
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+HOUR = 3600
+
+
+@pytest.fixture
+def store(tmp_path):
+    s = main.HistoryStore(str(tmp_path / "history.sqlite"))
+    yield s
+    s.close()
+
+
+def _seed(store, tmp_path, entries):
+    path = tmp_path / "analytics.json"
+    path.write_text(json.dumps(entries))
+    store.import_json(str(path))
+
+
+def test_key_stats_weights_by_age(store, tmp_path):
+    now = time.time()
+    _seed(store, tmp_path, {
+        "fresh": {"created": now, "checks": [
+            {"time": now, "success": True, "latency": 100},
+            {"time": now, "success": False, "latency": None},
+        ]},
+        "old": {"created": now, "checks": [
+            {"time": now - 48 * HOUR, "success": True, "latency": 300},
+        ]},
+    })
+    stats = store.key_stats(["fresh", "old", "unknown"], half_life_hours=48)
+    assert set(stats) == {"fresh", "old"}
+    assert stats["fresh"]["n"] == 2 and stats["fresh"]["ok"] == 1
+    assert stats["fresh"]["w"] == pytest.approx(2.0, rel=1e-3)
+    # Латентность — только по успешным проверкам
+    assert stats["fresh"]["latency"] == 100
+    # Ровно один период полураспада — вес вдвое меньше
+    assert stats["old"]["w_ok"] == pytest.approx(0.5, rel=1e-3)
+
+
+def test_append_is_visible_after_flush(store):
+    store.append("k", True, 250)
+    store.append("k", False)
+    checks = store.get_checks("k")
+    assert [c["success"] for c in checks] == [True, False]
+    assert checks[0]["latency"] == 250
+
+
+def test_compact_keeps_latest_checks_and_drops_stale_keys(store, tmp_path):
+    now = time.time()
+    _seed(store, tmp_path, {
+        "busy": {"created": now, "checks": [
+            {"time": now - i, "success": i % 2 == 0, "latency": None} for i in range(10)]},
+        "stale": {"created": now - 90 * 86400, "checks": [
+            {"time": now - 90 * 86400, "success": True, "latency": None}]},
+    })
+    store.touch(["busy"])
+    dropped_keys, dropped_checks = store.compact(keep_checks=3, keep_days=30)
+    assert dropped_keys == 1
+    assert dropped_checks == 1 + 7
+    assert [c["time"] for c in store.get_checks("busy")] == \
+        pytest.approx([now - 2, now - 1, now], abs=1e-3)
+    assert store.get_checks("stale") == []
+
+
+def test_source_ratios_are_smoothed(store):
+    store.record_sources({"http://a": (8, 8), "http://b": (0, 0)})
+    ratios = store.source_ratios()
+    assert ratios["http://a"] == pytest.approx(9 / 10)
+    assert ratios["http://b"] == pytest.approx(0.5)
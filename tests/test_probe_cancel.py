@@ -0,0 +1,74 @@
+"""Отмена TLS-пробы, зависшей на рукопожатии (ProbeCancel + socks_http_request)."""
+
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def _stalling_socks_server() -> socket.socket:
+    """SOCKS5, который принимает CONNECT и дальше молчит — ClientHello без ответа."""
+    srv = socket.socket()
+    srv.bind(("127.0.0.1", 0))
+    srv.listen(8)
+
+    def handle(c: socket.socket) -> None:
+        try:
+            c.recv(3)
+            c.sendall(b"\x05\x00")
+            head = c.recv(5)
+            c.recv(head[4] + 2)
+            c.sendall(b"\x05\x00\x00\x01" + b"\0" * 6)
+            while c.recv(4096):
+                pass
+        except OSError:
+            pass
+        finally:
+            c.close()
+
+    def serve() -> None:
+        while True:
+            try:
+                c, _ = srv.accept()
+            except OSError:
+                return
+            threading.Thread(target=handle, args=(c,), daemon=True).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    return srv
+
+
+def test_cancel_interrupts_tls_handshake():
+    srv = _stalling_socks_server()
+    port = srv.getsockname()[1]
+    cancel = main.ProbeCancel()
+    out = {}
+
+    def run() -> None:
+        out["r"] = main.socks_http_request(port, "https://example.com/", timeout=10,
+                                           connect_timeout=2, cancel=cancel)
+
+    t = threading.Thread(target=run)
+    t0 = time.time()
+    t.start()
+    time.sleep(0.5)                 # проба висит в do_handshake
+    cancel.cancel()
+    t.join(3)
+    srv.close()
+
+    assert not t.is_alive(), "отмена не прервала рукопожатие"
+    assert time.time() - t0 < 3
+    assert not out["r"].ok
+
+
+def test_cancelled_before_start_does_not_connect():
+    cancel = main.ProbeCancel()
+    cancel.cancel()
+    r = main.socks_http_request(1, "https://example.com/", timeout=5, cancel=cancel)
+    assert not r.ok
+    assert "отменено" in r.error
@@ -0,0 +1,72 @@
+"""RunJournal: сброс на диск по таймеру и подхват прерванного прогона (--resume)."""
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+OK = (True, "Универсальный", "vless://wkey", "universal", "ok", "🇳🇱NL")
+FAIL = (False, "Не работает", None, "none", "ничего не отвечает", "")
+
+
+@pytest.fixture(autouse=True)
+def interval(monkeypatch):
+    monkeypatch.setattr(main.CFG, "CHECKPOINT_INTERVAL", 0.2)
+
+
+def _lines(path):
+    with open(path, encoding="utf-8") as f:
+        return f.read().splitlines()
+
+
+def test_flushes_without_new_records(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = main.RunJournal(path)
+    journal.record("vless://a", OK)
+    assert _lines(path) == []
+    deadline = time.time() + 3
+    while not _lines(path) and time.time() < deadline:
+        time.sleep(0.05)
+    assert len(_lines(path)) == 1
+    journal.close()
+
+
+def test_resume_replays_results(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    journal = main.RunJournal(path)
+    journal.record("vless://a", OK)
+    journal.record("vless://b", FAIL)
+    journal.close()
+    # Недописанная строка при убийстве процесса пропускается
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"h": "trunc')
+
+    resumed = main.RunJournal(path, resume=True)
+    white, universal = [], []
+    stats = {"white": 0, "universal": 0}
+    assert resumed.replay("vless://a", white, universal, stats)
+    assert resumed.replay("vless://b", white, universal, stats)
+    assert not resumed.replay("vless://c", white, universal, stats)
+    assert universal == ["vless://wkey"] and white == []
+    assert stats == {"white": 0, "universal": 1, "resumed": 2}
+    assert main._country_flags_cache["vless://wkey"] == "🇳🇱NL"
+    resumed.close(remove=True)
+    assert not os.path.exists(path)
+
+
+def test_non_verdicts_are_not_journaled(tmp_path, monkeypatch):
+    journal = main.RunJournal(str(tmp_path / "journal.jsonl"))
+    monkeypatch.setattr(main, "_journal", journal)
+    monkeypatch.setattr(main, "_result_cache", None)
+    monkeypatch.setattr(main, "_history", None)
+    main._remember_result("vless://slow", main.XRAY_SLOW)
+    main._remember_result("vless://busy", main.PORT_CONFLICT)
+    main._remember_result("vless://dead", FAIL)
+    journal.close()
+    done = main.RunJournal._read(journal.path)
+    assert set(done) == {main.get_hash("vless://dead")}
@@ -0,0 +1,108 @@
+"""Шардинг: HashRing, очереди ShardCoordinator и проверка результатов воркеров."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+KEYS = [f"vless://id{i}@h{i}.example:443#k{i}" for i in range(200)]
+OK = [True, "Универсальный", "vless://other", "universal", "ok", "🇳🇱NL"]
+FAIL = [False, "Не работает", None, "none", "ничего не отвечает", ""]
+
+
+def test_ring_moves_only_the_lost_nodes_keys():
+    ring = main.HashRing(64)
+    for node in ("a", "b", "c"):
+        ring.add(node)
+    before = {k: ring.owner(k) for k in KEYS}
+    assert set(before.values()) == {"a", "b", "c"}
+    ring.remove("b")
+    after = {k: ring.owner(k) for k in KEYS}
+    for k in KEYS:
+        if before[k] != "b":
+            assert after[k] == before[k]
+        else:
+            assert after[k] in ("a", "c")
+    assert main.HashRing(8).owner(KEYS[0]) is None
+
+
+def test_lease_follows_ring_and_steals_when_idle():
+    coord = main.ShardCoordinator(KEYS[:20], lambda k, r: None)
+    a = coord.register("a")
+    b = coord.register("b")
+    own_a = coord.lease(a, 100)
+    assert own_a and all(coord.ring.owner(k) == a for k in own_a)
+    # Собственная очередь пуста — воркер забирает хвост чужой
+    stolen = coord.lease(a, 3)
+    assert stolen and all(coord.ring.owner(k) == b for k in stolen)
+    assert coord.lease("unknown-1", 5) is None
+
+
+def test_complete_accepts_only_own_leases_and_uses_own_key():
+    got = {}
+    coord = main.ShardCoordinator(KEYS[:4], got.__setitem__)
+    a = coord.register("a")
+    b = coord.register("b")
+    leased = coord.lease(a, 4) + coord.lease(a, 4)
+    assert sorted(leased) == sorted(KEYS[:4])
+
+    coord.complete(b, [{"key": leased[0], "result": OK}])
+    assert got == {}                      # чужой аренды не засчитывается
+
+    coord.complete(a, [{"key": leased[0], "result": OK, "latency": 1e9},
+                       {"key": leased[1], "result": FAIL},
+                       {"key": leased[2], "result": "garbage"},
+                       {"key": "vless://never-leased", "result": OK}])
+    assert got[leased[0]][2] == leased[0]           # wkey воркера не берётся
+    assert got[leased[1]][0] is False
+    assert leased[2] not in got                      # мусор — ключ снова в очереди
+    assert leased[0] not in main._key_latency        # задержка вне 0..TOTAL_TIMEOUT
+    assert leased[2] in coord.pending and leased[2] not in coord.leases
+
+    coord.complete(a, [{"key": leased[0], "result": OK}])   # повтор не засчитывается
+    assert coord.progress()[0] == 2
+
+
+def test_reap_reassigns_lost_worker():
+    coord = main.ShardCoordinator(KEYS[:30], lambda k, r: None)
+    a = coord.register("a")
+    b = coord.register("b")
+    held = coord.lease(a, 5)
+    coord.last_seen[a] -= main.CFG.SHARD_WORKER_TIMEOUT + 1
+    coord.reap()
+    assert a not in coord.queues and not coord.leases
+    leased = []
+    while True:
+        got = coord.lease(b, 50)
+        if not got:
+            break
+        leased += got
+    assert set(held) <= set(leased) and len(leased) == 30
+
+
+@pytest.mark.parametrize("raw, expected", [
+    (OK, (True, "Универсальный", "KEY", "universal", "ok", "🇳🇱NL")),
+    ([True, "x", "k", "white", "d", "🇩🇪DE"], (True, "Белый список", "KEY", "white", "d", "🇩🇪DE")),
+    ([True, "x", "k", "universal", "d", "<script>XX"], (True, "Универсальный", "KEY", "universal", "d", "")),
+    ([True, "x", "k", "none", "d", ""], (False, "x", None, "none", "d", "")),
+    ([True, "x", "k", "admin", "d", ""], (False, "x", None, "none", "d", "")),
+    ([1, "x", "k", "universal", "d", ""], (False, "x", None, "none", "d", "")),
+    ([True, "x", "k", "universal", "d"], None),
+    ([True, 5, "k", "universal", "d", ""], None),
+    (None, None),
+])
+def test_shard_result_validation(raw, expected):
+    assert main._shard_result("KEY", raw) == expected
+
+
+def test_open_bind_requires_token(monkeypatch):
+    monkeypatch.setattr(main.CFG, "SHARD_TOKEN", "")
+    assert not main.coordinator_bind_error("127.0.0.1:8765")
+    assert not main.coordinator_bind_error("localhost:8765")
+    assert main.coordinator_bind_error("0.0.0.0:8765")
+    monkeypatch.setattr(main.CFG, "SHARD_TOKEN", "secret")
+    assert not main.coordinator_bind_error("0.0.0.0:8765")
@@ -0,0 +1,48 @@
+"""iter_subscription_keys: текст и base64, разрезанные на куски где угодно."""
+
+import base64
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+KEYS = [f"vless://id{i}@h{i}.example:443?security=tls&sni=s{i}#имя {i}" for i in range(40)]
+TEXT = ("\r\n".join(KEYS) + "\n# комментарий\nnot a key\n").encode("utf-8")
+
+
+def _split(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.mark.parametrize("size", [1, 3, 7, 64, 100000])
+def test_plain_text_any_chunking(size):
+    assert list(main.iter_subscription_keys(_split(TEXT, size), sniff=16)) == KEYS
+
+
+@pytest.mark.parametrize("size", [1, 5, 13, 4096])
+def test_base64_any_chunking(size):
+    encoded = base64.b64encode(TEXT)
+    # Переносы строк внутри base64 встречаются у части провайдеров
+    wrapped = b"\n".join(_split(encoded, 76))
+    assert list(main.iter_subscription_keys(_split(wrapped, size), sniff=64)) == KEYS
+
+
+def test_base64_without_padding():
+    encoded = base64.b64encode("\n".join(KEYS[:3]).encode()).rstrip(b"=")
+    assert list(main.iter_subscription_keys([encoded], sniff=64)) == KEYS[:3]
+
+
+def test_last_line_without_newline():
+    data = "\n".join(KEYS[:2]).encode()
+    assert list(main.iter_subscription_keys(_split(data, 10), sniff=8)) == KEYS[:2]
+
+
+def test_broken_base64_midstream_raises():
+    encoded = base64.b64encode(TEXT)
+    broken = encoded[:200] + b"=" + encoded[200:]
+    with pytest.raises(ValueError):
+        list(main.iter_subscription_keys(_split(broken, 64), sniff=64))